@@ -0,0 +1,199 @@
+"""
+Запись и воспроизведение запросов к LLM на уровне HTTP-транспорта клиента OpenAI.
+- record: запросы идут в API как обычно, а пары запрос/ответ (включая вызовы функций и
+  потоковые ответы по чанкам) с таймингами дописываются в LLM_CASSETTE_PATH (gzip JSONL);
+- replay: ответы отдаются из файла без сети, с записанными задержками до заголовков и между
+  чанками, умноженными на LLM_CASSETTE_TIME_SCALE.
+Запрос узнаётся по хешу метода, пути и тела (JSON с отсортированными ключами); одинаковые
+запросы воспроизводятся в порядке записи, после исчерпания повторяется последний ответ.
+Так прогоны изменений контекста, кэширования и маршрутизации повторяемы и идут офлайн.
+"""
+import asyncio
+import codecs
+import gzip
+import hashlib
+import json
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+from app.config import settings
+
+# Заголовки ответа, которые не имеют смысла после записи (тело хранится раскодированным)
+_SKIP_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "set-cookie"}
+
+cassette_stats: Dict[str, int] = {
+    "recorded": 0,
+    "replayed": 0,
+    "misses": 0,
+}
+
+
+def request_key(request: httpx.Request) -> str:
+    body: Any = request.content.decode("utf-8", errors="replace")
+    try:
+        body = json.loads(body) if body else None
+    except ValueError:
+        pass
+    canonical = json.dumps([request.method, request.url.path, body], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+def _model(request: httpx.Request) -> Optional[str]:
+    try:
+        return json.loads(request.content).get("model")
+    except (ValueError, AttributeError):
+        return None
+
+
+class _RecordingStream(httpx.AsyncByteStream):
+    """
+    Пропускает тело ответа API как есть и запоминает чанки со смещениями от начала запроса;
+    запись в файл — только если тело дочитано до конца (проигравший hedge-запрос не пишется).
+    """
+
+    def __init__(self, cassette: "CassetteTransport", response: httpx.Response, entry: Dict[str, Any], started: float):
+        self._cassette = cassette
+        self._response = response
+        self._entry = entry
+        self._started = started
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        chunks: List[List[Any]] = []
+        async for chunk in self._response.aiter_raw():
+            offset = round((time.monotonic() - self._started) * 1000, 1)
+            chunks.append([offset, decoder.decode(chunk)])
+            yield chunk
+        tail = decoder.decode(b"", final=True)
+        if tail and chunks:
+            chunks[-1][1] += tail
+        elif tail:
+            chunks.append([round((time.monotonic() - self._started) * 1000, 1), tail])
+        self._entry["chunks"] = chunks
+        self._cassette.append(self._entry)
+
+    async def aclose(self) -> None:
+        await self._response.aclose()
+
+
+class _ReplayStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: List[List[Any]], started: float, scale: float):
+        self._chunks = chunks
+        self._started = started
+        self._scale = scale
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for offset, text in self._chunks:
+            wait = offset / 1000 * self._scale - (time.monotonic() - self._started)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            yield text.encode("utf-8")
+
+
+class CassetteTransport(httpx.AsyncBaseTransport):
+    def __init__(self, mode: str, path: str, time_scale: float, inner: Optional[httpx.AsyncBaseTransport] = None):
+        self._mode = mode
+        self._path = path
+        self._scale = time_scale
+        self._inner = inner
+        self._entries: Dict[str, List[Dict[str, Any]]] = {}
+        self._served: Dict[str, int] = {}
+        if mode == "replay":
+            self._load()
+        print(f"[cassette] Mode {mode}, file {path}, {sum(len(v) for v in self._entries.values())} recorded responses")
+
+    def _load(self) -> None:
+        if not os.path.exists(self._path):
+            print(f"[cassette] {self._path} not found, every request will miss")
+            return
+        try:
+            with gzip.open(self._path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries.setdefault(entry["key"], []).append(entry)
+        except (EOFError, ValueError) as e:
+            # Оборванная последняя запись (процесс остановлен во время записи) — берём всё до неё
+            print(f"[cassette] {self._path} is truncated, loaded what was readable: {type(e).__name__}: {e}")
+
+    def append(self, entry: Dict[str, Any]) -> None:
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Режим "at" дописывает новый gzip-member; gzip.open читает файл целиком
+        with gzip.open(self._path, "at", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+        cassette_stats["recorded"] += 1
+
+    async def _record(self, request: httpx.Request) -> httpx.Response:
+        # Тело ответа пишется в файл как текст — просим API не сжимать его
+        request.headers["Accept-Encoding"] = "identity"
+        started = time.monotonic()
+        response = await self._inner.handle_async_request(request)
+        entry = {
+            "key": request_key(request),
+            "method": request.method,
+            "path": request.url.path,
+            "model": _model(request),
+            "recorded_at": time.time(),
+            "status": response.status_code,
+            "headers": {k: v for k, v in response.headers.items() if k.lower() not in _SKIP_HEADERS},
+            "headers_ms": round((time.monotonic() - started) * 1000, 1),
+        }
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            stream=_RecordingStream(self, response, entry, started),
+            extensions=response.extensions,
+        )
+
+    async def _replay(self, request: httpx.Request) -> httpx.Response:
+        started = time.monotonic()
+        key = request_key(request)
+        entries = self._entries.get(key)
+        if not entries:
+            cassette_stats["misses"] += 1
+            print(f"[cassette] Miss {request.method} {request.url.path} model={_model(request)} key={key}")
+            # 404 не ретраится resilience-слоем: промах виден сразу
+            return httpx.Response(
+                404,
+                json={"error": {"message": f"No recorded response for request {key}", "type": "cassette_miss"}},
+            )
+        index = self._served.get(key, 0)
+        self._served[key] = index + 1
+        entry = entries[min(index, len(entries) - 1)]
+        cassette_stats["replayed"] += 1
+        wait = entry.get("headers_ms", 0) / 1000 * self._scale
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return httpx.Response(
+            entry["status"],
+            headers=entry["headers"],
+            stream=_ReplayStream(entry["chunks"], started, self._scale),
+        )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        if self._mode == "replay":
+            return await self._replay(request)
+        return await self._record(request)
+
+    async def aclose(self) -> None:
+        if self._inner is not None:
+            await self._inner.aclose()
+
+
+def build_transport(limits: httpx.Limits) -> Optional[httpx.AsyncBaseTransport]:
+    """
+    Транспорт для httpx-клиента OpenAI; None — обычный транспорт httpx (LLM_CASSETTE_MODE=off).
+    """
+    mode = settings.LLM_CASSETTE_MODE
+    if mode == "off":
+        return None
+    if mode not in ("record", "replay"):
+        raise ValueError(f"LLM_CASSETTE_MODE must be off, record or replay, got {mode!r}")
+    inner = httpx.AsyncHTTPTransport(limits=limits) if mode == "record" else None
+    return CassetteTransport(mode, settings.LLM_CASSETTE_PATH, settings.LLM_CASSETTE_TIME_SCALE, inner)
@@ -0,0 +1,162 @@
+"""
+Сборка контекста для LLM в пределах бюджета токенов этапа.
+Свежие сообщения идут целиком, пока помещаются в бюджет; всё, что старше, заменяется
+сводкой (summary), которая хранится в диалоге и дополняется инкрементально в фоне.
+Сводка запускается, когда вытесненных сообщений не меньше CONTEXT_SUMMARY_MIN_MESSAGES или
+в них не меньше CONTEXT_SUMMARY_MIN_TOKENS токенов. Пока сводка их не покрывает (ещё строится
+или не удалась), самые свежие из них остаются в контексте сверх бюджета, но не больше
+CONTEXT_OVERFLOW_MAX_TOKENS. Неудачная сводка повторяется с backoff.
+"""
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from app.agent.routing import complete_task
+from app.agent.tokens import message_tokens
+from app.config import settings
+from app.db import repository
+
+SUMMARY_SYSTEM_PROMPT = """You maintain a running summary of a conversation between an assistant and a user.
+Update the existing summary with the new messages. Keep every fact the user shared: names, business details,
+questions the assistant asked and the user's answers (keep answers close to verbatim), decisions and open questions.
+Write in the language of the conversation. Be concise, no more than 250 words. Output only the summary."""
+
+# Сколько записей backoff держать в памяти до чистки истёкших
+SUMMARY_BACKOFF_MAX_SIZE = 10000
+
+_summary_tasks: Dict[Tuple[int, str], asyncio.Task] = {}
+# (telegram_id, stage) -> (неудачных попыток подряд, monotonic-время следующей попытки)
+_summary_backoff: Dict[Tuple[int, str], Tuple[int, float]] = {}
+_background: Set[asyncio.Task] = set()
+
+
+def to_llm_messages(history: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """
+    Конвертируем историю из Mongo в формат messages для Chat Completions API.
+    """
+    msgs: List[Dict[str, str]] = []
+    for m in history:
+        role = m.get("role", "user")
+        text = m.get("text", "")
+        if not isinstance(text, str):
+            text = str(text)
+        if role not in ("user", "assistant"):
+            role = "user"
+        msgs.append({"role": role, "content": text})
+    return msgs
+
+
+def token_budget(stage: str) -> int:
+    return settings.CONTEXT_TOKEN_BUDGETS.get(stage, settings.CONTEXT_DEFAULT_TOKEN_BUDGET)
+
+
+async def build_context(
+    telegram_id: int,
+    stage: str,
+    prefix: List[Dict[str, str]],
+    history: List[Dict[str, Any]],
+) -> List[Dict[str, str]]:
+    """
+    prefix (system-сообщения) + сводка старых ходов + последние сообщения этапа stage,
+    сколько помещается в бюджет токенов этапа (плюс ещё не покрытые сводкой, до
+    CONTEXT_OVERFLOW_MAX_TOKENS). Сообщения сверх бюджета уходят в фоновую сводку.
+    """
+    budget = token_budget(stage)
+    history = [m for m in history if m.get("stage") == stage]
+    summary = await repository.get_context_summary(telegram_id, stage)
+    if summary:
+        history = [m for m in history if m.get("ts") and m["ts"] > summary["upto_ts"]]
+
+    used = sum(message_tokens(m) for m in prefix)
+    summary_msgs: List[Dict[str, str]] = []
+    if summary:
+        summary_msgs = [{"role": "system", "content": f"Summary of the earlier part of this conversation:\n{summary['text']}"}]
+        used += message_tokens(summary_msgs[0])
+
+    converted = to_llm_messages(history)
+    window: List[Dict[str, str]] = []
+    for msg in reversed(converted):
+        cost = message_tokens(msg)
+        # Последнее сообщение пользователя берём всегда, даже если бюджет превышен
+        if window and used + cost > budget:
+            break
+        window.append(msg)
+        used += cost
+    window.reverse()
+
+    overflow = history[:len(history) - len(window)]
+    if not overflow:
+        return prefix + summary_msgs + window
+    overflow_msgs = converted[:len(overflow)]
+    overflow_tokens = sum(message_tokens(m) for m in overflow_msgs)
+    if len(overflow) >= settings.CONTEXT_SUMMARY_MIN_MESSAGES or overflow_tokens >= settings.CONTEXT_SUMMARY_MIN_TOKENS:
+        _schedule_summary_update(telegram_id, stage, summary, overflow)
+    # Вытесненные сообщения ещё не покрыты сводкой: свежие из них остаются в контексте
+    # сверх бюджета, в пределах CONTEXT_OVERFLOW_MAX_TOKENS
+    kept: List[Dict[str, str]] = []
+    extra = 0
+    for msg in reversed(overflow_msgs):
+        extra += message_tokens(msg)
+        if extra > settings.CONTEXT_OVERFLOW_MAX_TOKENS:
+            break
+        kept.append(msg)
+    kept.reverse()
+    return prefix + summary_msgs + kept + window
+
+
+def _schedule_summary_update(
+    telegram_id: int,
+    stage: str,
+    summary: Optional[Dict[str, Any]],
+    overflow: List[Dict[str, Any]],
+) -> None:
+    key = (telegram_id, stage)
+    task = _summary_tasks.get(key)
+    if task and not task.done():
+        return
+    failures, retry_at = _summary_backoff.get(key, (0, 0.0))
+    if failures and time.monotonic() < retry_at:
+        return
+    task = asyncio.create_task(_update_summary(telegram_id, stage, summary, overflow))
+    _summary_tasks[key] = task
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    task.add_done_callback(lambda _t: _summary_tasks.pop(key, None))
+
+
+async def _update_summary(
+    telegram_id: int,
+    stage: str,
+    summary: Optional[Dict[str, Any]],
+    overflow: List[Dict[str, Any]],
+) -> None:
+    transcript = "\n".join(f"{m.get('role', 'user')}: {m.get('text', '')}" for m in overflow)
+    previous = summary["text"] if summary else "(empty)"
+    try:
+        msg = await complete_task(
+            "context_summary",
+            [
+                {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                {"role": "user", "content": f"Existing summary:\n{previous}\n\nNew messages:\n{transcript}"},
+            ],
+        )
+        text = (msg.content or "").strip()
+        if not text:
+            raise ValueError("empty summary")
+        await repository.set_context_summary(telegram_id, stage, text, overflow[-1]["ts"])
+        _summary_backoff.pop((telegram_id, stage), None)
+        print(f"[context] Summary updated for user_id={telegram_id}, stage={stage}: +{len(overflow)} messages")
+    except Exception as e:
+        # Следующий ход этапа повторит сводку, но не раньше backoff (маршрут context_summary
+        # первым отбрасывается при перегрузке — не добавляем ему нагрузки)
+        failures = _summary_backoff.get((telegram_id, stage), (0, 0.0))[0] + 1
+        delay = min(settings.CONTEXT_SUMMARY_RETRY_MAX_DELAY, settings.CONTEXT_SUMMARY_RETRY_DELAY * 2 ** (failures - 1))
+        _summary_backoff[(telegram_id, stage)] = (failures, time.monotonic() + delay)
+        if len(_summary_backoff) > SUMMARY_BACKOFF_MAX_SIZE:
+            now = time.monotonic()
+            for k in [k for k, (_, at) in _summary_backoff.items() if at < now]:
+                del _summary_backoff[k]
+        print(
+            f"[context] Summary update failed for user_id={telegram_id}, stage={stage} "
+            f"(attempt {failures}, retry in {delay:.0f}s): {type(e).__name__}: {e}"
+        )
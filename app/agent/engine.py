@@ -0,0 +1,204 @@
+"""
+Движок этапов диалога. Этапы, их агенты, обработчики функций и допустимые переходы
+описаны декларативно в STAGES; run_turn крутит один цикл диспетчеризации на ход пользователя
+с ограничением на число последовательных вызовов LLM (hops).
+"""
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.agent.chain import (
+    StepResult,
+    generate_greet_and_lang_agent_reply,
+    generate_profile_agent_reply,
+    generate_survey_agent_reply,
+    generate_summary_agent_reply,
+    handle_update_user_language,
+    handle_update_profile_summary,
+    handle_update_preffered_name,
+    handle_finish_survey,
+    handle_update_user_email_and_final_message,
+)
+from app.agent.llm import TextCallback
+from app.agent.response_cache import response_cache
+from app.agent.survey_extraction import schedule_extraction
+from app.config import settings
+from app.db import repository
+
+
+@dataclass
+class StageSpec:
+    name: str
+    # Агент этапа (один вызов LLM); None — этап обслуживается без LLM (например, final)
+    agent: Optional[Callable[..., Awaitable[Any]]]
+    tools: Dict[str, Callable[[Dict[str, Any]], Awaitable[StepResult]]] = field(default_factory=dict)
+    # Этап, на который переводит инструмент (None — остаёмся); проверяется до вызова обработчика
+    tool_stages: Dict[str, Optional[str]] = field(default_factory=dict)
+    transitions: Tuple[str, ...] = ()
+    # Ответ, если модель вернула пустой текст
+    default_reply: str = "Что бы вы хотели обсудить?"
+    # Хук на каждое сообщение пользователя в этом этапе: (telegram_id, история этапа);
+    # тяжёлую работу запускает в фоне
+    on_user_turn: Optional[Callable[[int, List[Dict[str, Any]]], Awaitable[None]]] = None
+    # Промпт агента (его версия входит в ключ кэша ответов)
+    prompt: Optional[str] = None
+    # Поля пользователя, от которых зависит ответ на типовой ход; None — ответы этапа не кэшируются
+    cache_hints: Optional[Tuple[str, ...]] = None
+
+    @property
+    def cacheable(self) -> bool:
+        return self.cache_hints is not None and self.prompt is not None and self.name in settings.RESPONSE_CACHE_STAGES
+
+
+STAGES: Dict[str, StageSpec] = {
+    "language": StageSpec(
+        name="language",
+        agent=generate_greet_and_lang_agent_reply,
+        tools={"update_user_language": handle_update_user_language},
+        tool_stages={"update_user_language": "profile"},
+        transitions=("profile",),
+        default_reply="What is your name?",
+        prompt="greeting_and_lang",
+        cache_hints=("language_code", "preffered_language"),
+    ),
+    "profile": StageSpec(
+        name="profile",
+        agent=generate_profile_agent_reply,
+        tools={
+            "update_profile_summary": handle_update_profile_summary,
+            "update_preffered_name": handle_update_preffered_name,
+        },
+        tool_stages={"update_profile_summary": "survey", "update_preffered_name": None},
+        transitions=("survey",),
+        default_reply="Could you tell me more about your business?",
+        prompt="profile",
+        cache_hints=("preffered_language",),
+    ),
+    "survey": StageSpec(
+        name="survey",
+        agent=generate_survey_agent_reply,
+        tools={"finish_survey": handle_finish_survey},
+        tool_stages={"finish_survey": "summary"},
+        on_user_turn=schedule_extraction,
+        transitions=("summary",),
+        default_reply="Let me ask you about your business needs...",
+        prompt="survey",
+        # Открывающий вопрос опроса персонализирован по профилю — чужому пользователю он не подходит
+        cache_hints=("preffered_language", "profile_summary"),
+    ),
+    "summary": StageSpec(
+        name="summary",
+        agent=generate_summary_agent_reply,
+        tools={"update_user_email_and_final_message": handle_update_user_email_and_final_message},
+        tool_stages={"update_user_email_and_final_message": "final"},
+        transitions=("final",),
+        default_reply="Please provide your email to get early access.",
+        prompt="summary",
+    ),
+    "final": StageSpec(name="final", agent=None),
+}
+
+# Счётчики: ходы, hops и время по каждому переходу "stage:tool"
+engine_stats: Dict[str, Any] = {
+    "turns": 0,
+    "llm_hops": 0,
+    "max_hops_in_turn": 0,
+    "hop_limit_reached": 0,
+    "rejected_transitions": 0,
+    "transitions": {},
+}
+
+
+def _record_step(key: str, elapsed: float) -> None:
+    step = engine_stats["transitions"].setdefault(key, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+    ms = elapsed * 1000
+    step["count"] += 1
+    step["total_ms"] = round(step["total_ms"] + ms, 1)
+    step["max_ms"] = round(max(step["max_ms"], ms), 1)
+
+
+def _parse_arguments(fn) -> Dict[str, Any]:
+    try:
+        return json.loads(fn.arguments or "{}")
+    except json.JSONDecodeError as e:
+        print(f"[engine] JSONDecodeError in {fn.name}: {e}")
+        print(f"[engine] Offending JSON (first 1000 chars): {(fn.arguments or '')[:1000]}")
+        raise
+
+
+async def run_turn(
+    stage: str,
+    user_doc: Dict[str, Any],
+    conversation_doc: Dict[str, Any],
+    on_text: Optional[TextCallback] = None,
+) -> str:
+    """
+    Обрабатывает ход пользователя начиная с этапа stage и возвращает текст ответа.
+    """
+    telegram_id = user_doc["telegram_id"]
+    hops = 0
+    path = []
+    engine_stats["turns"] += 1
+    spec = STAGES.get(stage)
+    if spec and spec.on_user_turn:
+        await spec.on_user_turn(telegram_id, conversation_doc.get("messages", []))
+    try:
+        while True:
+            spec = STAGES.get(stage)
+            if spec is None or spec.agent is None:
+                # Этап без агента: ответ формирует вызывающий код / fast paths
+                return (spec.default_reply if spec else "Что бы вы хотели обсудить?")
+            if hops >= settings.STAGE_MAX_LLM_HOPS:
+                engine_stats["hop_limit_reached"] += 1
+                print(f"[engine] Hop limit reached for user_id={telegram_id} at stage={stage}")
+                return spec.default_reply
+
+            started = time.perf_counter()
+            history = conversation_doc.get("messages", [])
+            if spec.cacheable:
+                cached = await response_cache.lookup(stage, spec.prompt, spec.cache_hints, user_doc, history)
+                if cached is not None:
+                    _record_step(f"{stage}:cached", time.perf_counter() - started)
+                    path.append(f"{stage}:cached")
+                    return cached
+            msg = await spec.agent(user_doc, conversation_doc, on_text=on_text)
+            hops += 1
+            fn = getattr(msg, "function_call", None)
+            if not fn:
+                _record_step(f"{stage}:reply", time.perf_counter() - started)
+                path.append(stage)
+                if spec.cacheable and msg.content:
+                    response_cache.store(stage, spec.prompt, spec.cache_hints, user_doc, history, msg.content.strip())
+                return (msg.content or spec.default_reply).strip()
+
+            print(f"[engine] {stage}: AI requested function {fn.name}, arguments: {fn.arguments}")
+            handler = spec.tools.get(fn.name)
+            if handler is None:
+                return f"[Unknown function call: {fn.name}]"
+            next_stage = spec.tool_stages.get(fn.name)
+            if next_stage and next_stage not in spec.transitions:
+                # Переход проверяется до обработчика: отклонённый вызов не оставляет побочных записей
+                engine_stats["rejected_transitions"] += 1
+                print(f"[engine] Transition {stage} -> {next_stage} is not allowed, {fn.name} skipped")
+                return spec.default_reply
+            args = _parse_arguments(fn)
+            args["telegram_id"] = telegram_id  # всегда подставляем реальный id
+            result = await handler(args)
+            _record_step(f"{stage}:{fn.name}", time.perf_counter() - started)
+            path.append(f"{stage}:{fn.name}")
+
+            if result.next_stage != next_stage:
+                print(f"[engine] {fn.name} returned next_stage={result.next_stage}, declared {next_stage}")
+            if next_stage:
+                await repository.set_stage(telegram_id, next_stage)
+                stage = next_stage
+            if result.reply is not None:
+                return result.reply
+            # Перечитываем состояние (из кэша) для следующего hop
+            user_doc = await repository.get_user(telegram_id) or user_doc
+            conversation_doc = await repository.get_conversation(telegram_id)
+    finally:
+        engine_stats["llm_hops"] += hops
+        engine_stats["max_hops_in_turn"] = max(engine_stats["max_hops_in_turn"], hops)
+        print(f"[engine] user_id={telegram_id} hops={hops} path={' -> '.join(path) or '-'}")
@@ -0,0 +1,193 @@
+"""
+Детерминированные правила, которые закрывают ход без вызова LLM:
+- final: повтор сохранённого финального сообщения;
+- summary: email в сообщении → сохраняем его и отвечаем шаблонным финальным сообщением;
+- language: пользователь просто назвал язык (или его код) или ответил «да» на предложение агента
+  продолжить на языке из language_code Telegram → сохраняем и передаём ход profile-агенту;
+- /start посреди диалога — повторяем последний вопрос ассистента текущего этапа.
+"""
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Set
+
+from app.agent.tools.db_ops import update_user_email_and_final_message, update_user_language
+from app.db import repository
+
+# Канонические названия языков (как их сохраняет update_user_language) и их варианты
+LANGUAGES: Dict[str, Dict[str, Any]] = {
+    "English": {
+        "aliases": ["english", "en", "eng", "английский", "англ", "אנגלית", "inglés", "ingles"],
+        "final": "Thank you for participating in our survey. Your opinion is valuable to us. You are in the queue for the service, we will contact you.",
+    },
+    "Русский": {
+        "aliases": ["русский", "russian", "ru", "рус", "по-русски", "по русски", "на русском", "רוסית"],
+        "final": "Спасибо за участие в нашем опросе. Ваше мнение очень важно для нас. Вы в очереди на подключение к сервису, мы с вами свяжемся.",
+    },
+    "עברית": {
+        "aliases": ["עברית", "hebrew", "he", "iw", "иврит", "на иврите"],
+        "final": "תודה שהשתתפת בסקר שלנו. דעתך חשובה לנו. אתה בתור לשירות, ניצור איתך קשר.",
+    },
+    "Українська": {
+        "aliases": ["українська", "украинский", "ukrainian", "uk", "ua", "українською"],
+        "final": "Дякуємо за участь у нашому опитуванні. Ваша думка дуже важлива для нас. Ви в черзі на підключення до сервісу, ми з вами зв'яжемося.",
+    },
+    "Español": {
+        "aliases": ["español", "espanol", "spanish", "es", "испанский"],
+        "final": "Gracias por participar en nuestra encuesta. Tu opinión es valiosa para nosotros. Estás en la cola para el servicio, nos pondremos en contacto contigo.",
+    },
+    "Deutsch": {
+        "aliases": ["deutsch", "german", "de", "немецкий"],
+        "final": "Vielen Dank für die Teilnahme an unserer Umfrage. Ihre Meinung ist uns wichtig. Sie stehen auf der Warteliste für den Service, wir melden uns bei Ihnen.",
+    },
+    "Français": {
+        "aliases": ["français", "francais", "french", "fr", "французский"],
+        "final": "Merci d'avoir participé à notre enquête. Votre avis compte pour nous. Vous êtes dans la file d'attente pour le service, nous vous contacterons.",
+    },
+}
+DEFAULT_LANGUAGE = "English"
+DEFAULT_FINAL_MESSAGE = "You are in the queue for the service, we will contact you."
+
+_ALIASES = {alias: name for name, spec in LANGUAGES.items() for alias in [name.lower(), *spec["aliases"]]}
+_EMAIL_RE = re.compile(r"[A-Za-z0-9._%+\-]+@[A-Za-z0-9\-]+(?:\.[A-Za-z0-9\-]+)*\.[A-Za-z]{2,}")
+_TRIM_RE = re.compile(r"^[\s\W_]+|[\s\W_]+$")
+# Короткое согласие на вопрос агента языка («Продолжим на русском?»)
+_AFFIRMATIVES = {
+    "yes", "yeah", "yep", "ok", "okay", "sure", "да", "ага", "конечно", "давай", "давайте", "так", "כן",
+    "sí", "si", "claro", "ja", "oui",
+}
+
+# Сколько ходов закрыло каждое правило (и сколько вызовов LLM сэкономлено)
+rule_stats: Dict[str, int] = {}
+
+
+@dataclass
+class FastPathResult:
+    rule: str
+    # Готовый ответ пользователю; None — ход продолжает агент этапа next_stage
+    reply: Optional[str] = None
+    next_stage: Optional[str] = None
+    llm_calls_saved: int = 1
+
+
+def resolve_language(text: Optional[str]) -> Optional[str]:
+    if not text:
+        return None
+    return _ALIASES.get(_TRIM_RE.sub("", text).lower())
+
+
+def resolve_language_code(code: Optional[str]) -> Optional[str]:
+    # language_code из Telegram — IETF-тег ("ru", "en-US", "pt-br")
+    if not code:
+        return None
+    return _ALIASES.get(code.split("-")[0].lower())
+
+
+def _is_affirmative(text: str) -> bool:
+    return _TRIM_RE.sub("", text or "").lower() in _AFFIRMATIVES
+
+
+def _mentioned_languages(text: str) -> Set[str]:
+    # Короткие коды ("en", "de") в тексте не ищем: слишком часто совпадают с частью слова
+    lowered = (text or "").lower()
+    return {name for alias, name in _ALIASES.items() if len(alias) >= 4 and alias in lowered}
+
+
+def extract_email(text: str) -> Optional[str]:
+    for candidate in _EMAIL_RE.findall(text or ""):
+        local, _, domain = candidate.rpartition("@")
+        if len(candidate) > 254 or len(local) > 64:
+            continue
+        if ".." in candidate or local.startswith(".") or local.endswith("."):
+            continue
+        if any(label.startswith("-") or label.endswith("-") for label in domain.split(".")):
+            continue
+        return candidate
+    return None
+
+
+def _localized(user_doc: Dict[str, Any], key: str) -> str:
+    language = resolve_language(user_doc.get("preffered_language")) or DEFAULT_LANGUAGE
+    return LANGUAGES[language][key]
+
+
+async def _final_rule(user_doc: Dict[str, Any], conversation_doc: Dict[str, Any], text: str) -> Optional[FastPathResult]:
+    # Always reply with the saved final_message in user's preferred language
+    # (этот этап и раньше обходился без LLM, поэтому вызовы не считаем сэкономленными)
+    return FastPathResult(
+        "final_message",
+        reply=user_doc.get("final_message") or DEFAULT_FINAL_MESSAGE,
+        llm_calls_saved=0,
+    )
+
+
+async def _email_rule(user_doc: Dict[str, Any], conversation_doc: Dict[str, Any], text: str) -> Optional[FastPathResult]:
+    email = extract_email(text)
+    if not email:
+        return None
+    telegram_id = user_doc["telegram_id"]
+    final_message = _localized(user_doc, "final")
+    await update_user_email_and_final_message(telegram_id=telegram_id, email=email, final_message=final_message)
+    await repository.set_stage(telegram_id, "final")
+    return FastPathResult("summary_email", reply=final_message)
+
+
+async def _language_rule(user_doc: Dict[str, Any], conversation_doc: Dict[str, Any], text: str) -> Optional[FastPathResult]:
+    rule = "language_selection"
+    language = resolve_language(text)
+    if not language and _is_affirmative(text):
+        # «Да» на вопрос агента, который предложил ровно язык из language_code Telegram
+        # (агент видит его в подсказках); предложен другой язык — решает агент
+        telegram_language = resolve_language_code(user_doc.get("language_code"))
+        question = next(
+            (m.get("text") for m in reversed(conversation_doc.get("messages", [])) if m.get("role") == "assistant"),
+            None,
+        )
+        if telegram_language and question and _mentioned_languages(question) == {telegram_language}:
+            language = telegram_language
+            rule = "language_from_telegram"
+    if not language:
+        return None
+    telegram_id = user_doc["telegram_id"]
+    await update_user_language(telegram_id=telegram_id, language_code=language)
+    await repository.set_stage(telegram_id, "profile")
+    return FastPathResult(rule, next_stage="profile")
+
+
+async def _start_command(user_doc: Dict[str, Any], conversation_doc: Dict[str, Any], text: str) -> Optional[FastPathResult]:
+    if text.strip() != "/start":
+        return None
+    # Повторяем последний вопрос ассистента, не начиная этап заново
+    for m in reversed(conversation_doc.get("messages", [])):
+        if m.get("role") == "assistant" and m.get("text"):
+            return FastPathResult("start_command", reply=m["text"])
+    return None
+
+
+STAGE_RULES = {
+    "language": [_language_rule],
+    "profile": [_start_command],
+    "survey": [_start_command],
+    "summary": [_start_command, _email_rule],
+    "final": [_final_rule],
+}
+
+
+async def run_fast_paths(
+    stage: str,
+    user_doc: Dict[str, Any],
+    conversation_doc: Dict[str, Any],
+    text: str,
+) -> Optional[FastPathResult]:
+    """
+    Пробует закрыть ход правилами этапа. Возвращает результат первого сработавшего правила или None.
+    """
+    if not user_doc.get("telegram_id"):
+        return None
+    for rule in STAGE_RULES.get(stage, []):
+        result = await rule(user_doc, conversation_doc, text)
+        if result is not None:
+            rule_stats[result.rule] = rule_stats.get(result.rule, 0) + 1
+            rule_stats["llm_calls_saved"] = rule_stats.get("llm_calls_saved", 0) + result.llm_calls_saved
+            print(f"[fast_path] user_id={user_doc['telegram_id']} stage={stage} rule={result.rule}")
+            return result
+    return None
@@ -0,0 +1,140 @@
+import asyncio
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+from openai import AsyncOpenAI
+
+from app.agent.cassette import build_transport, cassette_stats
+from app.config import settings
+
+# Колбэк стриминга: получает весь накопленный на данный момент текст ответа
+TextCallback = Callable[[str], Awaitable[None]]
+
+# Общий HTTP-пул для всех stage-агентов: keep-alive соединения к OpenAI
+# переиспользуются, а количество одновременных запросов ограничено лимитами пула.
+_limits = httpx.Limits(
+    max_connections=settings.LLM_MAX_CONNECTIONS,
+    max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=settings.LLM_KEEPALIVE_EXPIRY,
+)
+# LLM_CASSETTE_MODE=record|replay подменяет транспорт записью/воспроизведением (app/agent/cassette.py)
+_http_client = httpx.AsyncClient(
+    limits=_limits,
+    timeout=httpx.Timeout(settings.LLM_TIMEOUT, connect=settings.LLM_CONNECT_TIMEOUT),
+    transport=build_transport(_limits),
+)
+
+# Ретраи делает app/agent/resilience.py (backoff, retry-after, fallback), поэтому у клиента они выключены
+openai_client = AsyncOpenAI(
+    api_key=settings.OPENAI_API_KEY,
+    base_url=settings.OPENAI_BASE_URL,
+    http_client=_http_client,
+    max_retries=0,
+)
+
+
+# Счётчики токенов из resp.usage; cached_prompt_tokens — сколько токенов промпта
+# OpenAI отдал из prefix-кэша (prompt_tokens_details.cached_tokens)
+usage_stats: Dict[str, int] = {
+    "calls": 0,
+    "prompt_tokens": 0,
+    "cached_prompt_tokens": 0,
+    "completion_tokens": 0,
+}
+
+
+def _record_usage(usage: Any) -> None:
+    if usage is None:
+        return
+    usage_stats["calls"] += 1
+    usage_stats["prompt_tokens"] += usage.prompt_tokens or 0
+    usage_stats["completion_tokens"] += usage.completion_tokens or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    usage_stats["cached_prompt_tokens"] += (getattr(details, "cached_tokens", None) or 0) if details else 0
+
+
+def llm_stats() -> Dict[str, Any]:
+    prompt_tokens = usage_stats["prompt_tokens"]
+    return {
+        **usage_stats,
+        "cached_prompt_ratio": round(usage_stats["cached_prompt_tokens"] / prompt_tokens, 4) if prompt_tokens else 0.0,
+        "cassette": {"mode": settings.LLM_CASSETTE_MODE, **cassette_stats},
+    }
+
+
+async def create_chat_completion(*, timeout: Optional[float] = None, **kwargs: Any):
+    """
+    Неблокирующий вызов chat.completions.create.
+    timeout — общий дедлайн на вызов (включая ретраи клиента); по истечении запрос отменяется
+    и поднимается asyncio.TimeoutError. Отмена вызывающей корутины также отменяет HTTP-запрос.
+    """
+    deadline = timeout if timeout is not None else settings.LLM_TIMEOUT
+    resp = await asyncio.wait_for(openai_client.chat.completions.create(**kwargs), timeout=deadline)
+    _record_usage(resp.usage)
+    return resp
+
+
+async def _consume_stream(on_text: TextCallback, **kwargs: Any) -> SimpleNamespace:
+    stream = await openai_client.chat.completions.create(
+        stream=True,
+        stream_options={"include_usage": True},
+        **kwargs,
+    )
+    content_parts = []
+    fn_name = ""
+    fn_args = []
+    usage = None
+    finish_reason = None
+    async for chunk in stream:
+        if chunk.usage:
+            usage = chunk.usage
+            _record_usage(usage)
+        if not chunk.choices:
+            continue
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+        delta = chunk.choices[0].delta
+        if delta.function_call:
+            # Модель вызывает функцию — текст пользователю больше не стримим
+            fn_name += delta.function_call.name or ""
+            fn_args.append(delta.function_call.arguments or "")
+            continue
+        if delta.content:
+            content_parts.append(delta.content)
+            if not fn_name:
+                await on_text("".join(content_parts))
+    function_call = SimpleNamespace(name=fn_name, arguments="".join(fn_args)) if fn_name else None
+    return SimpleNamespace(
+        content="".join(content_parts) or None,
+        function_call=function_call,
+        finish_reason=finish_reason,
+        usage=usage,
+    )
+
+
+async def complete_message(
+    on_text: Optional[TextCallback] = None,
+    *,
+    timeout: Optional[float] = None,
+    **kwargs: Any,
+):
+    """
+    Возвращает message первого choice (content / function_call) вместе с finish_reason и usage.
+    Если передан on_text, ответ читается потоком и on_text вызывается с накопленным текстом
+    по мере прихода токенов; function_call собирается из дельт и возвращается как обычно.
+    """
+    if on_text is None:
+        resp = await create_chat_completion(timeout=timeout, **kwargs)
+        choice = resp.choices[0]
+        return SimpleNamespace(
+            content=choice.message.content,
+            function_call=choice.message.function_call,
+            finish_reason=choice.finish_reason,
+            usage=resp.usage,
+        )
+    deadline = timeout if timeout is not None else settings.LLM_TIMEOUT
+    return await asyncio.wait_for(_consume_stream(on_text, **kwargs), timeout=deadline)
+
+
+async def close_llm_client() -> None:
+    await openai_client.close()
@@ -0,0 +1,220 @@
+"""
+Общий для процесса планировщик вызовов OpenAI с учётом квот RPM/TPM по моделям.
+- квоты моделей (LLM_RATE_LIMITS) — token bucket'ы на запросы и токены; токены запроса
+  оцениваются заранее (промпт + max_tokens) и уточняются по фактическому usage;
+- если квоты не хватает, запрос ждёт в очереди с приоритетом: чем меньше число, тем раньше
+  (пользователи в середине опроса обслуживаются раньше новых, см. LLM_ROUTE_PRIORITIES);
+- запрос отбрасывается (LLMOverloaded), если очередь переполнена или ожидание дольше LLM_RATE_LIMIT_MAX_WAIT;
+- LLM_RATE_LIMIT_BACKEND=mongo — квоты общие для всех реплик: минутные окна-счётчики
+  в коллекции llm_rate_windows (атомарный условный $inc), порядок приоритетов — внутри процесса.
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.agent.tokens import count_tokens, message_tokens
+from app.config import settings
+from app.db import repository
+
+# Как часто проверять квоту, пока голова очереди ждёт
+MAX_POLL_INTERVAL = 0.5
+
+
+# Фоновые поправки квот в Mongo (держим ссылки, чтобы задачи не собрал GC)
+_background: set = set()
+
+
+class LLMOverloaded(Exception):
+    """Запрос к LLM отброшен планировщиком: квоты исчерпаны и очередь переполнена или ждать слишком долго."""
+
+
+def estimate_tokens(messages: List[Dict[str, Any]], max_tokens: int, functions: Optional[List[Dict[str, Any]]] = None) -> int:
+    """
+    Токены промпта (tiktoken, как при сборке контекста) + max_tokens — так же OpenAI резервирует TPM.
+    """
+    tokens = sum(message_tokens({"content": str(m.get("content") or "")}) for m in messages)
+    if functions:
+        tokens += count_tokens(json.dumps(functions))
+    return tokens + (max_tokens or 0)
+
+
+def _window_key(model: str, window: datetime) -> str:
+    return f"{model}:{window.strftime('%Y%m%d%H%M')}"
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount: float) -> float:
+        self._refill()
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.level -= amount
+
+    def give_back(self, amount: float) -> None:
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class _ModelQueue:
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.heap: List[Tuple[int, int, int, asyncio.Future]] = []
+        self.pump: Optional[asyncio.Task] = None
+
+
+class LLMRateLimiter:
+    def __init__(self, limits: Dict[str, Dict[str, int]], backend: str, max_queue: int, max_wait: float):
+        self._limits = limits
+        self._backend = backend
+        self._max_queue = max_queue
+        self._max_wait = max_wait
+        self._models: Dict[str, _ModelQueue] = {}
+        self._seq = itertools.count()
+        self.granted = 0
+        self.queued = 0
+        self.shed = 0
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+
+    def _queue(self, model: str) -> Optional[_ModelQueue]:
+        state = self._models.get(model)
+        if state is None:
+            limits = self._limits.get(model)
+            if not limits:
+                return None
+            state = self._models[model] = _ModelQueue(limits.get("rpm", 0), limits.get("tpm", 0))
+        return state
+
+    def congested(self, model: str) -> bool:
+        state = self._models.get(model)
+        return bool(state and state.heap)
+
+    async def _try_take(self, model: str, state: _ModelQueue, tokens: int) -> float:
+        """
+        Резервирует квоту под запрос. 0 — разрешено, иначе сколько подождать до следующей попытки.
+        """
+        if self._backend == "mongo":
+            now = datetime.now(timezone.utc)
+            window = now.replace(second=0, microsecond=0)
+            ok = await repository.take_rate_window(
+                _window_key(model, window), state.rpm, state.tpm, tokens, window + timedelta(minutes=2)
+            )
+            if ok:
+                return 0.0
+            return min(MAX_POLL_INTERVAL * 2, (window + timedelta(minutes=1) - now).total_seconds())
+        wait = max(state.requests.time_until(1), state.tokens.time_until(tokens))
+        if wait > 0:
+            return wait
+        state.requests.take(1)
+        state.tokens.take(tokens)
+        return 0.0
+
+    async def acquire(self, model: str, tokens: int, priority: int) -> None:
+        state = self._queue(model)
+        if state is None:
+            return
+        tokens = min(tokens, state.tpm)
+        if not state.heap and await self._try_take(model, state, tokens) == 0:
+            self.granted += 1
+            return
+        if len(state.heap) >= self._max_queue:
+            self.shed += 1
+            raise LLMOverloaded(f"{model}: rate limit queue is full ({len(state.heap)})")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(state.heap, (priority, next(self._seq), tokens, future))
+        self.queued += 1
+        if state.pump is None or state.pump.done():
+            state.pump = asyncio.create_task(self._pump(model, state))
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout=self._max_wait)
+        except asyncio.TimeoutError:
+            self.shed += 1
+            raise LLMOverloaded(f"{model}: waited more than {self._max_wait}s for rate limit quota")
+        finally:
+            waited_ms = (time.monotonic() - started) * 1000
+            self.wait_total_ms = round(self.wait_total_ms + waited_ms, 1)
+            self.wait_max_ms = round(max(self.wait_max_ms, waited_ms), 1)
+        self.granted += 1
+
+    async def _pump(self, model: str, state: _ModelQueue) -> None:
+        while state.heap:
+            entry = heapq.heappop(state.heap)
+            priority, seq, tokens, future = entry
+            if future.done():
+                # Ожидающий ушёл по таймауту или дедлайну
+                continue
+            try:
+                wait = await self._try_take(model, state, tokens)
+            except Exception as e:
+                print(f"[rate_limiter] {model}: quota check failed: {type(e).__name__}: {e}")
+                wait = MAX_POLL_INTERVAL
+            if wait > 0:
+                # Возвращаем в очередь с тем же (priority, seq) — порядок не меняется
+                heapq.heappush(state.heap, entry)
+                await asyncio.sleep(min(wait, MAX_POLL_INTERVAL))
+                continue
+            if future.done():
+                self.settle(model, tokens, 0)
+            else:
+                future.set_result(None)
+
+    def settle(self, model: str, estimated: int, actual: int) -> None:
+        """
+        Поправка квоты токенов по фактическому usage (actual=0 — запрос не отправлялся).
+        """
+        state = self._models.get(model)
+        if state is None or estimated == actual:
+            return
+        if self._backend == "mongo":
+            key = _window_key(model, datetime.now(timezone.utc).replace(second=0, microsecond=0))
+            task = asyncio.create_task(repository.adjust_rate_window(key, actual - estimated))
+            _background.add(task)
+            task.add_done_callback(_background.discard)
+            return
+        if actual < estimated:
+            state.tokens.give_back(estimated - actual)
+        else:
+            state.tokens.take(actual - estimated)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self._backend,
+            "granted": self.granted,
+            "queued": self.queued,
+            "shed": self.shed,
+            "wait_total_ms": self.wait_total_ms,
+            "wait_max_ms": self.wait_max_ms,
+            "avg_wait_ms": round(self.wait_total_ms / self.queued, 1) if self.queued else 0.0,
+            "queue_depth": {model: len(state.heap) for model, state in self._models.items()},
+        }
+
+
+rate_limiter = LLMRateLimiter(
+    limits=settings.LLM_RATE_LIMITS,
+    backend=settings.LLM_RATE_LIMIT_BACKEND,
+    max_queue=settings.LLM_RATE_LIMIT_MAX_QUEUE,
+    max_wait=settings.LLM_RATE_LIMIT_MAX_WAIT,
+)
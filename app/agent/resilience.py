@@ -0,0 +1,254 @@
+"""
+Устойчивый вызов LLM для маршрутов (см. app/agent/routing.py):
+- общий дедлайн на маршрут (LLM_STAGE_DEADLINES), по истечении — asyncio.TimeoutError;
+- hedging: если ответ не начал приходить дольше p95 задержки модели, параллельно уходит
+  дублирующий запрос, берётся первый ответ, второй отменяется;
+- повторы с jittered exponential backoff, с учётом заголовков retry-after / x-ratelimit-reset-*;
+- fallback на запасную модель (LLM_FALLBACK_MODELS), если основная не ответила за свою долю дедлайна
+  или планировщик квот (app/agent/rate_limiter.py) отбросил запрос.
+Каждая попытка (в том числе hedged) сначала получает квоту RPM/TPM у планировщика.
+Ретраи клиента openai отключены (max_retries=0 в app/agent/llm.py), всё делает эта обёртка.
+"""
+import asyncio
+import random
+import re
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+import openai
+
+from app.agent.llm import TextCallback, complete_message
+from app.agent.rate_limiter import LLMOverloaded, estimate_tokens, rate_limiter
+from app.config import settings
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,  # включая APITimeoutError
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+resilience_stats: Dict[str, int] = {
+    "calls": 0,
+    "attempts": 0,
+    "retries": 0,
+    "rate_limited": 0,
+    "timeouts": 0,
+    "hedges": 0,
+    "hedge_wins": 0,
+    "fallbacks": 0,
+    "failures": 0,
+}
+
+# Скользящее окно задержек (до первого токена при стриминге) по модели и режиму
+_latencies: Dict[str, Deque[float]] = {}
+
+
+def _latency_key(model: str, streaming: bool) -> str:
+    return f"{model}:{'stream' if streaming else 'full'}"
+
+
+def _record_latency(key: str, seconds: float) -> None:
+    window = _latencies.setdefault(key, deque(maxlen=settings.LLM_HEDGE_WINDOW))
+    window.append(seconds)
+
+
+def hedge_delay(key: str) -> float:
+    window = _latencies.get(key)
+    if not window or len(window) < settings.LLM_HEDGE_MIN_SAMPLES:
+        return settings.LLM_HEDGE_INITIAL_DELAY
+    ordered = sorted(window)
+    p95 = ordered[int(0.95 * (len(ordered) - 1))]
+    return max(settings.LLM_HEDGE_MIN_DELAY, p95)
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    # Формат OpenAI: "20ms", "1s", "6m0s", "1h2m3.5s"
+    parts = _DURATION_RE.findall(value or "")
+    if not parts:
+        return None
+    return sum(float(n) * _DURATION_UNITS[unit] for n, unit in parts)
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """
+    Сколько ждать перед повтором по заголовкам ответа (None — заголовков нет).
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    resets = [
+        _parse_duration(headers.get(name, ""))
+        for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+    ]
+    resets = [r for r in resets if r is not None]
+    return max(resets) if resets else None
+
+
+def backoff_delay(attempt: int, error: BaseException) -> float:
+    # Full jitter, но не меньше, чем просит сервер
+    delay = random.uniform(0, min(settings.LLM_RETRY_MAX_DELAY, settings.LLM_RETRY_BASE_DELAY * 2 ** attempt))
+    server_delay = retry_after(error)
+    if server_delay is not None:
+        delay = max(delay, server_delay)
+    return delay
+
+
+async def _attempt(model: str, on_text: Optional[TextCallback], priority: int, timeout: float, **kwargs: Any):
+    estimated = estimate_tokens(kwargs.get("messages", []), kwargs.get("max_tokens", 0), kwargs.get("functions"))
+    started = time.monotonic()
+    await rate_limiter.acquire(model, estimated, priority)
+    # При ошибке квоту не возвращаем: запрос мог дойти до OpenAI и быть учтён в его лимитах
+    msg = await complete_message(on_text, timeout=timeout - (time.monotonic() - started), model=model, **kwargs)
+    usage = getattr(msg, "usage", None)
+    rate_limiter.settle(model, estimated, (usage.total_tokens or 0) if usage else estimated)
+    return msg
+
+
+async def _hedged(model: str, on_text: Optional[TextCallback], hedge: bool, priority: int, timeout: float, **kwargs: Any):
+    """
+    Один логический запрос: основной и, если он медлит дольше p95, дублирующий.
+    При стриминге победителем считается запрос, первым приславший текст.
+    """
+    key = _latency_key(model, on_text is not None)
+    started = time.perf_counter()
+    tasks: List[asyncio.Task] = []
+    state = {"winner": None, "first_token_at": None}
+
+    def _gate(index: int) -> Optional[TextCallback]:
+        if on_text is None:
+            return None
+
+        async def _on_text(text: str) -> None:
+            if state["winner"] is None:
+                state["winner"] = index
+                state["first_token_at"] = time.perf_counter()
+                for i, t in enumerate(tasks):
+                    if i != index:
+                        t.cancel()
+            if state["winner"] == index:
+                await on_text(text)
+
+        return _on_text
+
+    def _launch() -> None:
+        resilience_stats["attempts"] += 1
+        index = len(tasks)
+        tasks.append(asyncio.create_task(
+            _attempt(model, _gate(index), priority, timeout - (time.perf_counter() - started), **kwargs)
+        ))
+
+    _launch()
+    try:
+        # Под нагрузкой на квоты дублирующие запросы только усугубят очередь
+        if hedge and not rate_limiter.congested(model):
+            await asyncio.wait(tasks, timeout=hedge_delay(key))
+            if not tasks[0].done() and state["winner"] is None:
+                resilience_stats["hedges"] += 1
+                print(f"[resilience] {model}: no response after {hedge_delay(key):.2f}s, sending hedged request")
+                _launch()
+        error: Optional[BaseException] = None
+        while True:
+            pending = [t for t in tasks if not t.done()]
+            if pending:
+                await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for index, task in enumerate(tasks):
+                if not task.done() or task.cancelled():
+                    continue
+                if task.exception() is None:
+                    if index > 0:
+                        resilience_stats["hedge_wins"] += 1
+                    first = state["first_token_at"] or time.perf_counter()
+                    _record_latency(key, first - started)
+                    msg = task.result()
+                    msg.model = model
+                    return msg
+                error = task.exception()
+            if all(t.done() for t in tasks):
+                raise error or asyncio.TimeoutError()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def _with_retries(
+    model: str,
+    on_text: Optional[TextCallback],
+    hedge: bool,
+    priority: int,
+    budget_end: float,
+    **kwargs: Any,
+):
+    attempt = 0
+    while True:
+        remaining = budget_end - time.monotonic()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        try:
+            return await asyncio.wait_for(_hedged(model, on_text, hedge, priority, remaining, **kwargs), timeout=remaining)
+        except RETRYABLE_ERRORS as e:
+            if isinstance(e, openai.RateLimitError):
+                resilience_stats["rate_limited"] += 1
+            elif isinstance(e, asyncio.TimeoutError):
+                resilience_stats["timeouts"] += 1
+            if attempt >= settings.LLM_MAX_RETRIES:
+                raise
+            delay = backoff_delay(attempt, e)
+            if time.monotonic() + delay >= budget_end:
+                raise
+            attempt += 1
+            resilience_stats["retries"] += 1
+            print(f"[resilience] {model}: {type(e).__name__}, retry {attempt} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+
+async def resilient_complete(
+    model: str,
+    deadline: float,
+    on_text: Optional[TextCallback] = None,
+    *,
+    hedge: bool = True,
+    priority: int = 0,
+    **kwargs: Any,
+):
+    """
+    complete_message с дедлайном, hedging, ретраями и fallback на запасную модель.
+    Возвращает message (content / function_call / usage) и model — модель, которая ответила.
+    """
+    resilience_stats["calls"] += 1
+    deadline_at = time.monotonic() + deadline
+    fallback = settings.LLM_FALLBACK_MODELS.get(model)
+    models = [model] + ([fallback] if fallback and fallback != model else [])
+    for i, current in enumerate(models):
+        is_last = i == len(models) - 1
+        now = time.monotonic()
+        # Основной модели — только доля дедлайна, остаток резервируется под fallback
+        budget_end = deadline_at if is_last else now + (deadline_at - now) * settings.LLM_PRIMARY_DEADLINE_SHARE
+        try:
+            return await _with_retries(current, on_text, hedge, priority, budget_end, **kwargs)
+        except RETRYABLE_ERRORS + (LLMOverloaded,) as e:
+            if is_last:
+                resilience_stats["failures"] += 1
+                raise
+            resilience_stats["fallbacks"] += 1
+            print(f"[resilience] {current} failed ({type(e).__name__}), falling back to {models[i + 1]}")
+        except Exception:
+            resilience_stats["failures"] += 1
+            raise
@@ -0,0 +1,227 @@
+"""
+Кэш ответов LLM на типовые ходы (первое «/start» / «hi» на этапе language, открывающий вопрос
+этапа profile и т.п.).
+Ключ — отпечаток (этап, версия промпта, модель маршрута, значимые подсказки о пользователе,
+нормализованная короткая история этапа). Имена пользователя в ответе заменяются плейсхолдерами
+и подставляются обратно при выдаче (шаблонные ответы).
+Хранится в памяти процесса (LRU + TTL) и, при RESPONSE_CACHE_BACKEND=mongo, в коллекции
+llm_response_cache, общей для реплик. При изменении файла промпта записи старой версии удаляются.
+"""
+import asyncio
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence
+
+from app.agent.routing import ROUTES
+from app.agent.tools.prompt_loader import prompt_registry
+from app.config import settings
+from app.db import repository
+
+# Поля пользователя, которые в ответе заменяются плейсхолдерами {{field}}
+TEMPLATE_FIELDS = ("preffered_name", "first_name", "last_name", "username")
+# Короче этого имя не шаблонизируем: слишком велик риск заменить обычное слово
+MIN_TEMPLATE_VALUE_CHARS = 3
+
+_NORMALIZE_RE = re.compile(r"[\W_]+")
+_PLACEHOLDER_RE = re.compile(r"\{\{(\w+)\}\}")
+
+
+def _normalize(text: str) -> str:
+    return _NORMALIZE_RE.sub(" ", str(text or "").lower()).strip()
+
+
+def _now_utc() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class ResponseCache:
+    def __init__(self, max_size: int, ttl: float, backend: str):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._backend = backend
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._background: set = set()
+        self.hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def fingerprint(
+        self,
+        stage: str,
+        prompt: str,
+        hint_fields: Sequence[str],
+        user_doc: Dict[str, Any],
+        history: List[Dict[str, Any]],
+    ) -> Optional[str]:
+        """
+        None — ход не кэшируется (длинная история или длинные сообщения: ответ индивидуален).
+        """
+        history = [m for m in history if m.get("stage", stage) == stage]
+        if len(history) > settings.RESPONSE_CACHE_MAX_HISTORY:
+            return None
+        turns = []
+        for m in history:
+            text = _normalize(m.get("text", ""))
+            if len(text) > settings.RESPONSE_CACHE_MAX_MESSAGE_CHARS:
+                return None
+            turns.append([m.get("role", "user"), text])
+        payload = {
+            "stage": stage,
+            "prompt": prompt,
+            "prompt_version": prompt_registry.version(prompt),
+            "model": ROUTES[stage].model if stage in ROUTES else None,
+            "hints": {field: _normalize(user_doc.get(field) or "") for field in hint_fields},
+            "history": turns,
+        }
+        raw = json.dumps(payload, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _get_local(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry["stored_at"] > self._ttl:
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put_local(self, key: str, entry: Dict[str, Any]) -> None:
+        self._entries[key] = {**entry, "stored_at": time.monotonic()}
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def lookup(
+        self,
+        stage: str,
+        prompt: str,
+        hint_fields: Sequence[str],
+        user_doc: Dict[str, Any],
+        history: List[Dict[str, Any]],
+    ) -> Optional[str]:
+        key = self.fingerprint(stage, prompt, hint_fields, user_doc, history)
+        if key is None:
+            return None
+        entry = self._get_local(key)
+        if entry is None and self._backend == "mongo":
+            try:
+                doc = await repository.get_cached_response(key)
+            except Exception as e:
+                print(f"[response_cache] Mongo lookup failed: {type(e).__name__}: {e}")
+                doc = None
+            if doc:
+                entry = {"text": doc["text"], "prompt": doc["prompt"], "prompt_version": doc["prompt_version"]}
+                self._put_local(key, entry)
+                self.remote_hits += 1
+        reply = _render(entry["text"], user_doc) if entry else None
+        if reply is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        print(f"[response_cache] Hit stage={stage} user_id={user_doc.get('telegram_id')}")
+        return reply
+
+    def store(
+        self,
+        stage: str,
+        prompt: str,
+        hint_fields: Sequence[str],
+        user_doc: Dict[str, Any],
+        history: List[Dict[str, Any]],
+        reply: str,
+    ) -> None:
+        key = self.fingerprint(stage, prompt, hint_fields, user_doc, history)
+        if key is None or not reply or "{{" in reply:
+            return
+        entry = {
+            "text": _templatize(reply, user_doc),
+            "stage": stage,
+            "prompt": prompt,
+            "prompt_version": prompt_registry.version(prompt),
+        }
+        self._put_local(key, entry)
+        self.stores += 1
+        if self._backend == "mongo":
+            expires_at = _now_utc() + timedelta(seconds=self._ttl)
+            self._spawn(repository.put_cached_response(key, entry, expires_at))
+
+    def invalidate_prompt(self, prompt: str, version: str) -> None:
+        stale = [k for k, e in self._entries.items() if e["prompt"] == prompt and e["prompt_version"] != version]
+        for key in stale:
+            del self._entries[key]
+        self.invalidations += len(stale)
+        if stale:
+            print(f"[response_cache] Dropped {len(stale)} entries of prompt {prompt}")
+        if self._backend == "mongo":
+            self._spawn(repository.delete_cached_responses(prompt, version))
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": self._backend,
+            "size": len(self._entries),
+            "max_size": self._max_size,
+            "ttl_s": self._ttl,
+            "hits": self.hits,
+            "remote_hits": self.remote_hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+def _templatize(text: str, user_doc: Dict[str, Any]) -> str:
+    values = [
+        (field, str(user_doc.get(field) or "").strip())
+        for field in TEMPLATE_FIELDS
+    ]
+    # Длинные значения первыми, чтобы «Alexander» не превратился в «{{first_name}}der»
+    for field, value in sorted(values, key=lambda fv: len(fv[1]), reverse=True):
+        if len(value) < MIN_TEMPLATE_VALUE_CHARS:
+            continue
+        text = re.sub(rf"(?<!\w){re.escape(value)}(?!\w)", "{{" + field + "}}", text)
+    return text
+
+
+def _render(text: str, user_doc: Dict[str, Any]) -> Optional[str]:
+    """
+    Подставляет данные пользователя в плейсхолдеры; None — у пользователя нет нужного поля.
+    """
+    missing = False
+
+    def _sub(match: "re.Match") -> str:
+        nonlocal missing
+        value = str(user_doc.get(match.group(1)) or "").strip()
+        if not value:
+            missing = True
+        return value
+
+    rendered = _PLACEHOLDER_RE.sub(_sub, text)
+    return None if missing else rendered
+
+
+response_cache = ResponseCache(
+    max_size=settings.RESPONSE_CACHE_MAX_SIZE,
+    ttl=settings.RESPONSE_CACHE_TTL,
+    backend=settings.RESPONSE_CACHE_BACKEND,
+)
+prompt_registry.add_reload_listener(response_cache.invalidate_prompt)
@@ -0,0 +1,243 @@
+"""
+Маршрутизация вызовов LLM: модель, max_tokens и temperature выбираются по этапу и по ходу.
+- у каждого этапа и фоновой задачи (извлечение ответов, сводка контекста) свой маршрут;
+- короткие реплики пользователя (подтверждения, уточнения) на этапах LLM_LIGHT_STAGES идут
+  на лёгкий маршрут "light";
+- если ответ лёгкой модели выглядит неуверенным (пустой, обрезан по длине, битый function_call),
+  ход повторяется на основном маршруте этапа (эскалация).
+Маршруты переопределяются через settings.LLM_ROUTES, по каждому ведутся счётчики
+задержки, токенов и стоимости. Дедлайны, hedging, ретраи и fallback — в app/agent/resilience.py.
+"""
+import json
+import time
+from dataclasses import dataclass, replace
+from typing import Any, Dict, List, Optional
+
+from app.agent.llm import TextCallback
+from app.agent.resilience import resilient_complete
+from app.config import settings
+from app.metrics import llm_seconds, llm_tokens
+from app.tracing import record_span
+
+
+@dataclass(frozen=True)
+class Route:
+    name: str
+    model: str
+    max_tokens: int
+    temperature: float
+    # Общий дедлайн на вызов (сек), включая ретраи и fallback
+    deadline: float = settings.LLM_TIMEOUT
+    # Дублирующий запрос при задержке дольше p95 (только для ответов пользователю)
+    hedge: bool = True
+    # Маршрут, на который повторяется вызов при неуверенном ответе
+    escalate_to: Optional[str] = None
+    # Приоритет в очереди планировщика квот (меньше — раньше)
+    priority: int = settings.LLM_DEFAULT_PRIORITY
+
+
+def _deadline(name: str) -> float:
+    return settings.LLM_STAGE_DEADLINES.get(name, settings.LLM_TIMEOUT)
+
+
+def _with_priorities(routes: Dict[str, Route]) -> Dict[str, Route]:
+    return {
+        name: replace(route, priority=settings.LLM_ROUTE_PRIORITIES.get(name, route.priority))
+        for name, route in routes.items()
+    }
+
+
+def _default_routes() -> Dict[str, Route]:
+    return {
+        "language": Route("language", "gpt-4o-mini", 220, 0.7, _deadline("language")),
+        "profile": Route("profile", "gpt-4o", 220, 0.7, _deadline("profile")),
+        "survey": Route("survey", "gpt-4o", 1024, 1.0, _deadline("survey")),
+        "summary": Route("summary", "gpt-4o", 1024, 1.0, _deadline("summary")),
+        # escalate_to подставляется при выборе: основной маршрут этапа
+        "light": Route("light", settings.LLM_LIGHT_MODEL, 512, 0.7, _deadline("light")),
+        "survey_extraction": Route(
+            "survey_extraction", settings.SURVEY_EXTRACTION_MODEL, 400, 0, _deadline("survey_extraction"), hedge=False
+        ),
+        "context_summary": Route(
+            "context_summary",
+            settings.CONTEXT_SUMMARY_MODEL,
+            settings.CONTEXT_SUMMARY_MAX_TOKENS,
+            0,
+            _deadline("context_summary"),
+            hedge=False,
+        ),
+    }
+
+
+def _load_routes() -> Dict[str, Route]:
+    routes = _with_priorities(_default_routes())
+    for name, overrides in settings.LLM_ROUTES.items():
+        base = routes.get(name) or Route(name, settings.LLM_LIGHT_MODEL, 512, 0.7, _deadline(name))
+        routes[name] = replace(base, **{k: v for k, v in overrides.items() if k != "name"})
+    return routes
+
+
+ROUTES: Dict[str, Route] = _load_routes()
+
+# Счётчики по маршрутам: вызовы, эскалации, ошибки, задержка, токены, стоимость (USD)
+route_stats: Dict[str, Dict[str, Any]] = {}
+
+
+def _stats_for(route: Route) -> Dict[str, Any]:
+    return route_stats.setdefault(route.name, {
+        "model": route.model,
+        "calls": 0,
+        "escalations": 0,
+        "errors": 0,
+        "total_ms": 0.0,
+        "max_ms": 0.0,
+        "prompt_tokens": 0,
+        "cached_prompt_tokens": 0,
+        "completion_tokens": 0,
+        "cost_usd": 0.0,
+    })
+
+
+def _call_cost(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    prices = settings.LLM_MODEL_PRICES.get(model)
+    if not prices:
+        return 0.0
+    cached_price = prices.get("cached_input", prices.get("input", 0.0))
+    cost = (
+        (prompt_tokens - cached_tokens) * prices.get("input", 0.0)
+        + cached_tokens * cached_price
+        + completion_tokens * prices.get("output", 0.0)
+    )
+    return cost / 1_000_000
+
+
+def _record_call(route: Route, elapsed: float, model: str, usage: Any) -> None:
+    stats = _stats_for(route)
+    ms = elapsed * 1000
+    stats["calls"] += 1
+    stats["total_ms"] = round(stats["total_ms"] + ms, 1)
+    stats["max_ms"] = round(max(stats["max_ms"], ms), 1)
+    if usage is None:
+        return
+    prompt_tokens = usage.prompt_tokens or 0
+    completion_tokens = usage.completion_tokens or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
+    stats["prompt_tokens"] += prompt_tokens
+    stats["cached_prompt_tokens"] += cached_tokens
+    stats["completion_tokens"] += completion_tokens
+    llm_tokens.inc(prompt_tokens - cached_tokens, route=route.name, model=model, kind="prompt_uncached")
+    llm_tokens.inc(cached_tokens, route=route.name, model=model, kind="prompt_cached")
+    llm_tokens.inc(completion_tokens, route=route.name, model=model, kind="completion")
+    stats["cost_usd"] = round(
+        stats["cost_usd"] + _call_cost(model, prompt_tokens, cached_tokens, completion_tokens), 6
+    )
+
+
+def routing_stats() -> Dict[str, Any]:
+    result = {}
+    for name, stats in route_stats.items():
+        calls = stats["calls"]
+        result[name] = {**stats, "avg_ms": round(stats["total_ms"] / calls, 1) if calls else 0.0}
+    return result
+
+
+def _last_user_text(history: List[Dict[str, Any]]) -> Optional[str]:
+    """
+    Текст хода пользователя, на который отвечает агент; None, если последнее сообщение
+    этапа не от пользователя (повторный вызов после tool или переход на новый этап).
+    """
+    if not history or history[-1].get("role") != "user":
+        return None
+    parts = []
+    for m in reversed(history):
+        if m.get("role") != "user":
+            break
+        parts.append(str(m.get("text") or ""))
+    return "\n".join(reversed(parts)).strip()
+
+
+def select_route(stage: str, history: List[Dict[str, Any]]) -> Route:
+    primary = ROUTES[stage]
+    if stage not in settings.LLM_LIGHT_STAGES:
+        return primary
+    text = _last_user_text(history)
+    if text and len(text) <= settings.LLM_LIGHT_TURN_MAX_CHARS and "light" in ROUTES:
+        # Лёгкий маршрут наследует приоритет этапа
+        return replace(ROUTES["light"], escalate_to=primary.name, priority=primary.priority)
+    return primary
+
+
+def _low_confidence(msg: Any, functions: Optional[List[Dict[str, Any]]]) -> Optional[str]:
+    fn = getattr(msg, "function_call", None)
+    if fn:
+        allowed = {f["name"] for f in functions or []}
+        if fn.name not in allowed:
+            return f"unknown function {fn.name}"
+        try:
+            json.loads(fn.arguments or "{}")
+        except json.JSONDecodeError:
+            return f"invalid arguments for {fn.name}"
+        return None
+    if getattr(msg, "finish_reason", None) == "length":
+        return "truncated"
+    if not (msg.content or "").strip():
+        return "empty reply"
+    return None
+
+
+async def _complete(route: Route, on_text: Optional[TextCallback], **kwargs: Any):
+    started = time.perf_counter()
+    try:
+        msg = await resilient_complete(
+            route.model,
+            route.deadline,
+            on_text,
+            hedge=route.hedge,
+            priority=route.priority,
+            max_tokens=route.max_tokens,
+            temperature=route.temperature,
+            **kwargs,
+        )
+    except Exception as e:
+        elapsed = time.perf_counter() - started
+        _stats_for(route)["errors"] += 1
+        llm_seconds.observe(elapsed, route=route.name, model=route.model, outcome="error")
+        record_span(f"llm.{route.name}", elapsed, model=route.model, error=type(e).__name__)
+        raise
+    elapsed = time.perf_counter() - started
+    model = getattr(msg, "model", route.model)
+    _record_call(route, elapsed, model, msg.usage)
+    llm_seconds.observe(elapsed, route=route.name, model=model, outcome="ok")
+    record_span(f"llm.{route.name}", elapsed, model=model)
+    return msg
+
+
+async def complete_for_stage(
+    stage: str,
+    history: List[Dict[str, Any]],
+    messages: List[Dict[str, str]],
+    on_text: Optional[TextCallback] = None,
+    functions: Optional[List[Dict[str, Any]]] = None,
+):
+    """
+    Вызов агента этапа stage по выбранному маршруту, с эскалацией на основной маршрут этапа.
+    """
+    kwargs: Dict[str, Any] = {"messages": messages}
+    if functions:
+        kwargs.update(functions=functions, function_call="auto")
+    route = select_route(stage, history)
+    msg = await _complete(route, on_text, **kwargs)
+    reason = _low_confidence(msg, functions) if route.escalate_to else None
+    if reason:
+        _stats_for(route)["escalations"] += 1
+        print(f"[routing] {stage}: {route.name}/{route.model} -> {route.escalate_to} ({reason})")
+        msg = await _complete(ROUTES[route.escalate_to], on_text, **kwargs)
+    return msg
+
+
+async def complete_task(task: str, messages: List[Dict[str, str]], **kwargs: Any):
+    """
+    Фоновая задача (извлечение, сводка) по маршруту task, без стриминга и эскалации.
+    """
+    return await _complete(ROUTES[task], None, messages=messages, **kwargs)
@@ -0,0 +1,148 @@
+"""
+Инкрементальное извлечение ответов опроса. После каждого хода пользователя на этапе survey
+пара «вопрос ассистента → ответ пользователя» сохраняется в users.survey_pending (в пути хода,
+один update), а фоновая задача (дешёвая модель, вне пути ответа) разбирает её и атомарно
+переносит извлечённые ответы в users.survey.
+- задачи одного пользователя выполняются строго по очереди, чтобы сохранить порядок ответов;
+- ошибка извлечения (LLM, LLMOverloaded, плохой JSON) — повтор с backoff, пара остаётся в
+  survey_pending до успешного разбора;
+- finish_survey (на любом воркере в CLUSTER_MODE) дожидается пар из survey_pending, а
+  оставшиеся без фоновой задачи в этом процессе разбирает заново; повторный разбор одной пары
+  не дублирует ответы (перенос условный по _id пары).
+"""
+import asyncio
+import json
+from typing import Any, Dict, List, Set
+
+from bson import ObjectId
+
+from app.agent.routing import complete_task
+from app.config import settings
+from app.db import repository
+
+EXTRACTION_SYSTEM_PROMPT = """You extract survey answers from a chat.
+You get the assistant's last message (it may contain a survey question with numbered options) and the user's reply.
+Return JSON: {"answers": [{"question": "...", "answer": "..."}]}
+- "question": the survey question as asked, without the list of options.
+- "answer": the user's answer as text, in the user's words; if the user replied with option numbers, replace them with the option texts.
+- If the reply answers several questions, return several items.
+- If the reply is not an answer to a survey question (greeting, agreement to start the survey, a clarification request, off-topic), return {"answers": []}."""
+
+extraction_stats: Dict[str, int] = {
+    "scheduled": 0,
+    "completed": 0,
+    "retries": 0,
+    "failed": 0,
+    "recovered": 0,
+    "answers_saved": 0,
+}
+
+_user_locks: Dict[int, asyncio.Lock] = {}
+_pending: Dict[int, Set[asyncio.Task]] = {}
+# _id пар, которые разбирает задача этого процесса
+_running: Set[ObjectId] = set()
+
+
+def _last_exchange(history: List[Dict[str, Any]]) -> Dict[str, str]:
+    """
+    Последнее сообщение ассистента и все сообщения пользователя после него.
+    """
+    user_parts: List[str] = []
+    question = ""
+    for m in reversed(history):
+        if m.get("role") == "assistant":
+            question = m.get("text", "")
+            break
+        user_parts.append(m.get("text", ""))
+    user_parts.reverse()
+    return {"question": question, "answer": "\n".join(p for p in user_parts if p)}
+
+
+def _spawn(telegram_id: int, exchange: Dict[str, Any]) -> asyncio.Task:
+    task = asyncio.create_task(_extract(telegram_id, exchange))
+    pending = _pending.setdefault(telegram_id, set())
+    pending.add(task)
+    _running.add(exchange["_id"])
+
+    def _done(t: asyncio.Task) -> None:
+        _running.discard(exchange["_id"])
+        pending.discard(t)
+        if not pending:
+            _pending.pop(telegram_id, None)
+            _user_locks.pop(telegram_id, None)
+
+    task.add_done_callback(_done)
+    return task
+
+
+async def schedule_extraction(telegram_id: int, history: List[Dict[str, Any]]) -> None:
+    exchange = _last_exchange(history)
+    if not exchange["question"] or not exchange["answer"]:
+        return
+    # Пара сохраняется до разбора: ни ошибка модели, ни другой воркер её не потеряют
+    exchange = await repository.add_survey_exchange(telegram_id, exchange["question"], exchange["answer"])
+    extraction_stats["scheduled"] += 1
+    _spawn(telegram_id, exchange)
+
+
+async def wait_for_pending(telegram_id: int, timeout: float) -> None:
+    """
+    Дожидается разбора всех пар пользователя из survey_pending (не дольше timeout), чтобы
+    следующий этап увидел полный users.survey. Пары без задачи в этом процессе (их сохранил
+    другой воркер или разбор не удался) разбираются заново.
+    """
+    for exchange in await repository.get_survey_exchanges(telegram_id):
+        if exchange["_id"] not in _running:
+            extraction_stats["recovered"] += 1
+            _spawn(telegram_id, exchange)
+    pending = list(_pending.get(telegram_id, ()))
+    if not pending:
+        return
+    done, not_done = await asyncio.wait(pending, timeout=timeout)
+    if not_done:
+        print(f"[survey_extraction] {len(not_done)} extraction(s) still running for user_id={telegram_id}")
+
+
+async def _extract_answers(exchange: Dict[str, Any]) -> List[Dict[str, str]]:
+    msg = await complete_task(
+        "survey_extraction",
+        [
+            {"role": "system", "content": EXTRACTION_SYSTEM_PROMPT},
+            {
+                "role": "user",
+                "content": f"Assistant message:\n{exchange['question']}\n\nUser reply:\n{exchange['answer']}",
+            },
+        ],
+        response_format={"type": "json_object"},
+    )
+    data = json.loads(msg.content or "{}")
+    answers = []
+    for item in data.get("answers") or []:
+        question = str(item.get("question") or "").strip()
+        answer = str(item.get("answer") or "").strip()
+        if question and answer:
+            answers.append({"question": question, "answer": answer})
+    return answers
+
+
+async def _extract(telegram_id: int, exchange: Dict[str, Any]) -> None:
+    lock = _user_locks.setdefault(telegram_id, asyncio.Lock())
+    async with lock:
+        attempt = 0
+        while True:
+            try:
+                answers = await _extract_answers(exchange)
+                break
+            except Exception as e:
+                attempt += 1
+                if attempt > settings.SURVEY_EXTRACTION_RETRIES:
+                    # Пара остаётся в survey_pending: её разберёт finish_survey
+                    extraction_stats["failed"] += 1
+                    print(f"[survey_extraction] Failed for user_id={telegram_id} after {attempt} attempts: {type(e).__name__}: {e}")
+                    return
+                extraction_stats["retries"] += 1
+                # Повтор под lock пользователя: следующие пары не обгоняют эту
+                await asyncio.sleep(settings.SURVEY_EXTRACTION_RETRY_DELAY * 2 ** (attempt - 1))
+        if await repository.complete_survey_exchange(telegram_id, exchange["_id"], answers):
+            extraction_stats["answers_saved"] += len(answers)
+        extraction_stats["completed"] += 1
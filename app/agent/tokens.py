@@ -0,0 +1,29 @@
+"""
+Подсчёт токенов сообщений Chat Completions (tiktoken, o200k_base) — общий для сборки контекста
+и оценки TPM в планировщике вызовов.
+"""
+from typing import Dict
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Служебные токены на каждое сообщение в формате Chat Completions
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        return len(_encoding.encode(text))
+    # Без tiktoken — грубая оценка, ~4 символа на токен
+    return len(text) // 4 + 1
+
+
+def message_tokens(msg: Dict[str, str]) -> int:
+    return count_tokens(msg.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
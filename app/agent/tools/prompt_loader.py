@@ -1,22 +1,117 @@
+import hashlib
 import os
+import time
+from typing import Callable, Dict, List, Optional
+
+from app.config import settings
+
+PROMPTS_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), "../prompts"))
+
 
 def load_prompt(prompt_path: str) -> str:
     with open(prompt_path, encoding="utf-8") as f:
         return f.read()
 
+
+class PromptRegistry:
+    """
+    Все промпты из prompts/*.md загружаются один раз и перечитываются только при изменении файла
+    (mtime проверяется не чаще reload_interval секунд).
+    """
+
+    def __init__(self, prompts_dir: str, reload_interval: float):
+        self._dir = prompts_dir
+        self._reload_interval = reload_interval
+        self._prompts: Dict[str, Dict] = {}
+        self._last_check = 0.0
+        self._listeners: List[Callable[[str, str], None]] = []
+        self.reloads = 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._dir, f"{name}.md")
+
+    def _load(self, name: str) -> None:
+        path = self._path(name)
+        mtime = os.stat(path).st_mtime
+        text = load_prompt(path)
+        self._prompts[name] = {
+            "text": text,
+            "mtime": mtime,
+            "version": hashlib.sha1(text.encode("utf-8")).hexdigest()[:12],
+        }
+
+    def preload(self) -> None:
+        for filename in sorted(os.listdir(self._dir)):
+            if filename.endswith(".md"):
+                self._load(filename[:-3])
+        self._last_check = time.monotonic()
+        print(f"[prompts] Loaded {len(self._prompts)} prompts: {self.versions()}")
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now - self._last_check < self._reload_interval:
+            return
+        self._last_check = now
+        for name, entry in list(self._prompts.items()):
+            try:
+                mtime = os.stat(self._path(name)).st_mtime
+            except FileNotFoundError:
+                continue
+            if mtime != entry["mtime"]:
+                self._load(name)
+                self.reloads += 1
+                print(f"[prompts] Reloaded {name} (version {self._prompts[name]['version']})")
+                for listener in self._listeners:
+                    listener(name, self._prompts[name]["version"])
+
+    def add_reload_listener(self, listener: Callable[[str, str], None]) -> None:
+        """
+        listener(name, version) вызывается после перечитывания изменённого промпта.
+        """
+        self._listeners.append(listener)
+
+    def get(self, name: str) -> str:
+        self._maybe_reload()
+        if name not in self._prompts:
+            self._load(name)
+        return self._prompts[name]["text"]
+
+    def version(self, name: str) -> str:
+        self.get(name)
+        return self._prompts[name]["version"]
+
+    def versions(self) -> Dict[str, str]:
+        return {name: entry["version"] for name, entry in self._prompts.items()}
+
+    def system_messages(self, name: str, instructions: str = "", user_context: Optional[str] = None) -> List[Dict[str, str]]:
+        """
+        Начало списка messages для Chat Completions.
+        Первое system-сообщение (промпт + статичные инструкции) одинаково для всех пользователей,
+        поэтому попадает под prefix prompt caching OpenAI; данные пользователя идут отдельным
+        сообщением после него.
+        """
+        static = self.get(name)
+        if instructions:
+            static = f"{static}\n\n{instructions.strip()}"
+        msgs = [{"role": "system", "content": static}]
+        if user_context:
+            msgs.append({"role": "system", "content": user_context.strip()})
+        return msgs
+
+
+prompt_registry = PromptRegistry(PROMPTS_DIR, reload_interval=settings.PROMPT_RELOAD_INTERVAL)
+prompt_registry.preload()
+
+
 # Для совместимости, если нужно, можно добавить алиасы:
 def load_greeting_and_lang_prompt():
-    path = os.path.join(os.path.dirname(__file__), "../prompts/greeting_and_lang.md")
-    return load_prompt(path)
+    return prompt_registry.get("greeting_and_lang")
 
 def load_profile_prompt():
-    path = os.path.join(os.path.dirname(__file__), "../prompts/profile.md")
-    return load_prompt(path)
+    return prompt_registry.get("profile")
 
 def load_summary_prompt():
-    path = os.path.join(os.path.dirname(__file__), "../prompts/summary.md")
-    return load_prompt(path)
+    return prompt_registry.get("summary")
 
 def load_survey_prompt():
-    path = os.path.join(os.path.dirname(__file__), "../prompts/survey.md")
-    return load_prompt(path)
+    return prompt_registry.get("survey")
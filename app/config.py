@@ -1,3 +1,5 @@
+from typing import Any, Dict, List, Optional
+
 from pydantic_settings import BaseSettings
 
 
@@ -6,13 +8,167 @@ class Settings(BaseSettings):
     TG_BOT_TOKEN: str
     WEBHOOK_URL: str
     WEBHOOK_SECRET: str
+    # Другой адрес Bot API (локальный Bot API server, stub для бенчмарков); None — api.telegram.org
+    TG_API_BASE_URL: Optional[str] = None
+    # "queue" — быстрый 200 OK и фоновая обработка; "inline" — обработка внутри запроса вебхука
+    UPDATE_PROCESSING_MODE: str = "queue"
+    UPDATE_WORKERS: int = 32
+    UPDATE_QUEUE_MAX_SIZE: int = 10000
+    UPDATE_QUEUE_DRAIN_TIMEOUT: float = 30.0
+    # Отбрасывание повторных доставок апдейтов по update_id: "memory" или "mongo" (несколько реплик)
+    UPDATE_DEDUP_BACKEND: str = "memory"
+    UPDATE_DEDUP_TTL: float = 3600.0
+    UPDATE_DEDUP_MAX_SIZE: int = 100000
+    # Сообщения пользователя, пришедшие с интервалом меньше окна, отвечаются одним ходом агента;
+    # окно добавляется к задержке каждого ответа, 0 — без склейки
+    MESSAGE_DEBOUNCE_WINDOW: float = 1.0
+    # Не откладывать ответ дольше этого времени от первого сообщения пачки
+    MESSAGE_DEBOUNCE_MAX_DELAY: float = 6.0
+
+    # Несколько воркеров/реплик: lease лидера для задач запуска и распределённые блокировки
+    # пользователей в Mongo (см. app/db/locks.py)
+    CLUSTER_MODE: bool = False
+    LEADER_LEASE_TTL: float = 60.0
+    USER_LOCK_TTL: float = 60.0
+    USER_LOCK_WAIT: float = 30.0
 
     # Mongo
     MONGO_URI: str
     MONGO_DB: str
+    MONGO_MAX_POOL_SIZE: int = 100
+    MONGO_MIN_POOL_SIZE: int = 0
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: int = 5000
+    MONGO_CONNECT_TIMEOUT_MS: int = 5000
+    MONGO_SOCKET_TIMEOUT_MS: int = 10000
+    # Write-behind некритичных записей (app/db/write_buffer.py): лог сообщений, updated_at, last_seen_at
+    WRITE_BEHIND_ENABLED: bool = True
+    WRITE_BEHIND_FLUSH_INTERVAL: float = 0.2
+    WRITE_BEHIND_MAX_BATCH: int = 500
+    # Архивация диалогов (app/db/archive.py): final без активности FINAL_AFTER секунд,
+    # любые без активности IDLE_AFTER секунд; проход раз в ARCHIVE_INTERVAL секунд
+    ARCHIVE_ENABLED: bool = True
+    ARCHIVE_INTERVAL: float = 600.0
+    ARCHIVE_FINAL_AFTER: float = 86400.0
+    ARCHIVE_IDLE_AFTER: float = 2592000.0
+    ARCHIVE_BATCH_SIZE: int = 200
+    # Сколько последних сообщений текущего этапа читается для агента
+    STAGE_HISTORY_LIMIT: int = 100
+    # Write-through кэш состояния пользователя (профиль, stage, история этапа)
+    USER_CACHE_MAX_SIZE: int = 10000
+    USER_CACHE_TTL: float = 300.0
 
     # LLM
     OPENAI_API_KEY: str
+    # Другой адрес API (прокси, локальный stub для бенчмарков); None — api.openai.com
+    OPENAI_BASE_URL: Optional[str] = None
+    LLM_TIMEOUT: float = 60.0  # секунды на один вызов chat.completions
+    LLM_CONNECT_TIMEOUT: float = 5.0
+    LLM_MAX_CONNECTIONS: int = 200
+    LLM_MAX_KEEPALIVE_CONNECTIONS: int = 50
+    LLM_KEEPALIVE_EXPIRY: float = 30.0
+    # Запись/воспроизведение запросов к LLM (app/agent/cassette.py): "off" | "record" | "replay".
+    # TIME_SCALE — множитель записанных задержек при воспроизведении (1 — как в записи, 0 — без пауз)
+    LLM_CASSETTE_MODE: str = "off"
+    LLM_CASSETTE_PATH: str = "cassettes/llm.jsonl.gz"
+    LLM_CASSETTE_TIME_SCALE: float = 1.0
+    # Устойчивость вызовов (app/agent/resilience.py): ретраи с backoff, hedging, fallback
+    LLM_MAX_RETRIES: int = 2
+    LLM_RETRY_BASE_DELAY: float = 0.5
+    LLM_RETRY_MAX_DELAY: float = 8.0
+    # Дедлайн (сек) на один вызов по маршруту; остальные маршруты — LLM_TIMEOUT
+    LLM_STAGE_DEADLINES: Dict[str, float] = {"language": 15.0, "light": 15.0, "profile": 20.0, "survey": 30.0, "summary": 30.0}
+    LLM_FALLBACK_MODELS: Dict[str, str] = {"gpt-4o": "gpt-4o-mini", "gpt-4o-mini": "gpt-4o"}
+    # Доля дедлайна на основную модель; остаток — на fallback
+    LLM_PRIMARY_DEADLINE_SHARE: float = 0.6
+    # Квоты OpenAI по моделям (запросов и токенов в минуту); модель без записи не ограничивается
+    LLM_RATE_LIMITS: Dict[str, Dict[str, int]] = {
+        "gpt-4o": {"rpm": 5000, "tpm": 800000},
+        "gpt-4o-mini": {"rpm": 5000, "tpm": 4000000},
+    }
+    # "memory" — квоты на процесс; "mongo" — общие для всех реплик (коллекция llm_rate_windows)
+    LLM_RATE_LIMIT_BACKEND: str = "memory"
+    LLM_RATE_LIMIT_MAX_QUEUE: int = 2000
+    LLM_RATE_LIMIT_MAX_WAIT: float = 10.0
+    # Приоритет маршрутов в очереди квот (меньше — раньше): пользователи в середине опроса — первыми
+    LLM_ROUTE_PRIORITIES: Dict[str, int] = {
+        "survey": 0,
+        "summary": 0,
+        "survey_extraction": 1,
+        "profile": 1,
+        "language": 2,
+        "context_summary": 3,
+    }
+    LLM_DEFAULT_PRIORITY: int = 2
+    # Дублирующий запрос отправляется после p95 задержки модели (по последним LLM_HEDGE_WINDOW вызовам)
+    LLM_HEDGE_WINDOW: int = 200
+    LLM_HEDGE_MIN_SAMPLES: int = 20
+    LLM_HEDGE_INITIAL_DELAY: float = 5.0
+    LLM_HEDGE_MIN_DELAY: float = 1.0
+    # Как часто (сек) проверять изменения файлов prompts/*.md
+    PROMPT_RELOAD_INTERVAL: float = 2.0
+    # Бюджет токенов промпта по этапам; старые ходы сворачиваются в сводку
+    CONTEXT_TOKEN_BUDGETS: Dict[str, int] = {"language": 1500, "profile": 3000, "survey": 8000, "summary": 5000}
+    CONTEXT_DEFAULT_TOKEN_BUDGET: int = 4000
+    CONTEXT_SUMMARY_MODEL: str = "gpt-4o-mini"
+    CONTEXT_SUMMARY_MAX_TOKENS: int = 400
+    # Сводка обновляется, когда за пределами окна накопилось столько новых сообщений (или токенов)
+    CONTEXT_SUMMARY_MIN_MESSAGES: int = 6
+    CONTEXT_SUMMARY_MIN_TOKENS: int = 800
+    # Сколько токенов ещё не покрытых сводкой сообщений допускается сверх бюджета этапа
+    CONTEXT_OVERFLOW_MAX_TOKENS: int = 1000
+    # Backoff повтора неудачной сводки (сек): удваивается с каждой неудачей подряд
+    CONTEXT_SUMMARY_RETRY_DELAY: float = 5.0
+    CONTEXT_SUMMARY_RETRY_MAX_DELAY: float = 300.0
+    # Маршрутизация моделей: переопределения маршрутов этапов/задач, например
+    # {"survey": {"model": "gpt-4o-mini", "max_tokens": 800}} (см. app/agent/routing.py)
+    LLM_ROUTES: Dict[str, Dict[str, Any]] = {}
+    # Короткие ходы (подтверждения, уточнения) на этих этапах идут на лёгкую модель
+    LLM_LIGHT_MODEL: str = "gpt-4o-mini"
+    LLM_LIGHT_STAGES: List[str] = ["profile", "survey"]
+    LLM_LIGHT_TURN_MAX_CHARS: int = 40
+    # Цены USD за 1M токенов для счётчика стоимости по маршрутам
+    LLM_MODEL_PRICES: Dict[str, Dict[str, float]] = {
+        "gpt-4o": {"input": 2.5, "cached_input": 1.25, "output": 10.0},
+        "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.6},
+    }
+    # Кэш ответов на типовые ходы (app/agent/response_cache.py); "mongo" — общий для реплик.
+    # survey по умолчанию не кэшируется: ключ включает profile_summary, попадания бывают только у того же пользователя
+    RESPONSE_CACHE_STAGES: List[str] = ["language", "profile"]
+    RESPONSE_CACHE_BACKEND: str = "memory"
+    RESPONSE_CACHE_MAX_SIZE: int = 5000
+    RESPONSE_CACHE_TTL: float = 86400.0
+    # Кэшируются только ходы с короткой историей этапа и короткими сообщениями
+    RESPONSE_CACHE_MAX_HISTORY: int = 2
+    RESPONSE_CACHE_MAX_MESSAGE_CHARS: int = 64
+    # Сколько последовательных вызовов LLM (переходов между агентами) допускается за один ход
+    STAGE_MAX_LLM_HOPS: int = 3
+    # Фоновое извлечение ответов опроса после каждого хода
+    SURVEY_EXTRACTION_MODEL: str = "gpt-4o-mini"
+    # Сколько ждать незавершённые извлечения при переходе survey -> summary
+    SURVEY_EXTRACTION_WAIT: float = 5.0
+    # Повторы неудачного извлечения (backoff от RETRY_DELAY, удваивается)
+    SURVEY_EXTRACTION_RETRIES: int = 3
+    SURVEY_EXTRACTION_RETRY_DELAY: float = 1.0
+
+    # Trace'ы обработки апдейтов (доля апдейтов; 0 — выключено), см. /api/traces
+    TRACE_SAMPLE_RATE: float = 0.0
+    TRACE_BUFFER_SIZE: int = 200
+    TRACE_LOG_SLOW_MS: float = 5000.0
+
+    # Исходящие сообщения (app/telegram_bot/sender.py): лимиты Bot API, повторы при 429/5xx
+    TG_SEND_GLOBAL_PER_SECOND: float = 30.0
+    TG_SEND_CHAT_INTERVAL: float = 1.0
+    TG_SEND_MAX_RETRIES: int = 3
+    # retry_after длиннее этого — сообщение считается недоставленным
+    TG_SEND_MAX_RETRY_AFTER: float = 60.0
+    # HTTP-сессия Bot API: размер пула keep-alive соединений и таймаут запроса (сек)
+    TG_MAX_CONNECTIONS: int = 100
+    TG_REQUEST_TIMEOUT: float = 30.0
+
+    # Стриминг ответов в Telegram (первое предложение + правки сообщения)
+    STREAM_REPLIES: bool = True
+    STREAM_EDIT_INTERVAL: float = 1.0
+    STREAM_FIRST_CHUNK_CHARS: int = 120
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,140 @@
+"""
+Архивация диалогов: история завершённых (stage final, без активности ARCHIVE_FINAL_AFTER секунд)
+и давно брошенных (ARCHIVE_IDLE_AFTER) диалогов переезжает из messages в сжатый документ
+conversations_archive, а в conversations остаётся заглушка (stage, final_message). Горячие
+коллекции и индексы содержат только живые диалоги.
+Пользователь, вернувшийся в брошенный диалог, получает историю обратно при первом сообщении
+(repository.rehydrate_conversation); в final история не нужна — ответ берётся из final_message.
+/reset удаляет и архив.
+
+Фоновая задача приложения (в CLUSTER_MODE — только у держателя lease) или разовый запуск:
+    python -m app.db.archive
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+from app.config import settings
+from app.db import repository
+from app.db.locks import LockTimeout, cluster_locks
+from app.db.write_buffer import write_buffer
+
+
+class ConversationArchiver:
+    def __init__(self, enabled: bool, interval: float, final_after: float, idle_after: float, batch_size: int):
+        self._enabled = enabled
+        self._interval = interval
+        self._final_after = final_after
+        self._idle_after = idle_after
+        self._batch_size = batch_size
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.archived = 0
+        self.skipped = 0
+        self.errors = 0
+        self.messages_moved = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    async def _archive_one(self, conv: Dict[str, Any]) -> None:
+        user_id = conv["user_id"]
+        try:
+            # Под блокировкой пользователя: ход не идёт параллельно с переносом истории
+            async with cluster_locks.user_lock(user_id):
+                await write_buffer.flush(user_id)
+                result = await repository.archive_conversation(conv)
+        except LockTimeout:
+            self.skipped += 1
+            return
+        except Exception as e:
+            self.errors += 1
+            print(f"[archive] user_id={user_id} failed: {type(e).__name__}: {e}")
+            return
+        if result is None:
+            self.skipped += 1
+            return
+        self.archived += 1
+        self.messages_moved += result["messages"]
+        self.raw_bytes += result["raw_bytes"]
+        self.compressed_bytes += result["compressed_bytes"]
+
+    async def run_once(self) -> int:
+        """
+        Один проход: архивирует все подходящие диалоги пакетами по ARCHIVE_BATCH_SIZE.
+        """
+        self.runs += 1
+        now = datetime.now(timezone.utc)
+        final_before = now - timedelta(seconds=self._final_after)
+        idle_before = now - timedelta(seconds=self._idle_after)
+        archived_before = self.archived
+        while True:
+            batch = await repository.find_archivable_conversations(final_before, idle_before, self._batch_size)
+            batch_start = self.archived
+            for conv in batch:
+                await self._archive_one(conv)
+            if len(batch) < self._batch_size or self.archived == batch_start:
+                # Пакет не полный или в нём ничего не удалось архивировать — ждём следующего прохода
+                break
+        count = self.archived - archived_before
+        if count:
+            print(f"[archive] Archived {count} conversations")
+        return count
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                if await cluster_locks.try_leadership("archive", ttl=self._interval):
+                    await self.run_once()
+            except Exception as e:
+                self.errors += 1
+                print(f"[archive] Run failed: {type(e).__name__}: {e}")
+
+    def start(self) -> None:
+        if self._enabled and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self._enabled,
+            "runs": self.runs,
+            "archived": self.archived,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "messages_moved": self.messages_moved,
+            "raw_bytes": self.raw_bytes,
+            "compressed_bytes": self.compressed_bytes,
+            "compression_ratio": round(self.raw_bytes / self.compressed_bytes, 2) if self.compressed_bytes else 0.0,
+        }
+
+
+archiver = ConversationArchiver(
+    enabled=settings.ARCHIVE_ENABLED,
+    interval=settings.ARCHIVE_INTERVAL,
+    final_after=settings.ARCHIVE_FINAL_AFTER,
+    idle_after=settings.ARCHIVE_IDLE_AFTER,
+    batch_size=settings.ARCHIVE_BATCH_SIZE,
+)
+
+
+async def main():
+    from app.db.mongo import mongo_client
+
+    await repository.ensure_indexes()
+    await archiver.run_once()
+    print(f"[archive] {archiver.stats()}")
+    await mongo_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,137 @@
+"""
+Write-through кэш состояния пользователя в памяти процесса (ключ — telegram_id).
+Хранит профиль пользователя, текущий stage, последние сообщения этого stage и сводки контекста.
+Все записи в БД идут через app.db.repository, который сразу обновляет кэш.
+"""
+import copy
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from app.config import settings
+
+
+class UserStateCache:
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _entry(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry["stored_at"] > self._ttl:
+            del self._entries[telegram_id]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(telegram_id)
+        return entry
+
+    def _entry_for_write(self, telegram_id: int) -> Dict[str, Any]:
+        entry = self._entry(telegram_id)
+        if entry is None:
+            entry = {"user": None, "stage": None, "messages": None, "summaries": None}
+            self._entries[telegram_id] = entry
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        entry["stored_at"] = time.monotonic()
+        return entry
+
+    def _lookup(self, telegram_id: int, field: str) -> Optional[Any]:
+        entry = self._entry(telegram_id)
+        value = entry.get(field) if entry else None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return copy.deepcopy(value)
+
+    # --- чтение ---
+
+    def get_user(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        return self._lookup(telegram_id, "user")
+
+    def get_stage(self, telegram_id: int) -> Optional[str]:
+        return self._lookup(telegram_id, "stage")
+
+    def get_summaries(self, telegram_id: int) -> Optional[Dict[str, Any]]:
+        return self._lookup(telegram_id, "summaries")
+
+    def get_messages(self, telegram_id: int, stage: str) -> Optional[List[Dict[str, Any]]]:
+        entry = self._entry(telegram_id)
+        if not entry or entry["stage"] != stage or entry["messages"] is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return copy.deepcopy(entry["messages"])
+
+    # --- запись (вызывается после успешной записи в БД) ---
+
+    def set_user(self, telegram_id: int, user_doc: Dict[str, Any]) -> None:
+        self._entry_for_write(telegram_id)["user"] = copy.deepcopy(user_doc)
+
+    def update_user(self, telegram_id: int, fields: Dict[str, Any]) -> None:
+        entry = self._entry(telegram_id)
+        if entry and entry["user"] is not None:
+            entry["user"].update(copy.deepcopy(fields))
+
+    def push_survey_answer(self, telegram_id: int, item: Dict[str, str]) -> None:
+        entry = self._entry(telegram_id)
+        if entry and entry["user"] is not None:
+            entry["user"].setdefault("survey", []).append(dict(item))
+
+    def set_stage(self, telegram_id: int, stage: str) -> None:
+        entry = self._entry_for_write(telegram_id)
+        if entry["stage"] != stage:
+            # История нового этапа ещё не загружена
+            entry["messages"] = None
+        entry["stage"] = stage
+
+    def set_messages(self, telegram_id: int, stage: str, messages: List[Dict[str, Any]]) -> None:
+        entry = self._entry_for_write(telegram_id)
+        entry["stage"] = stage
+        entry["messages"] = copy.deepcopy(messages[-settings.STAGE_HISTORY_LIMIT:])
+
+    def append_message(self, telegram_id: int, message: Dict[str, Any]) -> None:
+        entry = self._entry(telegram_id)
+        if entry and entry["messages"] is not None and entry["stage"] == message.get("stage"):
+            entry["messages"].append(copy.deepcopy(message))
+            del entry["messages"][:-settings.STAGE_HISTORY_LIMIT]
+
+    def drop_messages(self, telegram_id: int) -> None:
+        entry = self._entry(telegram_id)
+        if entry:
+            entry["messages"] = None
+
+    def set_summaries(self, telegram_id: int, summaries: Dict[str, Any]) -> None:
+        self._entry_for_write(telegram_id)["summaries"] = copy.deepcopy(summaries)
+
+    def set_summary(self, telegram_id: int, stage: str, summary: Dict[str, Any]) -> None:
+        entry = self._entry(telegram_id)
+        if entry and entry["summaries"] is not None:
+            entry["summaries"][stage] = copy.deepcopy(summary)
+
+    def invalidate(self, telegram_id: int) -> None:
+        self._entries.pop(telegram_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self._max_size,
+            "ttl_s": self._ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+user_cache = UserStateCache(max_size=settings.USER_CACHE_MAX_SIZE, ttl=settings.USER_CACHE_TTL)
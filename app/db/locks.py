@@ -0,0 +1,144 @@
+"""
+Координация нескольких воркеров/реплик (CLUSTER_MODE) через Mongo:
+- user_lock(telegram_id) — распределённая блокировка пользователя на время обработки апдейта,
+  чтобы два процесса не обрабатывали сообщения одного пользователя одновременно (гонки за stage);
+  если lock перед этим держал другой процесс, локальный кэш пользователя сбрасывается;
+- try_leadership(name) — lease «лидера» для разовых задач запуска (индексы, set_webhook).
+Без CLUSTER_MODE user_lock — обычный asyncio.Lock внутри процесса, try_leadership всегда True.
+"""
+import asyncio
+import os
+import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict
+
+from app.config import settings
+from app.db import repository
+from app.db.cache import user_cache
+from app.db.write_buffer import write_buffer
+
+# Идентификатор процесса-владельца блокировок
+OWNER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+# Интервал опроса занятого lock (растёт до максимума)
+POLL_MIN_INTERVAL = 0.02
+POLL_MAX_INTERVAL = 0.25
+
+
+class LockTimeout(Exception):
+    """Не удалось дождаться распределённой блокировки за USER_LOCK_WAIT секунд."""
+
+
+class ClusterLocks:
+    def __init__(self, enabled: bool, owner: str, ttl: float, wait: float):
+        self._enabled = enabled
+        self._owner = owner
+        self._ttl = ttl
+        self._wait = wait
+        self._local: Dict[int, asyncio.Lock] = {}
+        self._local_users: Dict[int, int] = {}
+        self.acquired = 0
+        self.contended = 0
+        self.timeouts = 0
+        self.cache_invalidations = 0
+        self.lost = 0
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+
+    async def _acquire_remote(self, key: str, telegram_id: int) -> None:
+        started = time.monotonic()
+        interval = POLL_MIN_INTERVAL
+        contended = False
+        while True:
+            ok, previous_owner = await repository.acquire_lock(key, self._owner, self._ttl)
+            if ok:
+                break
+            if not contended:
+                contended = True
+                self.contended += 1
+            if time.monotonic() - started + interval > self._wait:
+                self.timeouts += 1
+                raise LockTimeout(f"{key}: not acquired in {self._wait}s")
+            await asyncio.sleep(interval)
+            interval = min(POLL_MAX_INTERVAL, interval * 2)
+        waited_ms = (time.monotonic() - started) * 1000
+        self.wait_total_ms = round(self.wait_total_ms + waited_ms, 1)
+        self.wait_max_ms = round(max(self.wait_max_ms, waited_ms), 1)
+        if previous_owner != self._owner:
+            # Пользователя последним обрабатывал другой процесс (или история lock неизвестна)
+            user_cache.invalidate(telegram_id)
+            self.cache_invalidations += 1
+
+    async def _heartbeat(self, key: str) -> None:
+        while True:
+            await asyncio.sleep(self._ttl / 3)
+            if not await repository.renew_lock(key, self._owner, self._ttl):
+                self.lost += 1
+                print(f"[locks] Lost lock {key}")
+                return
+
+    @asynccontextmanager
+    async def user_lock(self, telegram_id: int) -> AsyncIterator[None]:
+        """
+        Эксклюзивная обработка пользователя в кластере; внутри процесса — asyncio.Lock.
+        """
+        local = self._local.setdefault(telegram_id, asyncio.Lock())
+        self._local_users[telegram_id] = self._local_users.get(telegram_id, 0) + 1
+        try:
+            async with local:
+                if not self._enabled:
+                    yield
+                    return
+                key = f"user:{telegram_id}"
+                await self._acquire_remote(key, telegram_id)
+                self.acquired += 1
+                heartbeat = asyncio.create_task(self._heartbeat(key))
+                try:
+                    yield
+                finally:
+                    heartbeat.cancel()
+                    # Отложенные записи хода должны быть в Mongo до того, как пользователя возьмёт другой воркер
+                    await write_buffer.flush(telegram_id)
+                    try:
+                        await repository.release_lock(key, self._owner)
+                    except Exception as e:
+                        # Lock освободится сам по истечении USER_LOCK_TTL
+                        print(f"[locks] Release failed for {key}: {type(e).__name__}: {e}")
+        finally:
+            self._local_users[telegram_id] -= 1
+            if not self._local_users[telegram_id]:
+                del self._local_users[telegram_id]
+                self._local.pop(telegram_id, None)
+
+    async def try_leadership(self, name: str, ttl: float) -> bool:
+        """
+        True — этот процесс взял lease name и должен выполнить разовую задачу.
+        """
+        if not self._enabled:
+            return True
+        ok, _ = await repository.acquire_lock(f"leader:{name}", self._owner, ttl)
+        print(f"[locks] Leadership for {name}: {'acquired' if ok else 'held by another worker'} ({self._owner})")
+        return ok
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "cluster_mode": self._enabled,
+            "owner": self._owner,
+            "acquired": self.acquired,
+            "contended": self.contended,
+            "timeouts": self.timeouts,
+            "lost": self.lost,
+            "cache_invalidations": self.cache_invalidations,
+            "wait_total_ms": self.wait_total_ms,
+            "wait_max_ms": self.wait_max_ms,
+            "local_users": len(self._local_users),
+        }
+
+
+cluster_locks = ClusterLocks(
+    enabled=settings.CLUSTER_MODE,
+    owner=OWNER_ID,
+    ttl=settings.USER_LOCK_TTL,
+    wait=settings.USER_LOCK_WAIT,
+)
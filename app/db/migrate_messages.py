@@ -0,0 +1,57 @@
+"""
+Миграция: переносит массив conversations.messages в отдельную коллекцию messages.
+
+Запуск:
+    python -m app.db.migrate_messages            # миграция всех диалогов
+    python -m app.db.migrate_messages --dry-run  # только посчитать
+
+Идемпотентна: сообщения, перенесённые прошлым (прерванным) запуском, помечены migrated=True
+и удаляются перед повторной вставкой; массив messages снимается только после успешной вставки.
+"""
+import argparse
+import asyncio
+
+from app.db.mongo import mongo_client, conversations, messages
+from app.db.repository import DEFAULT_STAGE, ensure_indexes
+
+
+async def migrate_conversation(conv: dict, dry_run: bool = False) -> int:
+    user_id = conv["user_id"]
+    docs = []
+    for m in conv.get("messages") or []:
+        doc = dict(m)
+        doc["user_id"] = user_id
+        doc.setdefault("stage", DEFAULT_STAGE)
+        doc["migrated"] = True
+        docs.append(doc)
+    if dry_run:
+        return len(docs)
+    await messages.delete_many({"user_id": user_id, "migrated": True})
+    if docs:
+        await messages.insert_many(docs, ordered=True)
+    await conversations.update_one({"_id": conv["_id"]}, {"$unset": {"messages": ""}})
+    return len(docs)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Move conversations.messages into the messages collection")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    await ensure_indexes()
+    migrated_convs = 0
+    migrated_msgs = 0
+    cursor = conversations.find({"messages": {"$exists": True}}, batch_size=args.batch_size)
+    async for conv in cursor:
+        count = await migrate_conversation(conv, dry_run=args.dry_run)
+        migrated_convs += 1
+        migrated_msgs += count
+        print(f"[migrate_messages] user_id={conv['user_id']}: {count} messages")
+    action = "Would migrate" if args.dry_run else "Migrated"
+    print(f"[migrate_messages] {action} {migrated_msgs} messages from {migrated_convs} conversations")
+    await mongo_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
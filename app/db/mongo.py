@@ -1,12 +1,70 @@
-from pymongo import MongoClient
-from pymongo.collection import Collection
+from pymongo import AsyncMongoClient, monitoring
+from pymongo.asynchronous.collection import AsyncCollection
 from app.config import settings
+from app.metrics import mongo_seconds
+from app.tracing import record_span
+
+# Служебные команды драйвера (handshake, аутентификация) в метрики не попадают
+_IGNORED_COMMANDS = {"hello", "ismaster", "isMaster", "saslStart", "saslContinue", "endSessions"}
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Гистограмма задержек и span'ы для каждой команды Mongo (по имени команды и коллекции).
+    """
+
+    def __init__(self):
+        self._inflight = {}
+
+    def started(self, event):
+        if event.command_name in _IGNORED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        self._inflight[(event.request_id, event.connection_id)] = collection if isinstance(collection, str) else ""
+
+    def _finish(self, event, outcome: str):
+        collection = self._inflight.pop((event.request_id, event.connection_id), None)
+        if collection is None:
+            return
+        duration = event.duration_micros / 1_000_000
+        mongo_seconds.observe(duration, command=event.command_name, collection=collection, outcome=outcome)
+        record_span(f"mongo.{event.command_name}", duration, collection=collection, outcome=outcome)
+
+    def succeeded(self, event):
+        self._finish(event, "ok")
+
+    def failed(self, event):
+        self._finish(event, "error")
+
 
 print(f"Connecting to MongoDB: {settings.MONGO_URI}")
 
-mongo_client = MongoClient(settings.MONGO_URI)
+# Асинхронный клиент: сетевые round-trip'ы не блокируют event loop.
+# Пул и таймауты настраиваются через переменные окружения (см. config.py).
+mongo_client = AsyncMongoClient(
+    settings.MONGO_URI,
+    maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+    minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+    serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    connectTimeoutMS=settings.MONGO_CONNECT_TIMEOUT_MS,
+    socketTimeoutMS=settings.MONGO_SOCKET_TIMEOUT_MS,
+    # datetime из БД — aware (UTC), как и создаваемые приложением: их можно сравнивать
+    tz_aware=True,
+    event_listeners=[CommandMetrics()],
+)
 db = mongo_client.get_database(settings.MONGO_DB)
 
 # Collections
-users: Collection = db["users"]
-conversations: Collection = db["conversations"]
\ No newline at end of file
+users: AsyncCollection = db["users"]
+conversations: AsyncCollection = db["conversations"]
+messages: AsyncCollection = db["messages"]
+# Распределённые блокировки пользователей и lease лидера (CLUSTER_MODE)
+locks: AsyncCollection = db["locks"]
+# update_id уже принятых апдейтов вебхука (UPDATE_DEDUP_BACKEND=mongo)
+processed_updates: AsyncCollection = db["processed_updates"]
+# Общие для всех реплик счётчики квот OpenAI по минутным окнам (LLM_RATE_LIMIT_BACKEND=mongo)
+llm_rate_windows: AsyncCollection = db["llm_rate_windows"]
+# Кэш ответов LLM на типовые первые ходы (RESPONSE_CACHE_BACKEND=mongo)
+llm_response_cache: AsyncCollection = db["llm_response_cache"]
+# Сжатая история завершённых и давно неактивных диалогов (app/db/archive.py)
+conversations_archive: AsyncCollection = db["conversations_archive"]
@@ -0,0 +1,561 @@
+"""
+Асинхронный слой доступа к данным. Все обращения к Mongo из хендлеров и инструментов агентов
+идут через функции этого модуля.
+"""
+import asyncio
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import Binary, ObjectId, decode as bson_decode, encode as bson_encode
+from bson.codec_options import CodecOptions
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from pymongo.results import UpdateResult
+
+from app.config import settings
+from app.db.cache import user_cache
+from app.db.write_buffer import write_buffer
+from app.db.mongo import (
+    users,
+    conversations,
+    messages,
+    locks,
+    processed_updates,
+    llm_rate_windows,
+    llm_response_cache,
+    conversations_archive,
+)
+
+DEFAULT_STAGE = "language"
+
+# Поля пользователя, которые нужны stage-агентам (остальное не тянем по сети)
+USER_AGENT_PROJECTION = {
+    "_id": 0,
+    "telegram_id": 1,
+    "first_name": 1,
+    "last_name": 1,
+    "username": 1,
+    "language_code": 1,
+    "preffered_language": 1,
+    "preffered_name": 1,
+    "profile_summary": 1,
+    "survey": 1,
+    "final_message": 1,
+}
+CONVERSATION_AGENT_PROJECTION = {"_id": 0, "stage": 1, "context_summaries": 1, "archived": 1}
+# Поля заглушки архивированного диалога в conversations
+ARCHIVE_STUB_FIELDS = ("archived", "archived_at", "archived_upto", "final_message")
+ARCHIVE_COMPRESSION_LEVEL = 6
+MESSAGE_PROJECTION = {"_id": 0, "role": 1, "text": 1, "ts": 1, "stage": 1}
+
+
+def _now_utc() -> datetime:
+    # Mongo хранит время с точностью до миллисекунды: так ts отложенной записи совпадает с прочитанным
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def _with_pending(user_id: int, stage: str, recent: List[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+    """
+    Подмешивает к прочитанным из Mongo сообщениям этапа ещё не записанные из write-behind буфера.
+    """
+    pending = write_buffer.pending_messages(user_id, stage)
+    if not pending:
+        return recent
+    seen = {(m.get("role"), m.get("ts"), m.get("text")) for m in recent}
+    extra = [
+        {k: m[k] for k in ("role", "text", "ts", "stage")}
+        for m in pending
+        if (m["role"], m["ts"], m["text"]) not in seen
+    ]
+    return sorted(recent + extra, key=lambda m: m["ts"])[-limit:]
+
+
+async def ensure_indexes() -> None:
+    await users.create_index("telegram_id", unique=True, name="uniq_telegram_id")
+    await conversations.create_index("user_id", unique=True, name="uniq_user_id")
+    await conversations.create_index("updated_at", name="idx_updated_at")
+    await messages.create_index(
+        [("user_id", ASCENDING), ("stage", ASCENDING), ("ts", ASCENDING)],
+        name="idx_user_stage_ts",
+    )
+    await locks.create_index("expires_at", expireAfterSeconds=0, name="ttl_expires_at")
+    await processed_updates.create_index("expires_at", expireAfterSeconds=0, name="ttl_expires_at")
+    await llm_rate_windows.create_index("expires_at", expireAfterSeconds=0, name="ttl_expires_at")
+    await llm_response_cache.create_index("expires_at", expireAfterSeconds=0, name="ttl_expires_at")
+    await conversations_archive.create_index("user_id", unique=True, name="uniq_user_id")
+
+
+# === Users ===
+
+async def get_user(telegram_id: int) -> Dict[str, Any]:
+    cached = user_cache.get_user(telegram_id)
+    if cached is not None:
+        return cached
+    user_doc = await users.find_one({"telegram_id": telegram_id}, USER_AGENT_PROJECTION)
+    if user_doc:
+        pending = write_buffer.pending_user_fields(telegram_id)
+        user_doc.update({k: v for k, v in pending.items() if k in USER_AGENT_PROJECTION})
+        user_cache.set_user(telegram_id, user_doc)
+    return user_doc or {}
+
+
+async def set_user_fields(telegram_id: int, fields: Dict[str, Any]) -> UpdateResult:
+    result = await users.update_one({"telegram_id": telegram_id}, {"$set": fields})
+    user_cache.update_user(telegram_id, fields)
+    return result
+
+
+# === Survey ===
+
+async def add_survey_exchange(telegram_id: int, question: str, answer: str) -> Dict[str, Any]:
+    """
+    Пара «вопрос → ответ» опроса, ожидающая извлечения ответов (users.survey_pending).
+    """
+    exchange = {"_id": ObjectId(), "question": question, "answer": answer, "ts": _now_utc()}
+    await users.update_one({"telegram_id": telegram_id}, {"$push": {"survey_pending": exchange}})
+    return exchange
+
+
+async def get_survey_exchanges(telegram_id: int) -> List[Dict[str, Any]]:
+    doc = await users.find_one({"telegram_id": telegram_id}, {"_id": 0, "survey_pending": 1})
+    return (doc or {}).get("survey_pending") or []
+
+
+async def complete_survey_exchange(telegram_id: int, exchange_id: ObjectId, answers: List[Dict[str, str]]) -> bool:
+    """
+    Атомарно переносит извлечённые ответы в users.survey и убирает пару из survey_pending.
+    False — пару уже разобрал другой процесс (или пользователь удалён): ответы не дублируются.
+    """
+    update: Dict[str, Any] = {"$pull": {"survey_pending": {"_id": exchange_id}}}
+    if answers:
+        update["$push"] = {"survey": {"$each": answers}}
+    result = await users.update_one({"telegram_id": telegram_id, "survey_pending._id": exchange_id}, update)
+    if not result.modified_count:
+        return False
+    for item in answers:
+        user_cache.push_survey_answer(telegram_id, item)
+    return True
+
+
+# === Messages ===
+
+async def get_stage_messages(user_id: int, stage: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Последние limit сообщений этапа stage в хронологическом порядке (индекс idx_user_stage_ts).
+    """
+    limit = limit or settings.STAGE_HISTORY_LIMIT
+    cached = user_cache.get_messages(user_id, stage)
+    if cached is not None and (len(cached) >= limit or len(cached) < settings.STAGE_HISTORY_LIMIT):
+        # В кэше либо достаточно сообщений, либо вся история этапа целиком
+        return cached[-limit:]
+    cursor = messages.find({"user_id": user_id, "stage": stage}, MESSAGE_PROJECTION).sort("ts", DESCENDING).limit(limit)
+    recent = await cursor.to_list(length=limit)
+    recent.reverse()
+    recent = _with_pending(user_id, stage, recent, limit)
+    if limit >= settings.STAGE_HISTORY_LIMIT and user_cache.get_stage(user_id) == stage:
+        user_cache.set_messages(user_id, stage, recent)
+    return recent
+
+
+async def _touch_conversation(user_id: int, now: datetime, title: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Обновляет updated_at (создаёт диалог при первом сообщении) и возвращает его stage.
+    """
+    update: Dict[str, Any] = {"$set": {"updated_at": now}}
+    if title is not None:
+        update["$setOnInsert"] = {"user_id": user_id, "created_at": now, "title": title}
+    conv = await conversations.find_one_and_update(
+        {"user_id": user_id},
+        update,
+        projection=CONVERSATION_AGENT_PROJECTION,
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    return conv or {}
+
+
+async def push_message(user_id: int, role: str, text: str, stage: Optional[str] = None) -> None:
+    """
+    Добавляет сообщение в историю диалога. Если stage не указан — берётся текущий stage диалога.
+    """
+    now = _now_utc()
+    stage = stage or user_cache.get_stage(user_id)
+    if stage is None:
+        conv = await _touch_conversation(user_id, now)
+        stage = conv.get("stage", DEFAULT_STAGE)
+        touch = None
+    elif write_buffer.active:
+        write_buffer.touch_conversation(user_id, now)
+        touch = None
+    else:
+        touch = conversations.update_one({"user_id": user_id}, {"$set": {"updated_at": now}})
+    doc = {"_id": ObjectId(), "user_id": user_id, "role": role, "text": text, "ts": now, "stage": stage}
+    if write_buffer.active:
+        # Лог сообщений — отложенная запись пакетом; чтения истории видят его сразу
+        write_buffer.insert_message(doc)
+    elif touch is not None:
+        await asyncio.gather(touch, messages.insert_one(doc))
+    else:
+        await messages.insert_one(doc)
+    user_cache.append_message(user_id, {k: doc[k] for k in ("role", "text", "ts", "stage")})
+
+
+async def restamp_messages(user_id: int, ids: List[ObjectId], stage: str) -> None:
+    """
+    Переносит сообщения в этап stage: их записали со stage, который ход пользователя успел сменить.
+    """
+    await write_buffer.restamp_messages(user_id, ids, stage)
+    await messages.update_many({"user_id": user_id, "_id": {"$in": ids}}, {"$set": {"stage": stage}})
+    # История этапа перечитывается с перенесёнными сообщениями
+    user_cache.drop_messages(user_id)
+
+
+async def append_assistant_message(user_id: int, text: str) -> None:
+    await push_message(user_id, "assistant", text)
+
+
+# === Ingest ===
+
+async def record_user_message(
+    telegram_id: int,
+    user_fields: Dict[str, Any],
+    message: Dict[str, Any],
+    title: str,
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """
+    Ingest входящего сообщения: upsert пользователя, запись сообщения с текущим stage
+    и выборка последних сообщений этого stage для агента.
+    Возвращает (user_doc, conversation_doc), где conversation_doc["messages"] — история текущего этапа,
+    а conversation_doc["message_id"] — _id записанного сообщения.
+    """
+    now = _now_utc()
+    stage = user_cache.get_stage(telegram_id)
+    cached_messages = user_cache.get_messages(telegram_id, stage) if stage else None
+    # В CLUSTER_MODE сообщение пишется сразу: следующий ход пользователя может взять другой воркер
+    buffered = write_buffer.active and not settings.CLUSTER_MODE and cached_messages is not None
+    cached_user = user_cache.get_user(telegram_id) if buffered else None
+    if cached_user is not None:
+        # Тёплый кэш и write-behind: поля активности, updated_at и сообщение уходят в буфер,
+        # ход не ждёт ни одного round-trip'а к Mongo
+        doc = {"_id": ObjectId(), "user_id": telegram_id, "role": "user", "ts": now, "stage": stage, **message}
+        write_buffer.set_user_fields(telegram_id, user_fields)
+        write_buffer.touch_conversation(telegram_id, now)
+        write_buffer.insert_message(doc)
+        agent_fields = {k: v for k, v in user_fields.items() if k in USER_AGENT_PROJECTION}
+        user_cache.update_user(telegram_id, agent_fields)
+        message_view = {k: doc[k] for k in ("role", "text", "ts", "stage")}
+        user_cache.append_message(telegram_id, message_view)
+        older = cached_messages[max(len(cached_messages) - settings.STAGE_HISTORY_LIMIT + 1, 0):]
+        return {**cached_user, **agent_fields}, {"stage": stage, "messages": older + [message_view], "message_id": doc["_id"]}
+
+    user_update = users.find_one_and_update(
+        {"telegram_id": telegram_id},
+        {
+            "$setOnInsert": {"telegram_id": telegram_id, "created_at": now},
+            "$set": user_fields,
+        },
+        projection=USER_AGENT_PROJECTION,
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    if cached_messages is not None:
+        # Тёплый кэш: stage и история известны, все три записи уходят параллельно без чтений
+        doc = {"_id": ObjectId(), "user_id": telegram_id, "role": "user", "ts": now, "stage": stage, **message}
+        user_doc, _, _ = await asyncio.gather(
+            user_update,
+            conversations.update_one({"user_id": telegram_id}, {"$set": {"updated_at": now}}),
+            messages.insert_one(doc),
+        )
+        user_doc = user_doc or {}
+        user_cache.set_user(telegram_id, user_doc)
+        message_view = {k: doc[k] for k in ("role", "text", "ts", "stage")}
+        user_cache.append_message(telegram_id, message_view)
+        older = cached_messages[max(len(cached_messages) - settings.STAGE_HISTORY_LIMIT + 1, 0):]
+        return user_doc, {"stage": stage, "messages": older + [message_view], "message_id": doc["_id"]}
+
+    user_doc, conv = await asyncio.gather(user_update, _touch_conversation(telegram_id, now, title=title))
+    user_doc = user_doc or {}
+    if conv.get("archived") and conv.get("stage") != "final":
+        # Пользователь вернулся в давно брошенный диалог — история нужна агенту этапа
+        await rehydrate_conversation(telegram_id)
+        conv = await conversations.find_one({"user_id": telegram_id}, CONVERSATION_AGENT_PROJECTION) or conv
+    user_cache.set_user(telegram_id, user_doc)
+    user_cache.set_summaries(telegram_id, conv.get("context_summaries") or {})
+    stage = conv.get("stage", DEFAULT_STAGE)
+    doc = {"_id": ObjectId(), "user_id": telegram_id, "role": "user", "ts": now, "stage": stage, **message}
+    # Вставка и чтение истории идут параллельно; новое сообщение исключаем из выборки и добавляем сами
+    older = max(settings.STAGE_HISTORY_LIMIT - 1, 1)
+    cursor = (
+        messages.find({"user_id": telegram_id, "stage": stage, "_id": {"$ne": doc["_id"]}}, MESSAGE_PROJECTION)
+        .sort("ts", DESCENDING)
+        .limit(older)
+    )
+    _, recent = await asyncio.gather(messages.insert_one(doc), cursor.to_list(length=older))
+    recent = recent[:settings.STAGE_HISTORY_LIMIT - 1]
+    recent.reverse()
+    recent = _with_pending(telegram_id, stage, recent, older)
+    recent.append({k: doc[k] for k in ("role", "text", "ts", "stage")})
+    user_cache.set_messages(telegram_id, stage, recent)
+    return user_doc, {"stage": stage, "messages": recent, "message_id": doc["_id"]}
+
+
+# === Conversations ===
+
+async def get_conversation(user_id: int) -> Dict[str, Any]:
+    """
+    Диалог с историей текущего этапа в поле messages.
+    """
+    stage = await get_stage(user_id)
+    return {"stage": stage, "messages": await get_stage_messages(user_id, stage)}
+
+
+async def get_stage(user_id: int) -> str:
+    cached = user_cache.get_stage(user_id)
+    if cached is not None:
+        return cached
+    conv = await conversations.find_one({"user_id": user_id}, {"stage": 1})
+    stage = conv.get("stage") if conv and "stage" in conv else DEFAULT_STAGE
+    if conv:
+        user_cache.set_stage(user_id, stage)
+    return stage
+
+
+async def get_context_summary(user_id: int, stage: str) -> Optional[Dict[str, Any]]:
+    """
+    Сводка старых сообщений этапа: {"text": ..., "upto_ts": ...} или None.
+    """
+    summaries = user_cache.get_summaries(user_id)
+    if summaries is None:
+        conv = await conversations.find_one({"user_id": user_id}, {"_id": 0, "context_summaries": 1}) or {}
+        summaries = conv.get("context_summaries") or {}
+        user_cache.set_summaries(user_id, summaries)
+    return summaries.get(stage)
+
+
+async def set_context_summary(user_id: int, stage: str, text: str, upto_ts: datetime) -> None:
+    summary = {"text": text, "upto_ts": upto_ts}
+    await conversations.update_one({"user_id": user_id}, {"$set": {f"context_summaries.{stage}": summary}})
+    user_cache.set_summary(user_id, stage, summary)
+
+
+# === Stage transitions ===
+
+async def set_stage(user_id: int, stage: str) -> UpdateResult:
+    result = await conversations.update_one({"user_id": user_id}, {"$set": {"stage": stage}})
+    user_cache.set_stage(user_id, stage)
+    return result
+
+
+async def delete_user_data(telegram_id: int) -> None:
+    user_cache.invalidate(telegram_id)
+    # Отложенные записи пользователя не должны воскресить его после удаления
+    await write_buffer.discard_user(telegram_id)
+    await asyncio.gather(
+        users.delete_one({"telegram_id": telegram_id}),
+        conversations.delete_one({"user_id": telegram_id}),
+        messages.delete_many({"user_id": telegram_id}),
+        conversations_archive.delete_one({"user_id": telegram_id}),
+    )
+
+
+# === Archive ===
+
+def _pack_messages(docs: List[Dict[str, Any]]) -> Tuple[Binary, int]:
+    raw = bson_encode({"messages": docs})
+    return Binary(zlib.compress(raw, ARCHIVE_COMPRESSION_LEVEL)), len(raw)
+
+
+def _unpack_messages(blob: bytes) -> List[Dict[str, Any]]:
+    return bson_decode(zlib.decompress(blob), codec_options=CodecOptions(tz_aware=True))["messages"]
+
+
+async def find_archivable_conversations(final_before: datetime, idle_before: datetime, limit: int) -> List[Dict[str, Any]]:
+    """
+    Диалоги в final без активности с final_before и любые без активности с idle_before,
+    ещё не архивированные или получившие сообщения после архивации (индекс idx_updated_at).
+    """
+    cursor = conversations.find(
+        {
+            "updated_at": {"$lt": max(final_before, idle_before)},
+            "$and": [
+                {"$or": [{"stage": "final"}, {"updated_at": {"$lt": idle_before}}]},
+                {"$or": [{"archived": {"$ne": True}}, {"$expr": {"$gt": ["$updated_at", "$archived_upto"]}}]},
+            ],
+        },
+    ).sort("updated_at", ASCENDING).limit(limit)
+    return await cursor.to_list(length=limit)
+
+
+async def archive_conversation(conv: Dict[str, Any]) -> Optional[Dict[str, int]]:
+    """
+    Переносит историю диалога в conversations_archive (сжатый BSON) и оставляет в conversations
+    заглушку: stage, updated_at и final_message. Повторная архивация дописывает новые сообщения.
+    None — диалог изменился во время архивации (пользователь снова активен), ничего не тронуто.
+    """
+    user_id = conv["user_id"]
+    hot, existing, user = await asyncio.gather(
+        messages.find({"user_id": user_id}).sort("ts", ASCENDING).to_list(length=None),
+        conversations_archive.find_one({"user_id": user_id}),
+        users.find_one({"telegram_id": user_id}, {"_id": 0, "final_message": 1}),
+    )
+    archived = _unpack_messages(existing["messages"]) if existing else []
+    # Прерванная прошлая архивация могла оставить уже заархивированные сообщения в messages
+    archived_ids = {m["_id"] for m in archived}
+    new_messages = [m for m in hot if m["_id"] not in archived_ids]
+    if existing:
+        conversation = existing["conversation"]
+    else:
+        conversation = {k: v for k, v in conv.items() if k != "_id" and k not in ARCHIVE_STUB_FIELDS}
+    now = _now_utc()
+    blob, raw_size = _pack_messages(archived + new_messages)
+    await conversations_archive.replace_one(
+        {"user_id": user_id},
+        {
+            "user_id": user_id,
+            "archived_at": now,
+            "conversation": conversation,
+            "message_count": len(archived) + len(new_messages),
+            "raw_bytes": raw_size,
+            "messages": blob,
+        },
+        upsert=True,
+    )
+    stub = {
+        "user_id": user_id,
+        "stage": conv.get("stage", DEFAULT_STAGE),
+        "updated_at": conv["updated_at"],
+        "archived": True,
+        "archived_at": now,
+        "archived_upto": conv["updated_at"],
+    }
+    if (user or {}).get("final_message"):
+        stub["final_message"] = user["final_message"]
+    result = await conversations.replace_one({"_id": conv["_id"], "updated_at": conv["updated_at"]}, stub)
+    if not result.modified_count:
+        # Откатываем архив к прежнему состоянию: сообщения ещё в messages
+        if existing:
+            await conversations_archive.replace_one({"user_id": user_id}, existing)
+        else:
+            await conversations_archive.delete_one({"user_id": user_id})
+        return None
+    if hot:
+        await messages.delete_many({"_id": {"$in": [m["_id"] for m in hot]}})
+    user_cache.invalidate(user_id)
+    return {"messages": len(new_messages), "raw_bytes": raw_size, "compressed_bytes": len(blob)}
+
+
+async def rehydrate_conversation(user_id: int) -> int:
+    """
+    Возвращает историю из архива в messages и полный диалог в conversations.
+    Идемпотентна: архив удаляется последним, повтор заменяет уже вставленные сообщения.
+    """
+    existing = await conversations_archive.find_one({"user_id": user_id})
+    unset = {field: "" for field in ARCHIVE_STUB_FIELDS}
+    if not existing:
+        await conversations.update_one({"user_id": user_id}, {"$unset": unset})
+        return 0
+    docs = _unpack_messages(existing["messages"])
+    if docs:
+        await messages.delete_many({"_id": {"$in": [m["_id"] for m in docs]}})
+        await messages.insert_many(docs, ordered=False)
+    restore = {k: v for k, v in existing["conversation"].items() if k not in ("user_id", "stage", "updated_at")}
+    update: Dict[str, Any] = {"$unset": unset}
+    if restore:
+        update["$set"] = restore
+    await conversations.update_one({"user_id": user_id}, update)
+    await conversations_archive.delete_one({"user_id": user_id})
+    user_cache.invalidate(user_id)
+    print(f"[archive] Rehydrated user_id={user_id}: {len(docs)} messages")
+    return len(docs)
+
+
+# === Distributed locks ===
+
+async def acquire_lock(key: str, owner: str, ttl: float) -> Tuple[bool, Optional[str]]:
+    """
+    Берёт lock key, если он свободен, истёк или уже принадлежит owner.
+    Возвращает (взят ли, предыдущий владелец); занятый lock даёт DuplicateKeyError при upsert.
+    """
+    now = _now_utc()
+    try:
+        before = await locks.find_one_and_update(
+            {"_id": key, "$or": [{"expires_at": {"$lte": now}}, {"owner": owner}]},
+            {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=ttl), "acquired_at": now}},
+            projection={"owner": 1},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+        )
+    except DuplicateKeyError:
+        return False, None
+    return True, (before or {}).get("owner")
+
+
+async def renew_lock(key: str, owner: str, ttl: float) -> bool:
+    result = await locks.update_one(
+        {"_id": key, "owner": owner},
+        {"$set": {"expires_at": _now_utc() + timedelta(seconds=ttl)}},
+    )
+    return result.matched_count == 1
+
+
+async def release_lock(key: str, owner: str) -> None:
+    # Документ остаётся (до TTL-индекса) с последним владельцем: по нему другая реплика
+    # понимает, что её кэш пользователя мог устареть
+    await locks.update_one({"_id": key, "owner": owner}, {"$set": {"expires_at": _now_utc()}})
+
+
+# === Webhook updates dedup ===
+
+async def mark_update_seen(update_id: int, expires_at: datetime) -> bool:
+    """
+    False — update_id уже был принят (повторная доставка).
+    """
+    try:
+        await processed_updates.insert_one({"_id": update_id, "expires_at": expires_at})
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+async def unmark_update_seen(update_id: int) -> None:
+    await processed_updates.delete_one({"_id": update_id})
+
+
+# === LLM rate limits (общие для реплик) ===
+
+async def take_rate_window(key: str, max_requests: int, max_tokens: int, tokens: int, expires_at: datetime) -> bool:
+    """
+    Атомарно резервирует 1 запрос и tokens токенов в окне key, если квоты окна не исчерпаны.
+    Если окно уже заполнено, условный upsert пытается вставить дубль _id и получает DuplicateKeyError.
+    """
+    try:
+        await llm_rate_windows.update_one(
+            {"_id": key, "requests": {"$lt": max_requests}, "tokens": {"$lte": max_tokens - tokens}},
+            {"$inc": {"requests": 1, "tokens": tokens}, "$setOnInsert": {"expires_at": expires_at}},
+            upsert=True,
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+
+async def adjust_rate_window(key: str, tokens: int) -> None:
+    # Поправка оценки токенов по фактическому usage
+    await llm_rate_windows.update_one({"_id": key}, {"$inc": {"tokens": tokens}})
+
+
+# === LLM response cache ===
+
+async def get_cached_response(key: str) -> Optional[Dict[str, Any]]:
+    return await llm_response_cache.find_one({"_id": key, "expires_at": {"$gt": _now_utc()}})
+
+
+async def put_cached_response(key: str, entry: Dict[str, Any], expires_at: datetime) -> None:
+    await llm_response_cache.replace_one({"_id": key}, {**entry, "expires_at": expires_at}, upsert=True)
+
+
+async def delete_cached_responses(prompt: str, keep_version: str) -> int:
+    result = await llm_response_cache.delete_many({"prompt": prompt, "prompt_version": {"$ne": keep_version}})
+    return result.deleted_count
@@ -0,0 +1,237 @@
+"""
+Write-behind буфер некритичных записей: лог сообщений (messages), updated_at диалога и поля
+активности пользователя (last_seen_at, last_message_*). Записи копятся в памяти и уходят в Mongo
+пакетами bulk_write не реже WRITE_BEHIND_FLUSH_INTERVAL секунд (или сразу при
+WRITE_BEHIND_MAX_BATCH ожидающих сообщениях), по одному round-trip на коллекцию для всех
+пользователей. Смена stage, инструменты агентов и удаление данных пишутся синхронно.
+- read-your-writes: repository подмешивает ещё не записанные сообщения и поля к чтениям из Mongo;
+- в CLUSTER_MODE записи пользователя сбрасываются перед освобождением его блокировки;
+- при остановке (lifespan) буфер сбрасывается целиком; ошибка записи — пакет возвращается в буфер.
+Пока буфер не запущен (скрипты, миграции), repository пишет синхронно.
+"""
+import asyncio
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from app.config import settings
+from app.db.mongo import conversations, messages, users
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+def _empty() -> Dict[str, Any]:
+    return {"user": {}, "touch": None, "messages": []}
+
+
+def _merge(older: Dict[str, Any], newer: Dict[str, Any]) -> Dict[str, Any]:
+    touches = [t for t in (older["touch"], newer["touch"]) if t is not None]
+    return {
+        "user": {**older["user"], **newer["user"]},
+        "touch": max(touches) if touches else None,
+        "messages": older["messages"] + newer["messages"],
+    }
+
+
+def _duplicates_only(error: BaseException) -> bool:
+    # Повтор пакета после частичной записи: уже вставленные сообщения (тот же _id) не ошибка
+    if not isinstance(error, BulkWriteError):
+        return False
+    details = error.details or {}
+    write_errors = details.get("writeErrors") or []
+    return bool(write_errors) and not details.get("writeConcernErrors") and all(
+        e.get("code") == DUPLICATE_KEY_ERROR for e in write_errors
+    )
+
+
+class WriteBuffer:
+    def __init__(self, enabled: bool, flush_interval: float, max_batch: int):
+        self._enabled = enabled
+        self._interval = flush_interval
+        self._max_batch = max_batch
+        # telegram_id -> {"user": поля $set, "touch": updated_at диалога, "messages": документы}
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        # Пакет, который пишется сейчас: его записи тоже видны чтениям
+        self._inflight: Dict[int, Dict[str, Any]] = {}
+        self._pending_messages = 0
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.flushes = 0
+        self.flushed_messages = 0
+        self.flushed_updates = 0
+        self.buffered_writes = 0
+        self.errors = 0
+        self.flush_max_ms = 0.0
+
+    @property
+    def active(self) -> bool:
+        return self._task is not None
+
+    # === Запись в буфер ===
+
+    def _user(self, telegram_id: int) -> Dict[str, Any]:
+        writes = self._pending.get(telegram_id)
+        if writes is None:
+            writes = self._pending[telegram_id] = _empty()
+        return writes
+
+    def set_user_fields(self, telegram_id: int, fields: Dict[str, Any]) -> None:
+        self._user(telegram_id)["user"].update(fields)
+        self.buffered_writes += 1
+
+    def touch_conversation(self, user_id: int, now: datetime) -> None:
+        writes = self._user(user_id)
+        writes["touch"] = max(writes["touch"], now) if writes["touch"] else now
+        self.buffered_writes += 1
+
+    def insert_message(self, doc: Dict[str, Any]) -> None:
+        self._user(doc["user_id"])["messages"].append(doc)
+        self.buffered_writes += 1
+        self._pending_messages += 1
+        if self._pending_messages >= self._max_batch:
+            self._wakeup.set()
+
+    # === Read-your-writes ===
+
+    def pending_messages(self, user_id: int, stage: str) -> List[Dict[str, Any]]:
+        result = []
+        for source in (self._inflight, self._pending):
+            writes = source.get(user_id)
+            if writes:
+                result.extend(m for m in writes["messages"] if m.get("stage") == stage)
+        return result
+
+    def pending_user_fields(self, telegram_id: int) -> Dict[str, Any]:
+        fields: Dict[str, Any] = {}
+        for source in (self._inflight, self._pending):
+            writes = source.get(telegram_id)
+            if writes:
+                fields.update(writes["user"])
+        return fields
+
+    async def restamp_messages(self, user_id: int, ids: List[Any], stage: str) -> None:
+        """
+        Меняет stage ещё не записанных сообщений; пишущийся пакет дожидается.
+        """
+        async with self._lock:
+            writes = self._pending.get(user_id)
+            for doc in writes["messages"] if writes else ():
+                if doc["_id"] in ids:
+                    doc["stage"] = stage
+
+    # === Сброс в Mongo ===
+
+    async def flush(self, user_id: Optional[int] = None) -> None:
+        """
+        Записывает буфер (или только записи user_id) пакетами bulk_write.
+        """
+        async with self._lock:
+            if user_id is None:
+                batch, self._pending = self._pending, {}
+            else:
+                writes = self._pending.pop(user_id, None)
+                batch = {user_id: writes} if writes else {}
+            if not batch:
+                return
+            self._pending_messages = sum(len(w["messages"]) for w in self._pending.values())
+            self._inflight = batch
+            started = time.monotonic()
+            try:
+                await self._write(batch)
+            except Exception as e:
+                self.errors += 1
+                print(f"[write_buffer] Flush failed, {len(batch)} users requeued: {type(e).__name__}: {e}")
+                for uid, writes in batch.items():
+                    newer = self._pending.get(uid)
+                    self._pending[uid] = _merge(writes, newer) if newer else writes
+                self._pending_messages = sum(len(w["messages"]) for w in self._pending.values())
+                return
+            finally:
+                self._inflight = {}
+            elapsed_ms = (time.monotonic() - started) * 1000
+            self.flush_max_ms = round(max(self.flush_max_ms, elapsed_ms), 1)
+            self.flushes += 1
+
+    async def _write(self, batch: Dict[int, Dict[str, Any]]) -> None:
+        user_ops = [UpdateOne({"telegram_id": uid}, {"$set": w["user"]}) for uid, w in batch.items() if w["user"]]
+        # $max: отложенная запись не откатывает updated_at, записанный позже синхронно
+        conversation_ops = [
+            UpdateOne({"user_id": uid}, {"$max": {"updated_at": w["touch"]}}) for uid, w in batch.items() if w["touch"]
+        ]
+        message_ops = [InsertOne(doc) for w in batch.values() for doc in w["messages"]]
+        writes = []
+        if user_ops:
+            writes.append(users.bulk_write(user_ops, ordered=False))
+        if conversation_ops:
+            writes.append(conversations.bulk_write(conversation_ops, ordered=False))
+        if message_ops:
+            writes.append(messages.bulk_write(message_ops, ordered=False))
+        results = await asyncio.gather(*writes, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException) and not _duplicates_only(result):
+                # Все операции идемпотентны ($set, $max, вставка с _id) — пакет можно повторить целиком
+                raise result
+        self.flushed_updates += len(user_ops) + len(conversation_ops)
+        self.flushed_messages += len(message_ops)
+
+    async def discard_user(self, telegram_id: int) -> None:
+        """
+        Отбрасывает записи пользователя (удаление данных); пишущийся пакет дожидается.
+        """
+        async with self._lock:
+            writes = self._pending.pop(telegram_id, None)
+            if writes:
+                self._pending_messages -= len(writes["messages"])
+
+    async def _loop(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self) -> None:
+        if self._enabled and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        """
+        Остановка приложения: цикл сброса останавливается, остаток буфера записывается.
+        """
+        if self._task is None:
+            return
+        # Без cancel: пакет, который пишется сейчас, не должен оборваться
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        await self.flush()
+        if self._pending:
+            print(f"[write_buffer] {len(self._pending)} users' writes were not flushed on shutdown")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "pending_users": len(self._pending),
+            "pending_messages": self._pending_messages,
+            "buffered_writes": self.buffered_writes,
+            "flushes": self.flushes,
+            "flushed_messages": self.flushed_messages,
+            "flushed_updates": self.flushed_updates,
+            "errors": self.errors,
+            "flush_max_ms": self.flush_max_ms,
+        }
+
+
+write_buffer = WriteBuffer(
+    enabled=settings.WRITE_BEHIND_ENABLED,
+    flush_interval=settings.WRITE_BEHIND_FLUSH_INTERVAL,
+    max_batch=settings.WRITE_BEHIND_MAX_BATCH,
+)
@@ -1,10 +1,43 @@
+import time
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import PlainTextResponse
 from aiogram.types import Update
 
 from app.config import settings
 from app.telegram_bot.bot import bot, dp
-from app.db.mongo import users, conversations
+from app.telegram_bot.update_queue import update_queue
+from app.telegram_bot.debounce import debouncer
+from app.telegram_bot.dedup import update_dedup
+from app.telegram_bot.sender import telegram_sender
+from app.db.mongo import mongo_client
+from app.db.cache import user_cache
+from app.db.repository import ensure_indexes
+from app.db.locks import cluster_locks
+from app.db.write_buffer import write_buffer
+from app.db.archive import archiver
+from app.agent.llm import close_llm_client, llm_stats
+from app.agent.tools.prompt_loader import prompt_registry
+from app.agent.fast_paths import rule_stats
+from app.agent.engine import engine_stats
+from app.agent.survey_extraction import extraction_stats
+from app.agent.routing import routing_stats
+from app.agent.resilience import resilience_stats
+from app.agent.rate_limiter import rate_limiter
+from app.agent.response_cache import response_cache
+from app.metrics import gauge, render_metrics, webhook_seconds
+from app.tracing import recent_traces, trace_update
+
+gauge("bot_update_queue_depth", "Updates accepted but not yet processed", lambda: update_queue.stats()["depth"])
+gauge("bot_telegram_send_backlog", "Outgoing Telegram messages waiting in chat queues", lambda: telegram_sender.backlog)
+gauge("bot_write_buffer_pending_messages", "Messages buffered for the next bulk write", lambda: write_buffer.stats()["pending_messages"])
+gauge("bot_user_cache_size", "Users in the in-process state cache", lambda: user_cache.stats()["size"])
+gauge(
+    "bot_llm_rate_limiter_queue_depth",
+    "LLM requests waiting for RPM/TPM quota",
+    lambda: rate_limiter.stats()["queue_depth"],
+    ["model"],
+)
 
 
 WEBHOOK_PATH = f"/api/telegram/{settings.TG_BOT_TOKEN}"
@@ -15,31 +48,66 @@ def build_webhook_url() -> str:
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # === Индексы БД (выполнятся один раз, если их ещё нет) ===
-    try:
-        users.create_index("telegram_id", unique=True, name="uniq_telegram_id")
-        conversations.create_index("user_id", unique=True, name="uniq_user_id")
-        conversations.create_index("updated_at", name="idx_updated_at")
-    except Exception as e:
-        print(f"[WARN] Index creation skipped/error: {e}")
-        
-    # Ставит вебхук при старте приложения
-    await bot.set_webhook(
-        url=build_webhook_url(),
-        secret_token=settings.WEBHOOK_SECRET,  # Telegram пришлёт этот токен в заголовке
-        allowed_updates=dp.resolve_used_update_types(),
-    )
+    # Разовые задачи запуска: в CLUSTER_MODE их выполняет только воркер, взявший lease лидера
+    leader = await cluster_locks.try_leadership("startup", ttl=settings.LEADER_LEASE_TTL)
+    if leader:
+        # === Индексы БД (выполнятся один раз, если их ещё нет) ===
+        try:
+            await ensure_indexes()
+        except Exception as e:
+            print(f"[WARN] Index creation skipped/error: {e}")
+
+    # Отложенные записи (лог сообщений, updated_at, last_seen_at) пакетами bulk_write
+    write_buffer.start()
+    # Перенос истории завершённых и брошенных диалогов в сжатый архив
+    archiver.start()
+    if settings.UPDATE_PROCESSING_MODE == "queue":
+        update_queue.start()
+
+    if leader:
+        # Ставит вебхук при старте приложения
+        await bot.set_webhook(
+            url=build_webhook_url(),
+            secret_token=settings.WEBHOOK_SECRET,  # Telegram пришлёт этот токен в заголовке
+            allowed_updates=dp.resolve_used_update_types(),
+        )
     try:
         yield
     finally:
-        # Снимаем вебхук и закрываем HTTP‑сессию бота
-        await bot.delete_webhook(drop_pending_updates=False)
+        if not settings.CLUSTER_MODE:
+            # Снимаем вебхук (в кластере его не трогаем: остальные воркеры продолжают работать)
+            await bot.delete_webhook(drop_pending_updates=False)
+        # Дообрабатываем уже принятые апдейты
+        await update_queue.stop()
+        # Отложенные ходы пачек сообщений выполняются сразу
+        await debouncer.drain(settings.UPDATE_QUEUE_DRAIN_TIMEOUT)
+        await archiver.stop()
+        # Все отложенные записи уходят в Mongo до закрытия клиента
+        await write_buffer.stop()
+        # Досылаем ответы, ждущие в очередях чатов
+        await telegram_sender.drain(settings.UPDATE_QUEUE_DRAIN_TIMEOUT)
         await bot.session.close()
+        await close_llm_client()
+        await mongo_client.close()
 
 app = FastAPI(title="AI Business Buddy - Telegram Webhook (lifespan)", lifespan=lifespan)
 
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request):
+    started = time.perf_counter()
+    status = 200
+    try:
+        return await _handle_webhook(request)
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    except Exception:
+        status = 500
+        raise
+    finally:
+        webhook_seconds.observe(time.perf_counter() - started, mode=settings.UPDATE_PROCESSING_MODE, status=status)
+
+async def _handle_webhook(request: Request):
     # Валидируем секрет из заголовка Telegram
     secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token")
     if secret != settings.WEBHOOK_SECRET:
@@ -47,10 +115,56 @@ async def telegram_webhook(request: Request):
 
     # Преобразуем JSON в aiogram Update и передаём в диспетчер
     update = Update.model_validate(await request.json())
-    await dp.feed_webhook_update(bot, update)
+    # Повторная доставка уже принятого апдейта — подтверждаем, но не обрабатываем
+    if not await update_dedup.claim(update.update_id):
+        return {"ok": True}
+    if settings.UPDATE_PROCESSING_MODE == "queue":
+        # Быстрый ответ Telegram: обработка идёт в фоне, по порядку для каждого пользователя
+        if not update_queue.submit(update):
+            # Очередь переполнена — Telegram доставит апдейт повторно
+            await update_dedup.release(update.update_id)
+            raise HTTPException(status_code=503, detail="Update queue is full")
+        return {"ok": True}
+    # Ошибка обработчика отметку не снимает: пользователь уже получил сообщение об ошибке,
+    # а повтор записал бы сообщение в историю второй раз
+    with trace_update(update.update_id, "webhook"):
+        await dp.feed_webhook_update(bot, update)
     return {"ok": True}
 
 # Для быстрой проверки, что API живо
 @app.get("/api/health")
 async def root():
-    return {"status": "ok", "webhook": build_webhook_url()}
\ No newline at end of file
+    return {"status": "ok", "webhook": build_webhook_url()}
+
+# Метрики Prometheus: задержки вебхука, Mongo, LLM, Telegram и токены
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+# Последние trace'ы апдейтов (при TRACE_SAMPLE_RATE > 0)
+@app.get("/api/traces")
+async def traces(limit: int = 50):
+    return {"traces": recent_traces(limit)}
+
+# Состояние внутренних очередей и счётчики для мониторинга
+@app.get("/api/stats")
+async def stats():
+    return {
+        "update_queue": update_queue.stats(),
+        "update_dedup": update_dedup.stats(),
+        "debounce": debouncer.stats(),
+        "telegram_sender": telegram_sender.stats(),
+        "write_buffer": write_buffer.stats(),
+        "archive": archiver.stats(),
+        "user_cache": user_cache.stats(),
+        "cluster_locks": cluster_locks.stats(),
+        "llm": llm_stats(),
+        "llm_routes": routing_stats(),
+        "llm_resilience": resilience_stats,
+        "llm_rate_limiter": rate_limiter.stats(),
+        "response_cache": response_cache.stats(),
+        "prompts": {"versions": prompt_registry.versions(), "reloads": prompt_registry.reloads},
+        "fast_paths": rule_stats,
+        "stage_engine": engine_stats,
+        "survey_extraction": extraction_stats,
+    }
@@ -0,0 +1,190 @@
+"""
+Метрики в формате Prometheus (text exposition 0.0.4) для /metrics: счётчики, гистограммы
+задержек и gauge'и, значения которых считываются при каждом запросе.
+Без внешних зависимостей: значения хранятся в памяти процесса (в CLUSTER_MODE каждый воркер
+отдаёт свои метрики).
+"""
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(ABC):
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    @abstractmethod
+    def render(self) -> List[str]:
+        ...
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # label values -> [counts по бакетам..., sum, count]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[i] += 1
+                break
+        state[-2] += value
+        state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, state in sorted(self._values.items()):
+            cumulative = 0
+            for i, bound in enumerate(self.buckets):
+                cumulative += state[i]
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{labels} {state[-1]}")
+        return lines
+
+
+class Gauge(_Metric):
+    """
+    Значение считывается функцией при отдаче /metrics: число или {кортеж значений меток: число}.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], Any], labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._read = read
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        try:
+            value = self._read()
+        except Exception as e:
+            print(f"[metrics] Gauge {self.name} failed: {type(e).__name__}: {e}")
+            return lines
+        if isinstance(value, dict):
+            for key, v in sorted(value.items()):
+                key = key if isinstance(key, tuple) else (key,)
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {_format_value(v)}")
+        else:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+
+_registry: Dict[str, _Metric] = {}
+
+
+def _register(metric: _Metric) -> Any:
+    _registry[metric.name] = metric
+    return metric
+
+
+def counter(name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+    return _register(Counter(name, documentation, labels))
+
+
+def histogram(name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, documentation, labels, buckets))
+
+
+def gauge(name: str, documentation: str, read: Callable[[], Any], labels: Sequence[str] = ()) -> Gauge:
+    return _register(Gauge(name, documentation, read, labels))
+
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in _registry.values():
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# === Метрики хода: вебхук → Mongo → LLM → Telegram ===
+
+webhook_seconds = histogram(
+    "bot_webhook_request_seconds", "Time to handle a Telegram webhook request", ["mode", "status"]
+)
+update_seconds = histogram(
+    "bot_update_processing_seconds", "Time to process one update in the dispatcher (queue workers)", ["outcome"]
+)
+mongo_seconds = histogram(
+    "bot_mongo_command_seconds", "MongoDB command latency", ["command", "collection", "outcome"]
+)
+llm_seconds = histogram(
+    "bot_llm_call_seconds", "LLM call latency per route (stage) and model, including retries and fallback",
+    ["route", "model", "outcome"],
+)
+llm_tokens = counter("bot_llm_tokens_total", "LLM tokens from response usage", ["route", "model", "kind"])
+telegram_seconds = histogram(
+    "bot_telegram_request_seconds", "Telegram Bot API request latency", ["method", "outcome"]
+)
+telegram_delivery_seconds = histogram(
+    "bot_telegram_delivery_seconds",
+    "Outgoing message delivery time from enqueue to Bot API response, including flood-control waits",
+    ["method", "outcome"],
+)
@@ -1,12 +1,48 @@
+import time
+
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
 from app.config import settings
+from app.metrics import telegram_seconds
+from app.tracing import record_span
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """
+    Задержка каждого запроса к Bot API (sendMessage, editMessageText, ...) в метриках и trace.
+    """
 
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            name = getattr(method, "__api_method__", type(method).__name__)
+            telegram_seconds.observe(elapsed, method=name, outcome=outcome)
+            record_span(f"telegram.{name}", elapsed, outcome=outcome)
+
+
+# Одна сессия с пулом keep-alive соединений на все запросы к Bot API
+session = AiohttpSession(
+    api=TelegramAPIServer.from_base(settings.TG_API_BASE_URL) if settings.TG_API_BASE_URL else PRODUCTION,
+    limit=settings.TG_MAX_CONNECTIONS,
+    timeout=settings.TG_REQUEST_TIMEOUT,
+)
 bot = Bot(
     token=settings.TG_BOT_TOKEN,
+    session=session,
     default=DefaultBotProperties(parse_mode=ParseMode.HTML),
 )
+bot.session.middleware(TelegramMetricsMiddleware())
 dp = Dispatcher()
 
 # Импорт обработчиков, чтобы они зарегистрировались
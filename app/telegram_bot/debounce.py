@@ -0,0 +1,144 @@
+"""
+Склейка «пачек» сообщений пользователя в один ход агента.
+Каждое сообщение сохраняется сразу, а ход агента откладывается таймером пользователя на
+MESSAGE_DEBOUNCE_WINDOW: новое сообщение пачки переносит таймер и заменяет ход своим, так что
+агент отвечает один раз — на последнее сообщение, видя всю пачку в истории этапа.
+Обработчик апдейта не ждёт ни таймер, ни идущий ход пользователя (ingest без блокировки
+пользователя; в CLUSTER_MODE — под ней): воркер очереди апдейтов сразу свободен для других.
+Ход откладывается не дольше MESSAGE_DEBOUNCE_MAX_DELAY от первого сообщения пачки; при
+MESSAGE_DEBOUNCE_WINDOW=0 ход выполняется сразу в обработчике.
+"""
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from app.config import settings
+from app.tracing import Trace, current_trace, resume_trace
+
+
+@dataclass
+class _Burst:
+    started: float
+    deadline: float
+    turn: Callable[[], Awaitable[Any]]
+    # Trace апдейта, на который будет дан ответ (последнее сообщение пачки)
+    trace: Optional[Trace] = field(default_factory=current_trace)
+    size: int = 1
+    running: bool = False
+    wakeup: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+class MessageDebouncer:
+    def __init__(self, window: float, max_delay: float, pending_for: Optional[Callable[[int], int]] = None):
+        self._window = window
+        self._max_delay = max_delay
+        self._pending_for = pending_for
+        self._bursts: Dict[int, _Burst] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._draining = False
+        self.messages = 0
+        self.turns = 0
+        self.calls_avoided = 0
+        self.max_burst = 0
+        self.errors = 0
+        self.wait_total_ms = 0.0
+
+    async def submit(self, telegram_id: int, turn: Callable[[], Awaitable[Any]]) -> None:
+        """
+        Ход агента на сообщение пользователя: сразу (окно 0) или по таймеру пачки.
+        """
+        self.messages += 1
+        if self._window <= 0 or self._draining:
+            self.turns += 1
+            await turn()
+            return
+        now = time.monotonic()
+        burst = self._bursts.get(telegram_id)
+        if burst is not None and not burst.running:
+            # Сообщение продолжает пачку: ход предыдущего сообщения не нужен
+            self.calls_avoided += 1
+            burst.size += 1
+            burst.turn = turn
+            burst.trace = current_trace()
+            burst.deadline = min(now + self._window, burst.started + self._max_delay)
+            burst.wakeup.set()
+            return
+        # Новая пачка (ход прошлой уже идёт — он ждёт блокировку пользователя вместе с этим)
+        burst = _Burst(started=now, deadline=now + self._window, turn=turn)
+        self._bursts[telegram_id] = burst
+        task = asyncio.create_task(self._run(telegram_id, burst))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, telegram_id: int, burst: _Burst) -> None:
+        while not self._draining:
+            wait = burst.deadline - time.monotonic()
+            if wait <= 0:
+                overdue = time.monotonic() - burst.started >= self._max_delay
+                if overdue or not (self._pending_for and self._pending_for(telegram_id)):
+                    break
+                # Следующее сообщение пользователя уже в очереди апдейтов — дождёмся его
+                wait = min(self._window, burst.started + self._max_delay - time.monotonic())
+                burst.deadline = time.monotonic() + wait
+            burst.wakeup.clear()
+            try:
+                await asyncio.wait_for(burst.wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+        burst.running = True
+        self.turns += 1
+        self.max_burst = max(self.max_burst, burst.size)
+        self.wait_total_ms = round(self.wait_total_ms + (time.monotonic() - burst.started) * 1000, 1)
+        try:
+            with resume_trace(burst.trace):
+                await burst.turn()
+        except Exception:
+            # Ошибку хода уже залогировал и сообщил пользователю обработчик
+            self.errors += 1
+        finally:
+            if self._bursts.get(telegram_id) is burst:
+                del self._bursts[telegram_id]
+
+    async def drain(self, timeout: float) -> None:
+        """
+        Остановка приложения: отложенные ходы выполняются сразу, не дольше timeout.
+        """
+        self._draining = True
+        for burst in self._bursts.values():
+            burst.wakeup.set()
+        if not self._tasks:
+            return
+        done, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            print(f"[debounce] Drain timeout: {len(pending)} turns cancelled")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_s": self._window,
+            "messages": self.messages,
+            "turns": self.turns,
+            "llm_calls_avoided": self.calls_avoided,
+            "max_burst": self.max_burst,
+            "errors": self.errors,
+            "wait_total_ms": self.wait_total_ms,
+            "bursts_in_progress": len(self._bursts),
+        }
+
+
+def _queued_messages(telegram_id: int) -> int:
+    if settings.UPDATE_PROCESSING_MODE != "queue":
+        return 0
+    # Локальный импорт: update_queue -> bot -> handlers -> debounce
+    from app.telegram_bot.update_queue import update_queue
+
+    return update_queue.pending_for(telegram_id)
+
+
+debouncer = MessageDebouncer(
+    window=settings.MESSAGE_DEBOUNCE_WINDOW,
+    max_delay=settings.MESSAGE_DEBOUNCE_MAX_DELAY,
+    pending_for=_queued_messages,
+)
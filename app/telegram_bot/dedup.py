@@ -0,0 +1,90 @@
+"""
+Идемпотентная обработка вебхука: каждый update_id обрабатывается не больше одного раза.
+Telegram повторяет доставку, если вебхук ответил медленно или с ошибкой; повтор отбрасывается
+до диспетчера. Хранилище — в памяти процесса (одна реплика) или коллекция processed_updates
+с TTL-индексом (UPDATE_DEDUP_BACKEND=mongo, несколько реплик).
+"""
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict
+
+from app.config import settings
+from app.db import repository
+
+
+class UpdateDeduplicator:
+    def __init__(self, backend: str, ttl: float, max_size: int):
+        self._backend = backend
+        self._ttl = ttl
+        self._max_size = max_size
+        self._seen: "OrderedDict[int, float]" = OrderedDict()
+        self.accepted = 0
+        self.duplicates = 0
+        self.released = 0
+        self.store_errors = 0
+
+    def _claim_local(self, update_id: int) -> bool:
+        now = time.monotonic()
+        # Записи добавляются по времени, поэтому просроченные — в начале
+        while self._seen and next(iter(self._seen.values())) < now:
+            self._seen.popitem(last=False)
+        if update_id in self._seen:
+            return False
+        self._seen[update_id] = now + self._ttl
+        while len(self._seen) > self._max_size:
+            self._seen.popitem(last=False)
+        return True
+
+    async def claim(self, update_id: int) -> bool:
+        """
+        True — апдейт видим впервые и его нужно обработать; False — повторная доставка.
+        """
+        if self._backend == "mongo":
+            expires_at = datetime.now(timezone.utc) + timedelta(seconds=self._ttl)
+            try:
+                fresh = await repository.mark_update_seen(update_id, expires_at)
+            except Exception as e:
+                # Хранилище недоступно — лучше обработать апдейт, чем потерять его
+                self.store_errors += 1
+                print(f"[dedup] Store error for update_id={update_id}: {type(e).__name__}: {e}")
+                fresh = self._claim_local(update_id)
+        else:
+            fresh = self._claim_local(update_id)
+        if fresh:
+            self.accepted += 1
+        else:
+            self.duplicates += 1
+            print(f"[dedup] Dropped redelivered update_id={update_id}")
+        return fresh
+
+    async def release(self, update_id: int) -> None:
+        """
+        Снимает отметку, если апдейт не был обработан (ошибка, переполненная очередь) —
+        повторная доставка Telegram должна пройти.
+        """
+        self.released += 1
+        self._seen.pop(update_id, None)
+        if self._backend == "mongo":
+            try:
+                await repository.unmark_update_seen(update_id)
+            except Exception as e:
+                self.store_errors += 1
+                print(f"[dedup] Release error for update_id={update_id}: {type(e).__name__}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self._backend,
+            "tracked_local": len(self._seen),
+            "accepted": self.accepted,
+            "dropped_redeliveries": self.duplicates,
+            "released": self.released,
+            "store_errors": self.store_errors,
+        }
+
+
+update_dedup = UpdateDeduplicator(
+    backend=settings.UPDATE_DEDUP_BACKEND,
+    ttl=settings.UPDATE_DEDUP_TTL,
+    max_size=settings.UPDATE_DEDUP_MAX_SIZE,
+)
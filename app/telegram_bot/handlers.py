@@ -1,10 +1,27 @@
 from aiogram.types import Message
-from app.db.mongo import users, conversations
-from app.agent.chain import generate_greet_and_lang_agent_reply, generate_profile_agent_reply, generate_survey_agent_reply, generate_summary_agent_reply
+from app.config import settings
+from app.db import repository
+from app.db.locks import cluster_locks
+from app.telegram_bot.streaming import StreamingReply
+from app.telegram_bot.sender import telegram_sender
+from app.telegram_bot.debounce import debouncer
+from app.agent.fast_paths import run_fast_paths
+from app.agent.engine import run_turn
+from app.agent.rate_limiter import LLMOverloaded
+import asyncio
+import functools
 import html
 import json
 from datetime import datetime, timezone
-from typing import Tuple, Dict, Any
+from typing import Tuple, Dict, Any, List
+from bson import ObjectId
+
+ERROR_REPLY = "⚠️ Sorry, something went wrong. Please try again in a moment."
+TIMEOUT_REPLY = "⚠️ Sorry, the assistant is taking too long to respond. Please try again in a moment."
+BUSY_REPLY = "⚠️ Sorry, we are receiving too many messages right now. Please try again in a minute."
+
+# Сообщения, записанные без блокировки пользователя (не CLUSTER_MODE): telegram_id -> [(_id, stage)]
+_ingested: Dict[int, List[Tuple[ObjectId, str]]] = {}
 
 def _extract_text(message: Message) -> str:
     # Универсально тянем текст из text/caption, иначе пусто
@@ -13,6 +30,15 @@ def _extract_text(message: Message) -> str:
 def _now_utc():
     return datetime.now(timezone.utc)
 
+def _pending_user_text(conversation_doc: Dict[str, Any], fallback: str) -> str:
+    # Все сообщения пользователя после последнего ответа ассистента (склеенная пачка)
+    parts = []
+    for m in reversed(conversation_doc.get("messages", [])):
+        if m.get("role") != "user":
+            break
+        parts.append(str(m.get("text") or ""))
+    return "\n".join(reversed(parts)) or fallback
+
 async def _upsert_user_and_push_user_message(message: Message) -> Tuple[Dict[str, Any], Dict[str, Any]]:
     now = _now_utc()
     u = message.from_user
@@ -26,82 +52,51 @@ async def _upsert_user_and_push_user_message(message: Message) -> Tuple[Dict[str
     language_code = getattr(u, "language_code", None)
     text = _extract_text(message)
 
-    # Получаем текущий stage (по умолчанию language)
-    conv = conversations.find_one({"user_id": telegram_id}, {"stage": 1})
-    stage = conv.get("stage") if conv and "stage" in conv else "language"
-
-    # USERS: создаём при первом появлении и обновляем на каждый апдейт
-    users.update_one(
-        {"telegram_id": telegram_id},
-        {
-            "$setOnInsert": {
-                "telegram_id": telegram_id,
-                "created_at": now,
-            },
-            "$set": {
-                "first_name": first_name,
-                "last_name": last_name,
-                "username": username,
-                "language_code": language_code,
-                "last_message_at": now,
-                "last_message_text": text,
-                "last_seen_at": now,
-            },
+    # USERS + CONVERSATIONS: upsert пользователя и push входящего сообщения.
+    # В CLUSTER_MODE — под блокировкой пользователя: stage из кэша процесса актуален только после
+    # сверки владельца lock. В одном процессе ingest не ждёт идущий ход: сообщение, записанное
+    # со stage, который этот ход сменил, переносит в новый этап следующий ход (_restamp_ingested)
+    ingest = functools.partial(
+        repository.record_user_message,
+        telegram_id,
+        user_fields={
+            "first_name": first_name,
+            "last_name": last_name,
+            "username": username,
+            "language_code": language_code,
+            "last_message_at": now,
+            "last_message_text": text,
+            "last_seen_at": now,
         },
-        upsert=True,
-    )
-    user_doc = users.find_one({"telegram_id": telegram_id}, {"_id": 0}) or {}
-
-    # CONVERSATIONS: создаём запись диалога (без поля messages в $setOnInsert!) и пушим входящий месседж
-    conversations.update_one(
-        {"user_id": telegram_id},
-        {
-            "$setOnInsert": {
-                "user_id": telegram_id,
-                "created_at": now,
-                "title": f"Dialog with {username or first_name or telegram_id}",
-            },
-            "$push": {
-                "messages": {
-                    "role": "user",
-                    "text": text,
-                    "ts": now,
-                    "message_id": message.message_id,
-                    "chat_id": message.chat.id if message.chat else None,
-                    "stage": stage,
-                }
-            },
-            "$set": {"updated_at": now},
+        message={
+            "text": text,
+            "message_id": message.message_id,
+            "chat_id": message.chat.id if message.chat else None,
         },
-        upsert=True,
+        title=f"Dialog with {username or first_name or telegram_id}",
     )
-    conversation_doc = conversations.find_one({"user_id": telegram_id}, {"_id": 0}) or {}
+    if settings.CLUSTER_MODE:
+        async with cluster_locks.user_lock(telegram_id):
+            return await ingest()
+    user_doc, conversation_doc = await ingest()
+    _ingested.setdefault(telegram_id, []).append((conversation_doc["message_id"], conversation_doc["stage"]))
     return user_doc, conversation_doc
 
+async def _restamp_ingested(telegram_id: int) -> None:
+    # Вызывается под блокировкой пользователя: stage в кэше актуален
+    ingested = _ingested.pop(telegram_id, [])
+    if not ingested:
+        return
+    stage = await repository.get_stage(telegram_id)
+    stale = [message_id for message_id, message_stage in ingested if message_stage != stage]
+    if stale:
+        await repository.restamp_messages(telegram_id, stale, stage)
+
 async def _delete_user_and_conversation(telegram_id: int):
-    users.delete_one({"telegram_id": telegram_id})
-    conversations.delete_one({"user_id": telegram_id})
+    await repository.delete_user_data(telegram_id)
 
-def _push_assistant_message(user_id: int, text: str):
-    now = _now_utc()
-    # Получаем текущий stage (по умолчанию language)
-    conv = conversations.find_one({"user_id": user_id}, {"stage": 1})
-    stage = conv.get("stage") if conv and "stage" in conv else "language"
-    conversations.update_one(
-        {"user_id": user_id},
-        {
-            "$push": {
-                "messages": {
-                    "role": "assistant",
-                    "text": text,
-                    "ts": now,
-                    "stage": stage,
-                }
-            },
-            "$set": {"updated_at": now},
-        },
-        upsert=True,  # на всякий случай (если конкурентно создаётся)
-    )
+async def _push_assistant_message(user_id: int, text: str):
+    await repository.append_assistant_message(user_id, text)
 
 from app.telegram_bot.bot import dp
 try:
@@ -113,40 +108,86 @@ except ImportError:
 async def on_reset_command(message: Message):
     u = message.from_user
     if not u:
-        await message.answer("Пользователь не найден.")
+        telegram_sender.send_message_nowait(message.chat.id, "Пользователь не найден.")
         if CancelHandler:
             raise CancelHandler()
         return
     telegram_id = u.id
-    await _delete_user_and_conversation(telegram_id)
-    await message.answer("Your data has been reset. The conversation will start over. Send any message to start.")
+    async with cluster_locks.user_lock(telegram_id):
+        await _delete_user_and_conversation(telegram_id)
+    telegram_sender.send_message_nowait(message.chat.id, "Your data has been reset. The conversation will start over. Send any message to start.")
     if CancelHandler:
         raise CancelHandler()
     return
 
+def _reply_error(message: Message, e: Exception) -> None:
+    # Подробности — только в лог; пользователю короткое сообщение без деталей исключения
+    print(f"[BOT ERROR] {type(e).__name__}: {e}")
+    if isinstance(e, LLMOverloaded):
+        telegram_sender.send_message_nowait(message.chat.id, BUSY_REPLY)
+    elif isinstance(e, asyncio.TimeoutError):
+        telegram_sender.send_message_nowait(message.chat.id, TIMEOUT_REPLY)
+    else:
+        telegram_sender.send_message_nowait(message.chat.id, ERROR_REPLY)
+
 @dp.message()
 async def on_any_message(message: Message):
     try:
         # 1) Сохраняем пользователя и входящее сообщение
-        user_doc, conversation_doc = await _upsert_user_and_push_user_message(message)
-        stage = conversation_doc.get("stage", "language")
-        if stage == "language":
-            agent_reply = await generate_greet_and_lang_agent_reply(user_doc, conversation_doc)
-        elif stage == "profile":
-            agent_reply = await generate_profile_agent_reply(user_doc, conversation_doc)
-        elif stage == "survey":
-            agent_reply = await generate_survey_agent_reply(user_doc, conversation_doc)
-        elif stage == "summary":
-            agent_reply = await generate_summary_agent_reply(user_doc, conversation_doc)
-        elif stage == "final":
-            # Always reply with the saved final_message in user's preferred language
-            agent_reply = user_doc.get("final_message") or "You are in the queue for the service, we will contact you."
+        user_doc, _ = await _upsert_user_and_push_user_message(message)
+    except Exception as e:
+        _reply_error(message, e)
+        raise
+    if not user_doc:
+        return
+    turn = functools.partial(_answer, message, user_doc)
+    if _extract_text(message).startswith("/"):
+        await turn()
+        return
+    # Пачка быстрых сообщений — один ход: ход откладывается таймером пользователя и
+    # заменяется ходом следующего сообщения пачки, воркер апдейтов при этом не ждёт
+    await debouncer.submit(user_doc["telegram_id"], turn)
+
+async def _answer(message: Message, user_doc: Dict[str, Any]):
+    telegram_id = user_doc["telegram_id"]
+    text = _extract_text(message)
+    try:
+        # Ход пользователя выполняется эксклюзивно (в CLUSTER_MODE — между воркерами и репликами)
+        async with cluster_locks.user_lock(telegram_id):
+            # Состояние перечитываем под блокировкой: за время ожидания в историю могли добавиться
+            # сообщения пачки, а предыдущий ход (или другой воркер) — сменить этап
+            await _restamp_ingested(telegram_id)
+            user_doc = await repository.get_user(telegram_id) or user_doc
+            conversation_doc = await repository.get_conversation(telegram_id)
+            history = conversation_doc.get("messages", [])
+            if not history or history[-1].get("role") != "user":
+                # Сообщение уже обработано предыдущим ходом (своего или другого воркера)
+                return
+            stage = conversation_doc.get("stage", "language")
+            if not text.startswith("/"):
+                text = _pending_user_text(conversation_doc, text)
+            # 2) Детерминированные правила: часть ходов закрывается без LLM
+            fast = await run_fast_paths(stage, user_doc, conversation_doc, text)
+            if fast and fast.next_stage:
+                # Правило сменило этап — дальше отвечает агент нового этапа
+                stage = fast.next_stage
+                user_doc = await repository.get_user(telegram_id) or user_doc
+                conversation_doc = await repository.get_conversation(telegram_id)
+            # 3) Стриминг: первое предложение уходит сразу, дальше сообщение дописывается правками
+            streamer = StreamingReply(message) if settings.STREAM_REPLIES else None
+            on_text = streamer.on_text if streamer else None
+            if fast and fast.reply is not None:
+                agent_reply = fast.reply
+            else:
+                # 4) Движок этапов: агент этапа и переходы между этапами в пределах одного хода
+                agent_reply = await run_turn(stage, user_doc, conversation_doc, on_text=on_text)
+            await _push_assistant_message(telegram_id, agent_reply)
+        if streamer:
+            await streamer.finalize(agent_reply)
         else:
-            agent_reply = "Что бы вы хотели обсудить?"
-        _push_assistant_message(user_doc["telegram_id"], agent_reply)
-        safe_reply = html.escape(agent_reply)
-        await message.answer(safe_reply)
+            safe_reply = html.escape(agent_reply)
+            # Доставка идёт в очереди чата: обработчик не ждёт flood control Telegram
+            telegram_sender.send_message_nowait(message.chat.id, safe_reply)
     except Exception as e:
-        print(f"[BOT ERROR] {type(e).__name__}: {e}")
-        await message.answer(f"⚠️ Error: <code>{type(e).__name__}: {str(e)}</code>")
+        _reply_error(message, e)
         raise
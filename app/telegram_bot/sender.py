@@ -0,0 +1,216 @@
+"""
+Исходящие сообщения бота (sendMessage, editMessageText) через очередь с учётом лимитов Bot API:
+- в чат — по порядку и не чаще одного сообщения в TG_SEND_CHAT_INTERVAL секунд;
+- всего — не больше TG_SEND_GLOBAL_PER_SECOND сообщений в секунду;
+- 429 Too Many Requests: ждём retry_after (до TG_SEND_MAX_RETRY_AFTER) и повторяем,
+  сетевые ошибки и 5xx — повтор с backoff, до TG_SEND_MAX_RETRIES раз.
+Ответ не теряется, если Telegram притормозил бота во время всплеска: отправка ждёт в очереди
+чата, а обработчик апдейта не блокируется (send_message_nowait).
+"""
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+from app.config import settings
+from app.metrics import telegram_delivery_seconds
+from app.telegram_bot.bot import bot
+from app.tracing import Trace, current_trace, resume_trace
+
+# Backoff для сетевых ошибок и 5xx
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 5.0
+# Сколько чатов держать в памяти до чистки истёкших интервалов
+CHAT_STATE_MAX_SIZE = 10000
+
+
+@dataclass
+class _Send:
+    chat_id: int
+    method: str
+    call: Callable[[], Awaitable[Any]]
+    future: asyncio.Future
+    # Trace апдейта, поставившего отправку: воркер чата общий для апдейтов и переживает их обработку
+    trace: Optional[Trace] = field(default_factory=current_trace)
+    enqueued: float = field(default_factory=time.monotonic)
+    attempts: int = 0
+
+
+class TelegramSender:
+    def __init__(self, global_per_second: float, chat_interval: float, max_retries: int, max_retry_after: float):
+        self._global_interval = 1.0 / global_per_second if global_per_second > 0 else 0.0
+        self._chat_interval = chat_interval
+        self._max_retries = max_retries
+        self._max_retry_after = max_retry_after
+        self._global_next = 0.0
+        self._chat_next: Dict[int, float] = {}
+        self._chats: Dict[int, Deque[_Send]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.retry_after_hits = 0
+        self.retry_after_total_s = 0.0
+        self.max_backlog = 0
+        self.latency_total_ms = 0.0
+        self.latency_max_ms = 0.0
+
+    # === Публичный API ===
+
+    async def send_message(self, chat_id: int, text: str, **kwargs: Any) -> Any:
+        """
+        Отправка в очередь чата; возвращает Message после доставки (нужен для последующих правок).
+        """
+        return await self._submit(chat_id, "sendMessage", lambda: bot.send_message(chat_id, text, **kwargs))
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str, **kwargs: Any) -> Any:
+        return await self._submit(
+            chat_id,
+            "editMessageText",
+            lambda: bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs),
+        )
+
+    def send_message_nowait(self, chat_id: int, text: str, **kwargs: Any) -> asyncio.Future:
+        """
+        Отправка без ожидания доставки: порядок в чате сохраняется, ошибка доставки — в лог.
+        """
+        future = self._submit(chat_id, "sendMessage", lambda: bot.send_message(chat_id, text, **kwargs))
+        future.add_done_callback(self._log_failure)
+        return future
+
+    async def drain(self, timeout: float) -> None:
+        """
+        Дожидается отправки очередей (остановка приложения); по таймауту оставшееся отменяется.
+        """
+        workers = list(self._workers.values())
+        if not workers:
+            return
+        done, pending = await asyncio.wait(workers, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            print(f"[sender] Drain timeout: {self.backlog} messages not delivered")
+
+    @property
+    def backlog(self) -> int:
+        return sum(len(q) for q in self._chats.values())
+
+    # === Очереди ===
+
+    def _submit(self, chat_id: int, method: str, call: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        queue = self._chats.setdefault(chat_id, deque())
+        queue.append(_Send(chat_id, method, call, future))
+        self.max_backlog = max(self.max_backlog, self.backlog)
+        if len(self._chat_next) > CHAT_STATE_MAX_SIZE:
+            now = time.monotonic()
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._chat_worker(chat_id, queue))
+        return future
+
+    async def _chat_worker(self, chat_id: int, queue: Deque[_Send]) -> None:
+        try:
+            while queue:
+                item = queue[0]
+                if not item.future.cancelled():
+                    await self._deliver(item)
+                queue.popleft()
+        finally:
+            for item in queue:
+                if not item.future.done():
+                    item.future.cancel()
+            self._chats.pop(chat_id, None)
+            self._workers.pop(chat_id, None)
+
+    def _reserve_global(self) -> float:
+        # Слот глобального лимита резервируется сразу: ожидающие отправки не конкурируют за него
+        now = time.monotonic()
+        slot = max(now, self._global_next)
+        self._global_next = slot + self._global_interval
+        return slot - now
+
+    async def _deliver(self, item: _Send) -> None:
+        while True:
+            wait = self._chat_next.get(item.chat_id, 0.0) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            wait = self._reserve_global()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                with resume_trace(item.trace):
+                    result = await item.call()
+            except TelegramRetryAfter as e:
+                self.retry_after_hits += 1
+                if item.attempts >= self._max_retries or e.retry_after > self._max_retry_after:
+                    self._finish(item, "retry_after", error=e)
+                    return
+                item.attempts += 1
+                self.retries += 1
+                self.retry_after_total_s += e.retry_after
+                print(f"[sender] Flood control for chat {item.chat_id}: retry in {e.retry_after}s")
+                self._chat_next[item.chat_id] = time.monotonic() + e.retry_after
+                continue
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if item.attempts >= self._max_retries:
+                    self._finish(item, "error", error=e)
+                    return
+                item.attempts += 1
+                self.retries += 1
+                await asyncio.sleep(min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (item.attempts - 1)))
+                continue
+            except Exception as e:
+                self._finish(item, "error", error=e)
+                return
+            self._chat_next[item.chat_id] = time.monotonic() + self._chat_interval
+            self._finish(item, "ok", result=result)
+            return
+
+    def _finish(self, item: _Send, outcome: str, result: Any = None, error: Optional[Exception] = None) -> None:
+        elapsed = time.monotonic() - item.enqueued
+        telegram_delivery_seconds.observe(elapsed, method=item.method, outcome=outcome)
+        self.latency_total_ms += elapsed * 1000
+        self.latency_max_ms = round(max(self.latency_max_ms, elapsed * 1000), 1)
+        if error is None:
+            self.sent += 1
+        else:
+            self.failed += 1
+        if item.future.done():
+            return
+        if error is None:
+            item.future.set_result(result)
+        else:
+            item.future.set_exception(error)
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            e = future.exception()
+            print(f"[sender] Delivery failed: {type(e).__name__}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        finished = self.sent + self.failed
+        return {
+            "backlog": self.backlog,
+            "chats_with_backlog": len(self._chats),
+            "max_backlog": self.max_backlog,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "retry_after_hits": self.retry_after_hits,
+            "retry_after_total_s": round(self.retry_after_total_s, 1),
+            "latency_avg_ms": round(self.latency_total_ms / finished, 1) if finished else 0.0,
+            "latency_max_ms": self.latency_max_ms,
+        }
+
+
+telegram_sender = TelegramSender(
+    global_per_second=settings.TG_SEND_GLOBAL_PER_SECOND,
+    chat_interval=settings.TG_SEND_CHAT_INTERVAL,
+    max_retries=settings.TG_SEND_MAX_RETRIES,
+    max_retry_after=settings.TG_SEND_MAX_RETRY_AFTER,
+)
@@ -0,0 +1,79 @@
+"""
+Прогрессивная отправка ответа агента: первое сообщение уходит, как только готово первое
+предложение, дальше оно редактируется не чаще STREAM_EDIT_INTERVAL секунд
+(лимиты Telegram на editMessageText). Отправка и правки идут через очередь чата telegram_sender.
+"""
+import asyncio
+import html
+import re
+import time
+from typing import Optional
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message
+
+from app.config import settings
+from app.telegram_bot.sender import telegram_sender
+
+# Конец предложения: знак препинания + пробел/перевод строки, либо просто перевод строки
+_SENTENCE_END = re.compile(r"[.!?…](\s|$)|\n")
+
+
+class StreamingReply:
+    def __init__(self, message: Message):
+        self._message = message
+        self._sent: Optional[Message] = None
+        self._shown_text = ""
+        self._latest_text = ""
+        self._last_edit_at = 0.0
+        self._inflight: Optional[asyncio.Task] = None
+
+    @property
+    def started(self) -> bool:
+        return self._sent is not None
+
+    async def on_text(self, text: str) -> None:
+        """
+        Колбэк для агента: text — весь накопленный ответ.
+        """
+        self._latest_text = text
+        if self._inflight and not self._inflight.done():
+            # Предыдущая отправка/правка ещё идёт — не блокируем чтение стрима
+            return
+        if self._sent is None:
+            if not _SENTENCE_END.search(text.strip() + " ") and len(text) < settings.STREAM_FIRST_CHUNK_CHARS:
+                return
+            self._inflight = asyncio.create_task(self._send_first(text))
+            return
+        if time.monotonic() - self._last_edit_at >= settings.STREAM_EDIT_INTERVAL:
+            self._inflight = asyncio.create_task(self._edit(text))
+
+    async def _send_first(self, text: str) -> None:
+        self._sent = await telegram_sender.send_message(self._message.chat.id, html.escape(text))
+        self._shown_text = text
+        self._last_edit_at = time.monotonic()
+
+    async def _edit(self, text: str) -> None:
+        if not text.strip() or text == self._shown_text:
+            return
+        try:
+            await telegram_sender.edit_message_text(self._sent.chat.id, self._sent.message_id, html.escape(text))
+            self._shown_text = text
+        except TelegramBadRequest as e:
+            # "message is not modified" и подобные — не критично для промежуточных правок
+            print(f"[streaming] Edit skipped: {e}")
+        self._last_edit_at = time.monotonic()
+
+    async def finalize(self, text: str) -> None:
+        """
+        Показывает окончательный ответ: правит уже отправленное сообщение или отправляет новое.
+        """
+        if self._inflight:
+            try:
+                await self._inflight
+            except Exception as e:
+                print(f"[streaming] Partial update failed: {type(e).__name__}: {e}")
+        if self._sent is None:
+            telegram_sender.send_message_nowait(self._message.chat.id, html.escape(text))
+            return
+        await self._edit(text)
@@ -0,0 +1,158 @@
+"""
+Очередь входящих апдейтов для быстрого ответа на вебхук.
+Апдейты одного пользователя (telegram_id) обрабатываются строго по порядку,
+апдейты разных пользователей — параллельно в ограниченном пуле воркеров.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from aiogram.types import Update
+
+from app.config import settings
+from app.metrics import update_seconds
+from app.telegram_bot.bot import bot, dp
+from app.tracing import trace_update
+
+
+def partition_key(update: Update) -> int:
+    # Ключ упорядочивания — telegram_id отправителя; апдейты без пользователя независимы
+    event = update.event
+    from_user = getattr(event, "from_user", None)
+    if from_user:
+        return from_user.id
+    return -update.update_id
+
+
+class UpdateQueue:
+    def __init__(self, process: Callable[[Update], Awaitable[Any]], workers: int, max_pending: int):
+        self._process = process
+        self._workers_count = workers
+        self._max_pending = max_pending
+        self._pending: Dict[int, Deque[Tuple[float, Update]]] = {}
+        self._ready: "asyncio.Queue[int]" = asyncio.Queue()
+        self._workers: List[asyncio.Task] = []
+        self._depth = 0
+        self._busy = 0
+        # Счётчики для мониторинга
+        self._accepted = 0
+        self._rejected = 0
+        self._processed = 0
+        self._errors = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_last = 0.0
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        for i in range(self._workers_count):
+            self._workers.append(asyncio.create_task(self._worker(), name=f"update-worker-{i}"))
+        print(f"[update_queue] Started {self._workers_count} workers")
+
+    async def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Дожидается обработки уже принятых апдейтов (не дольше timeout) и останавливает воркеров.
+        """
+        if self._depth:
+            deadline = time.monotonic() + (timeout if timeout is not None else settings.UPDATE_QUEUE_DRAIN_TIMEOUT)
+            while self._depth and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._depth:
+            print(f"[update_queue] Stopped with {self._depth} unprocessed updates")
+
+    def submit(self, update: Update) -> bool:
+        """
+        Ставит апдейт в очередь. Возвращает False, если очередь переполнена.
+        """
+        if self._depth >= self._max_pending:
+            self._rejected += 1
+            return False
+        key = partition_key(update)
+        item = (time.monotonic(), update)
+        chain = self._pending.get(key)
+        if chain is None:
+            # Ключ попадает в ready-очередь только один раз — это и гарантирует порядок
+            self._pending[key] = deque([item])
+            self._ready.put_nowait(key)
+        else:
+            chain.append(item)
+        self._depth += 1
+        self._accepted += 1
+        return True
+
+    def pending_for(self, key: int) -> int:
+        """
+        Сколько апдейтов с этим ключом ещё ждут обработки (не считая обрабатываемого).
+        """
+        chain = self._pending.get(key)
+        return len(chain) if chain else 0
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._ready.get()
+            chain = self._pending[key]
+            enqueued_at, update = chain.popleft()
+            wait = time.monotonic() - enqueued_at
+            self._wait_last = wait
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            self._busy += 1
+            try:
+                await self._process(update)
+            except Exception as e:
+                self._errors += 1
+                print(f"[update_queue] Error processing update {update.update_id}: {type(e).__name__}: {e}")
+            finally:
+                self._busy -= 1
+                self._depth -= 1
+                self._processed += 1
+                if chain:
+                    # Следующий апдейт этого пользователя — в конец ready-очереди (честность между пользователями)
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+
+    def stats(self) -> Dict[str, Any]:
+        dequeued = self._processed + self._busy
+        return {
+            "workers": self._workers_count,
+            "busy_workers": self._busy,
+            "depth": self._depth,
+            "waiting": self._depth - self._busy,
+            "partitions": len(self._pending),
+            "max_pending": self._max_pending,
+            "accepted": self._accepted,
+            "rejected": self._rejected,
+            "processed": self._processed,
+            "errors": self._errors,
+            "wait_last_s": round(self._wait_last, 4),
+            "wait_avg_s": round(self._wait_total / dequeued, 4) if dequeued else 0.0,
+            "wait_max_s": round(self._wait_max, 4),
+        }
+
+
+async def _process_update(update: Update) -> None:
+    # feed_update (а не feed_webhook_update) — дожидаемся полной обработки, чтобы сохранить порядок
+    with trace_update(update.update_id, "update_queue"):
+        outcome = "ok"
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            update_seconds.observe(time.perf_counter() - started, outcome=outcome)
+
+
+update_queue = UpdateQueue(
+    _process_update,
+    workers=settings.UPDATE_WORKERS,
+    max_pending=settings.UPDATE_QUEUE_MAX_SIZE,
+)
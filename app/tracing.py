@@ -0,0 +1,119 @@
+"""
+Лёгкие trace'ы обработки апдейта: все span'ы (команды Mongo, вызовы LLM, запросы к Telegram),
+выполненные в контексте одного update_id, собираются в один trace.
+Включается TRACE_SAMPLE_RATE > 0; последние trace'ы отдаются через /api/traces, медленные
+(дольше TRACE_LOG_SLOW_MS) печатаются в лог.
+"""
+import json
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from app.config import settings
+
+_current: ContextVar[Optional["Trace"]] = ContextVar("current_trace", default=None)
+# Отложенная работа апдейта (resume_trace) пишет span'ы и в уже завершённый trace
+_resumed: ContextVar[bool] = ContextVar("trace_resumed", default=False)
+_recent: Deque[Dict[str, Any]] = deque(maxlen=settings.TRACE_BUFFER_SIZE)
+
+
+class Trace:
+    def __init__(self, update_id: int, name: str):
+        self.update_id = update_id
+        self.name = name
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.spans: List[Dict[str, Any]] = []
+        self.finished = False
+
+    def add_span(self, name: str, started: float, duration: float, attrs: Dict[str, Any]) -> None:
+        late = self.finished
+        if late and not _resumed.get():
+            # Фоновые задачи, пережившие обработку апдейта, в trace не попадают
+            return
+        self.spans.append({
+            "name": name,
+            "start_ms": round((started - self.started) * 1000, 2),
+            "duration_ms": round(duration * 1000, 2),
+            **attrs,
+            **({"after_finish": True} if late else {}),
+        })
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "update_id": self.update_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            # Список общий: span'ы доставки ответа после завершения trace видны в /api/traces
+            "spans": self.spans,
+        }
+
+
+@contextmanager
+def trace_update(update_id: int, name: str) -> Iterator[Optional[Trace]]:
+    """
+    Trace обработки апдейта (с вероятностью TRACE_SAMPLE_RATE); вложенные вызовы не создают новый.
+    """
+    if _current.get() is not None or not settings.TRACE_SAMPLE_RATE or random.random() >= settings.TRACE_SAMPLE_RATE:
+        yield None
+        return
+    trace = Trace(update_id, name)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+        trace.finished = True
+        data = trace.to_dict()
+        _recent.append(data)
+        if data["duration_ms"] >= settings.TRACE_LOG_SLOW_MS:
+            print(f"[trace] {json.dumps(data, ensure_ascii=False, default=str)}")
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def resume_trace(trace: Optional[Trace]) -> Iterator[None]:
+    """
+    Span'ы работы, отложенной апдейтом (доставка ответа из очереди чата), — в trace этого апдейта,
+    даже если его обработка уже завершилась (span помечается after_finish). None — вне trace'ов.
+    """
+    token = _current.set(trace)
+    resumed = _resumed.set(trace is not None)
+    try:
+        yield
+    finally:
+        _resumed.reset(resumed)
+        _current.reset(token)
+
+
+def record_span(name: str, duration: float, **attrs: Any) -> None:
+    """
+    Span уже завершённой операции (длительность известна), например из listener'а Mongo.
+    """
+    trace = _current.get()
+    if trace is not None:
+        trace.add_span(name, time.perf_counter() - duration, duration, attrs)
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[None]:
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, started, time.perf_counter() - started, attrs)
+
+
+def recent_traces(limit: int = 50) -> List[Dict[str, Any]]:
+    return list(_recent)[-limit:]
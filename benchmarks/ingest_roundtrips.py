@@ -0,0 +1,128 @@
+"""
+Бенчмарк ingest/persist пути одного хода: сколько round-trip'ов к Mongo и сколько времени
+уходит на сохранение входящего сообщения и ответа ассистента — старая схема против текущей.
+
+Запуск (нужен локальный mongod):
+    MONGO_URI=mongodb://localhost:27017 python -m benchmarks.ingest_roundtrips --turns 200
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from datetime import datetime, timezone
+
+# Для импорта app.config достаточно фиктивных значений Telegram/OpenAI
+os.environ.setdefault("TG_BOT_TOKEN", "bench")
+os.environ.setdefault("WEBHOOK_URL", "http://localhost")
+os.environ.setdefault("WEBHOOK_SECRET", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("MONGO_DB", "ai_business_bot_bench")
+
+from pymongo import monitoring
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+counter = CommandCounter()
+# Регистрируем до создания клиента в app.db.mongo
+monitoring.register(counter)
+
+from app.db import repository  # noqa: E402
+from app.db.mongo import mongo_client, users, conversations, messages  # noqa: E402
+
+
+def _now_utc():
+    return datetime.now(timezone.utc)
+
+
+async def legacy_turn(telegram_id: int, text: str, reply: str):
+    # Повторяет прежние _upsert_user_and_push_user_message + _push_assistant_message
+    now = _now_utc()
+    conv = await conversations.find_one({"user_id": telegram_id}, {"stage": 1})
+    stage = conv.get("stage") if conv and "stage" in conv else "language"
+    await users.update_one(
+        {"telegram_id": telegram_id},
+        {
+            "$setOnInsert": {"telegram_id": telegram_id, "created_at": now},
+            "$set": {"first_name": "Bench", "last_message_at": now, "last_message_text": text, "last_seen_at": now},
+        },
+        upsert=True,
+    )
+    await users.find_one({"telegram_id": telegram_id}, {"_id": 0})
+    await conversations.update_one(
+        {"user_id": telegram_id},
+        {
+            "$setOnInsert": {"user_id": telegram_id, "created_at": now, "title": "Dialog with Bench"},
+            "$push": {"messages": {"role": "user", "text": text, "ts": now, "stage": stage}},
+            "$set": {"updated_at": now},
+        },
+        upsert=True,
+    )
+    await conversations.find_one({"user_id": telegram_id}, {"_id": 0})
+    conv = await conversations.find_one({"user_id": telegram_id}, {"stage": 1})
+    stage = conv.get("stage") if conv and "stage" in conv else "language"
+    await conversations.update_one(
+        {"user_id": telegram_id},
+        {"$push": {"messages": {"role": "assistant", "text": reply, "ts": _now_utc(), "stage": stage}}, "$set": {"updated_at": _now_utc()}},
+        upsert=True,
+    )
+
+
+async def current_turn(telegram_id: int, text: str, reply: str):
+    now = _now_utc()
+    await repository.record_user_message(
+        telegram_id,
+        user_fields={"first_name": "Bench", "last_message_at": now, "last_message_text": text, "last_seen_at": now},
+        message={"text": text, "message_id": 1, "chat_id": telegram_id},
+        title="Dialog with Bench",
+    )
+    await repository.append_assistant_message(telegram_id, reply)
+
+
+async def run(name: str, turn, turns: int, users_count: int):
+    await users.delete_many({})
+    await conversations.delete_many({})
+    await messages.delete_many({})
+    latencies = []
+    counter.count = 0
+    for i in range(turns):
+        telegram_id = 1_000_000 + i % users_count
+        t0 = time.perf_counter()
+        await turn(telegram_id, f"message {i}", f"reply {i}")
+        latencies.append((time.perf_counter() - t0) * 1000)
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{name:<8} round-trips/turn={counter.count / turns:5.2f}  "
+        f"p50={statistics.median(latencies):7.2f} ms  p95={p95:7.2f} ms  mean={statistics.mean(latencies):7.2f} ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--users", type=int, default=20)
+    args = parser.parse_args()
+    await repository.ensure_indexes()
+    await run("legacy", legacy_turn, args.turns, args.users)
+    await run("current", current_turn, args.turns, args.users)
+    await mongo_client.drop_database(os.environ["MONGO_DB"])
+    await mongo_client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,119 @@
+"""
+Бенчмарк устойчивости вызовов LLM против локального stub-сервера (benchmarks/stub_openai.py)
+с инжектированными задержками и ошибками: один вызов complete_message с дедлайном против
+resilient_complete (hedging, ретраи с backoff, fallback модели).
+
+Запуск (stub поднимается внутри процесса):
+    python -m benchmarks.llm_resilience --calls 500 --concurrency 50 --tail-rate 0.05 --error-rate 0.03
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+from benchmarks.stub_openai import StubConfig, create_app
+
+PORT = int(os.environ.get("STUB_OPENAI_PORT", "8100"))
+
+# Для импорта app.config достаточно фиктивных значений; OpenAI-клиент смотрит на stub
+os.environ.setdefault("TG_BOT_TOKEN", "bench")
+os.environ.setdefault("WEBHOOK_URL", "http://localhost")
+os.environ.setdefault("WEBHOOK_SECRET", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("MONGO_DB", "ai_business_bot_bench")
+os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{PORT}/v1"
+
+import uvicorn  # noqa: E402
+
+from app.agent.llm import close_llm_client, complete_message  # noqa: E402
+from app.agent.resilience import resilience_stats, resilient_complete  # noqa: E402
+
+MESSAGES = [
+    {"role": "system", "content": "You are a helpful assistant."},
+    {"role": "user", "content": "Tell me about your service."},
+]
+
+
+def _percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * (len(ordered) - 1)))]
+
+
+async def _noop_text(text: str) -> None:
+    pass
+
+
+async def run(mode: str, args: argparse.Namespace) -> None:
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    failures = {}
+    on_text = _noop_text if args.stream else None
+
+    async def one_call():
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                if mode == "plain":
+                    await complete_message(on_text, timeout=args.deadline, model=args.model, messages=MESSAGES, max_tokens=200)
+                else:
+                    await resilient_complete(args.model, args.deadline, on_text, messages=MESSAGES, max_tokens=200)
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                name = type(e).__name__
+                failures[name] = failures.get(name, 0) + 1
+
+    for key in resilience_stats:
+        resilience_stats[key] = 0
+    started = time.perf_counter()
+    await asyncio.gather(*(one_call() for _ in range(args.calls)))
+    elapsed = time.perf_counter() - started
+
+    print(f"\n== {mode} ({'stream' if args.stream else 'full'}) ==")
+    print(f"ok: {len(latencies)}/{args.calls}  failures: {failures or 0}  wall: {elapsed:.1f}s")
+    if latencies:
+        print(
+            f"latency ms: p50={_percentile(latencies, 0.5) * 1000:.0f} "
+            f"p95={_percentile(latencies, 0.95) * 1000:.0f} "
+            f"p99={_percentile(latencies, 0.99) * 1000:.0f} "
+            f"mean={statistics.mean(latencies) * 1000:.0f}"
+        )
+    if mode == "resilient":
+        print(f"resilience: {resilience_stats}")
+
+
+async def main(args: argparse.Namespace) -> None:
+    config = StubConfig(
+        latency_ms=args.latency_ms,
+        tail_rate=args.tail_rate,
+        tail_ms=args.tail_ms,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+    )
+    server = uvicorn.Server(uvicorn.Config(create_app(config), host="127.0.0.1", port=PORT, log_level="warning"))
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    try:
+        for mode in ("plain", "resilient"):
+            await run(mode, args)
+    finally:
+        server.should_exit = True
+        await server_task
+        await close_llm_client()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=30)
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--deadline", type=float, default=20.0)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--latency-ms", type=float, default=400.0)
+    parser.add_argument("--tail-rate", type=float, default=0.05)
+    parser.add_argument("--tail-ms", type=float, default=6000.0)
+    parser.add_argument("--error-rate", type=float, default=0.03)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.02)
+    asyncio.run(main(parser.parse_args()))
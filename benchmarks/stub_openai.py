@@ -0,0 +1,193 @@
+"""
+Локальный stub OpenAI Chat Completions API с управляемыми задержками и ошибками.
+Поддерживает обычные и потоковые (stream=true, SSE) ответы, 429 с retry-after и 5xx,
+JSON mode и сценарные вызовы функций этапов (--script-turns) для прогона диалога целиком.
+
+Запуск:
+    python -m benchmarks.stub_openai --port 8100 --latency-ms 400 --tail-rate 0.05 --tail-ms 6000 \\
+        --error-rate 0.02 --rate-limit-rate 0.02
+и в .env приложения: OPENAI_BASE_URL=http://127.0.0.1:8100/v1
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class StubConfig:
+    # Медианная задержка до ответа (до первого токена при стриминге) и её разброс (lognormal sigma)
+    latency_ms: float = 400.0
+    jitter: float = 0.3
+    # Доля «хвостовых» запросов с большой задержкой
+    tail_rate: float = 0.0
+    tail_ms: float = 5000.0
+    # Доля ответов 500 и 429 (с заголовком retry-after-ms)
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after_ms: int = 200
+    # Задержка между чанками при стриминге
+    chunk_ms: float = 20.0
+    reply_words: int = 40
+    # Доля ответов вызовом функции (первая из переданных functions)
+    function_call_rate: float = 0.0
+    # Сценарий: вызвать первую из переданных functions, когда в запросе набралось столько
+    # сообщений пользователя (0 — сценарий выключен, действует function_call_rate)
+    script_turns: int = 0
+
+
+def _delay(config: StubConfig) -> float:
+    if config.tail_rate and random.random() < config.tail_rate:
+        return config.tail_ms / 1000
+    return config.latency_ms / 1000 * random.lognormvariate(0, config.jitter)
+
+
+def _error(config: StubConfig) -> Optional[JSONResponse]:
+    roll = random.random()
+    if roll < config.rate_limit_rate:
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached (stub)", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429,
+            headers={"retry-after-ms": str(config.retry_after_ms), "x-ratelimit-reset-requests": f"{config.retry_after_ms}ms"},
+        )
+    if roll < config.rate_limit_rate + config.error_rate:
+        return JSONResponse({"error": {"message": "Internal error (stub)", "type": "server_error"}}, status_code=500)
+    return None
+
+
+def _reply_text(body: Dict[str, Any], config: StubConfig) -> str:
+    last_user = next((m.get("content") or "" for m in reversed(body.get("messages", [])) if m.get("role") == "user"), "")
+    if (body.get("response_format") or {}).get("type") == "json_object":
+        # Извлечение ответов опроса (JSON mode)
+        return json.dumps({"answers": [{"question": "Stub question", "answer": str(last_user)[:60]}]})
+    words = " ".join(f"word{i}" for i in range(config.reply_words))
+    return f"Stub reply to: {str(last_user)[:60]}. {words}."
+
+
+# Аргументы функций этапов для сценарного режима (telegram_id подставляет движок)
+SCRIPTED_ARGUMENTS: Dict[str, Dict[str, Any]] = {
+    "update_user_language": {"language_code": "English"},
+    "update_profile_summary": {"profile_summary": "Owner of a small bakery looking to automate orders."},
+    "update_preffered_name": {"preffered_name": "Alex"},
+    "finish_survey": {},
+    "update_user_email_and_final_message": {
+        "email": "stub@example.com",
+        "final_message": "Thank you! You are in the queue, we will contact you.",
+    },
+}
+
+
+def _function_call(body: Dict[str, Any], config: StubConfig) -> Optional[Dict[str, str]]:
+    functions = body.get("functions") or []
+    if not functions:
+        return None
+    if config.script_turns:
+        user_turns = sum(1 for m in body.get("messages", []) if m.get("role") == "user")
+        if user_turns < config.script_turns:
+            return None
+        name = functions[0]["name"]
+        return {"name": name, "arguments": json.dumps(SCRIPTED_ARGUMENTS.get(name, {}))}
+    if random.random() < config.function_call_rate:
+        return {"name": functions[0]["name"], "arguments": "{}"}
+    return None
+
+
+def _usage(body: Dict[str, Any], completion_text: str) -> Dict[str, Any]:
+    prompt_chars = sum(len(str(m.get("content") or "")) for m in body.get("messages", []))
+    prompt_tokens = prompt_chars // 4 + 1
+    completion_tokens = len(completion_text) // 4 + 1
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": 0},
+    }
+
+
+def create_app(config: StubConfig) -> FastAPI:
+    app = FastAPI()
+    app.state.requests = 0
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        await asyncio.sleep(_delay(config))
+        error = _error(config)
+        if error is not None:
+            return error
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+        model = body.get("model", "stub")
+        fn = _function_call(body, config)
+        text = None if fn else _reply_text(body, config)
+
+        if not body.get("stream"):
+            message: Dict[str, Any] = {"role": "assistant", "content": text}
+            if fn:
+                message["function_call"] = fn
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": "function_call" if fn else "stop"}],
+                "usage": _usage(body, text or json.dumps(fn)),
+            }
+
+        async def events():
+            def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None, usage=None, choices=True):
+                data = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if choices else [],
+                }
+                if usage is not None:
+                    data["usage"] = usage
+                return f"data: {json.dumps(data)}\n\n"
+
+            yield chunk({"role": "assistant", "content": ""})
+            if fn:
+                yield chunk({"function_call": fn})
+            else:
+                for word in text.split(" "):
+                    yield chunk({"content": word + " "})
+                    await asyncio.sleep(config.chunk_ms / 1000)
+            yield chunk({}, finish_reason="function_call" if fn else "stop")
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield chunk({}, usage=_usage(body, text or json.dumps(fn)), choices=False)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    for name, default in StubConfig.__dataclass_fields__.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(default.default), default=default.default)
+    return parser.parse_args(argv)
+
+
+def config_from_args(args: argparse.Namespace) -> StubConfig:
+    return StubConfig(**{name: getattr(args, name) for name in StubConfig.__dataclass_fields__})
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    args = parse_args()
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
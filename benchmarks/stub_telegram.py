@@ -0,0 +1,64 @@
+"""
+Локальный stub Telegram Bot API для бенчмарков: принимает запросы бота
+(POST /bot<token>/<method>), отвечает как Bot API и складывает отправленные тексты
+в очередь чата, чтобы нагрузочный клиент мог дождаться ответа на своё сообщение.
+
+Приложение направляется на stub настройкой TG_API_BASE_URL=http://127.0.0.1:8200
+"""
+import asyncio
+import itertools
+import time
+from typing import Any, Dict
+
+from aiohttp import web
+
+# Методы, которые возвращают отправленное/изменённое сообщение
+MESSAGE_METHODS = {"sendmessage", "editmessagetext"}
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench bot", "username": "bench_bot"}
+
+
+class StubTelegram:
+    def __init__(self):
+        self.requests: Dict[str, int] = {}
+        self._replies: Dict[int, asyncio.Queue] = {}
+        self._message_ids = itertools.count(1)
+
+    def replies(self, chat_id: int) -> asyncio.Queue:
+        """
+        Очередь текстов, отправленных ботом в чат chat_id (sendMessage и editMessageText).
+        """
+        queue = self._replies.get(chat_id)
+        if queue is None:
+            queue = self._replies[chat_id] = asyncio.Queue()
+        return queue
+
+    @property
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.requests[method] = self.requests.get(method, 0) + 1
+        params = dict(await request.post())
+        if method.lower() == "getme":
+            return web.json_response({"ok": True, "result": BOT_USER})
+        if method.lower() not in MESSAGE_METHODS:
+            return web.json_response({"ok": True, "result": True})
+
+        chat_id = int(params.get("chat_id") or 0)
+        text = str(params.get("text") or "")
+        message_id = int(params.get("message_id") or next(self._message_ids))
+        self.replies(chat_id).put_nowait(text)
+        result: Dict[str, Any] = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": text,
+        }
+        return web.json_response({"ok": True, "result": result})
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
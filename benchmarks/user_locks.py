@@ -0,0 +1,80 @@
+"""
+Проверка и бенчмарк распределённых блокировок пользователей (app/db/locks.py) на локальном mongod:
+несколько «процессов» (экземпляры ClusterLocks с разными владельцами) конкурируют за небольшое
+число пользователей; считаем нарушения взаимного исключения, пропускную способность и ожидание.
+
+Запуск (нужен локальный mongod):
+    MONGO_URI=mongodb://localhost:27017 python -m benchmarks.user_locks --processes 8 --users 20 --turns 2000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+
+# Для импорта app.config достаточно фиктивных значений Telegram/OpenAI
+os.environ.setdefault("TG_BOT_TOKEN", "bench")
+os.environ.setdefault("WEBHOOK_URL", "http://localhost")
+os.environ.setdefault("WEBHOOK_SECRET", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("MONGO_DB", "ai_business_bot_bench")
+
+from app.db.locks import ClusterLocks  # noqa: E402
+from app.db.mongo import mongo_client, locks  # noqa: E402
+from app.db.repository import ensure_indexes  # noqa: E402
+
+
+async def main(args: argparse.Namespace) -> None:
+    await ensure_indexes()
+    await locks.delete_many({"_id": {"$regex": "^user:"}})
+    processes = [
+        ClusterLocks(enabled=True, owner=f"bench-{i}", ttl=30.0, wait=60.0)
+        for i in range(args.processes)
+    ]
+    inside = {}
+    violations = 0
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def turn(i: int) -> None:
+        nonlocal violations
+        proc = processes[i % len(processes)]
+        user_id = random.randrange(args.users)
+        async with semaphore:
+            started = time.perf_counter()
+            async with proc.user_lock(user_id):
+                latencies.append(time.perf_counter() - started)
+                inside[user_id] = inside.get(user_id, 0) + 1
+                if inside[user_id] > 1:
+                    violations += 1
+                await asyncio.sleep(args.hold_ms / 1000)
+                inside[user_id] -= 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(turn(i) for i in range(args.turns)))
+    elapsed = time.perf_counter() - started
+
+    ordered = sorted(latencies)
+    print(f"turns: {args.turns}  processes: {args.processes}  users: {args.users}  wall: {elapsed:.1f}s")
+    print(f"throughput: {args.turns / elapsed:.0f} turns/s  mutual exclusion violations: {violations}")
+    print(
+        f"lock wait ms: p50={ordered[len(ordered) // 2] * 1000:.1f} "
+        f"p95={ordered[int(len(ordered) * 0.95)] * 1000:.1f} "
+        f"mean={statistics.mean(latencies) * 1000:.1f}"
+    )
+    print(f"contended: {sum(p.contended for p in processes)}  "
+          f"cache invalidations: {sum(p.cache_invalidations for p in processes)}")
+    await locks.delete_many({"_id": {"$regex": "^user:"}})
+    await mongo_client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--hold-ms", type=float, default=5.0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,227 @@
+"""
+Нагрузочный бенчмарк всего хода через вебхук: синтетические пользователи параллельно проходят
+диалог language → profile → survey → summary → final, отправляя Telegram Update в
+telegram_webhook и дожидаясь ответа бота. Внутри процесса поднимаются приложение (uvicorn),
+stub OpenAI со сценарными вызовами функций (benchmarks/stub_openai.py) и stub Bot API
+(benchmarks/stub_telegram.py); нужен локальный mongod, база бенчмарка очищается при старте.
+
+Отчёт: пропускная способность, p50/p95/p99 задержки хода (от POST вебхука до ответа бота),
+в том числе по этапам, и число команд Mongo, вызовов LLM и запросов к Bot API на ход.
+Задержка включает окно склейки пачек MESSAGE_DEBOUNCE_WINDOW из настроек; MESSAGE_DEBOUNCE_WINDOW=0
+в окружении — замер без него.
+
+Запуск:
+    MONGO_URI=mongodb://localhost:27017 python -m benchmarks.webhook_load --users 200 --concurrency 50
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import statistics
+import time
+from typing import Dict, List, Tuple
+
+APP_PORT = int(os.environ.get("BENCH_APP_PORT", "8300"))
+OPENAI_PORT = int(os.environ.get("STUB_OPENAI_PORT", "8100"))
+TELEGRAM_PORT = int(os.environ.get("STUB_TELEGRAM_PORT", "8200"))
+
+# Приложение смотрит на локальные stub'ы и отдельную базу; фиктивные токены
+os.environ.setdefault("TG_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("WEBHOOK_SECRET", "bench")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+os.environ.setdefault("MONGO_DB", "ai_business_bot_bench")
+os.environ["WEBHOOK_URL"] = f"http://127.0.0.1:{APP_PORT}"
+os.environ["TG_API_BASE_URL"] = f"http://127.0.0.1:{TELEGRAM_PORT}"
+os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{OPENAI_PORT}/v1"
+# Ответ целиком одним sendMessage — так клиент видит конец хода
+os.environ["STREAM_REPLIES"] = "false"
+
+from pymongo import monitoring  # noqa: E402
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+mongo_commands = CommandCounter()
+# Регистрируем до создания клиента в app.db.mongo
+monitoring.register(mongo_commands)
+
+import aiohttp  # noqa: E402
+import uvicorn  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+from app.config import settings  # noqa: E402
+from app.db.mongo import conversations, mongo_client  # noqa: E402
+from app.main import WEBHOOK_PATH, app  # noqa: E402
+from benchmarks.stub_openai import StubConfig, create_app as create_openai_stub  # noqa: E402
+from benchmarks.stub_telegram import StubTelegram  # noqa: E402
+
+BASE_USER_ID = 700_000_000
+ERROR_PREFIX = "⚠️"
+
+
+def build_script(telegram_id: int, stage_turns: int) -> List[Tuple[str, str]]:
+    """
+    Сообщения пользователя с этапом, на котором они отправляются. Stub вызывает функцию этапа
+    на stage_turns-м сообщении этапа: profile и survey закрываются через stage_turns ходов,
+    язык и email распознают детерминированные правила.
+    """
+    return [
+        ("language", "hi"),
+        ("language", "English"),
+        *[("profile", f"I run a small bakery, answer {i + 1}") for i in range(stage_turns)],
+        *[("survey", f"We take about {10 * (i + 1)} orders a day by phone") for i in range(stage_turns)],
+        ("summary", f"my email is user{telegram_id}@example.com"),
+        ("final", "thanks"),
+    ]
+
+
+def _percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * (len(ordered) - 1)))]
+
+
+def _latency_line(values: List[float]) -> str:
+    return (
+        f"p50={_percentile(values, 0.5) * 1000:.0f} p95={_percentile(values, 0.95) * 1000:.0f} "
+        f"p99={_percentile(values, 0.99) * 1000:.0f} mean={statistics.mean(values) * 1000:.0f}"
+    )
+
+
+class LoadRun:
+    def __init__(self, args: argparse.Namespace, telegram: StubTelegram):
+        self.args = args
+        self.telegram = telegram
+        self.update_ids = itertools.count(1)
+        self.latencies: Dict[str, List[float]] = {}
+        self.failures: Dict[str, int] = {}
+        self.url = f"http://127.0.0.1:{APP_PORT}{WEBHOOK_PATH}"
+
+    def _fail(self, reason: str) -> None:
+        self.failures[reason] = self.failures.get(reason, 0) + 1
+
+    async def _turn(self, http: aiohttp.ClientSession, telegram_id: int, message_id: int, stage: str, text: str) -> bool:
+        update = {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": telegram_id, "type": "private"},
+                "from": {"id": telegram_id, "is_bot": False, "first_name": "Bench", "language_code": "en"},
+                "text": text,
+            },
+        }
+        replies = self.telegram.replies(telegram_id)
+        started = time.perf_counter()
+        async with http.post(self.url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": settings.WEBHOOK_SECRET}) as response:
+            if response.status != 200:
+                self._fail(f"webhook {response.status}")
+                return False
+        try:
+            reply = await asyncio.wait_for(replies.get(), timeout=self.args.turn_timeout)
+        except asyncio.TimeoutError:
+            self._fail("reply timeout")
+            return False
+        self.latencies.setdefault(stage, []).append(time.perf_counter() - started)
+        if reply.startswith(ERROR_PREFIX):
+            self._fail("error reply")
+            return False
+        return True
+
+    async def user(self, http: aiohttp.ClientSession, semaphore: asyncio.Semaphore, index: int) -> None:
+        telegram_id = BASE_USER_ID + index
+        async with semaphore:
+            for message_id, (stage, text) in enumerate(build_script(telegram_id, self.args.stage_turns), start=1):
+                if not await self._turn(http, telegram_id, message_id, stage, text):
+                    return
+                if self.args.think_ms:
+                    await asyncio.sleep(self.args.think_ms / 1000)
+
+    async def run(self) -> float:
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as http:
+            started = time.perf_counter()
+            await asyncio.gather(*(self.user(http, semaphore, i) for i in range(self.args.users)))
+            return time.perf_counter() - started
+
+
+async def _serve(server: uvicorn.Server) -> asyncio.Task:
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+        await asyncio.sleep(0.05)
+    return task
+
+
+async def main(args: argparse.Namespace) -> None:
+    await mongo_client.drop_database(settings.MONGO_DB)
+
+    stub_config = StubConfig(latency_ms=args.llm_latency_ms, chunk_ms=0, reply_words=args.reply_words, script_turns=args.stage_turns)
+    openai_app = create_openai_stub(stub_config)
+    openai_server = uvicorn.Server(uvicorn.Config(openai_app, host="127.0.0.1", port=OPENAI_PORT, log_level="warning"))
+    telegram = StubTelegram()
+    telegram_runner = web.AppRunner(telegram.create_app())
+    await telegram_runner.setup()
+    await web.TCPSite(telegram_runner, "127.0.0.1", TELEGRAM_PORT).start()
+    openai_task = await _serve(openai_server)
+    app_server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=APP_PORT, log_level="warning"))
+    app_task = await _serve(app_server)
+
+    try:
+        # Команды старта (индексы, set_webhook) в расчёт на ход не входят
+        mongo_before = mongo_commands.count
+        llm_before = openai_app.state.requests
+        telegram_before = telegram.total_requests
+
+        load = LoadRun(args, telegram)
+        elapsed = await load.run()
+        # Фоновые задачи хода (извлечение ответов опроса, сводка контекста) успевают завершиться
+        await asyncio.sleep(args.settle)
+
+        turns = sum(len(v) for v in load.latencies.values())
+        finished = await conversations.count_documents({"stage": "final"})
+        print(f"\n== webhook load ({settings.UPDATE_PROCESSING_MODE}, {args.users} users, concurrency {args.concurrency}) ==")
+        print(f"turns: {turns}  finished dialogs: {finished}/{args.users}  failures: {load.failures or 0}  wall: {elapsed:.1f}s")
+        if turns:
+            print(f"throughput: {turns / elapsed:.1f} turns/s")
+            print(f"turn latency ms: {_latency_line([v for values in load.latencies.values() for v in values])}")
+            for stage, values in load.latencies.items():
+                print(f"  {stage:<8} ({len(values)} turns): {_latency_line(values)}")
+            print(
+                f"per turn: mongo commands={(mongo_commands.count - mongo_before) / turns:.1f} "
+                f"llm calls={(openai_app.state.requests - llm_before) / turns:.2f} "
+                f"telegram requests={(telegram.total_requests - telegram_before) / turns:.2f}"
+            )
+    finally:
+        app_server.should_exit = True
+        await app_task
+        openai_server.should_exit = True
+        await openai_task
+        await telegram_runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=50, help="пользователей в диалоге одновременно")
+    parser.add_argument("--stage-turns", type=int, default=2, help="сообщений пользователя на этапах profile и survey")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="пауза пользователя между сообщениями")
+    parser.add_argument("--turn-timeout", type=float, default=60.0)
+    parser.add_argument("--settle", type=float, default=1.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=400.0)
+    parser.add_argument("--reply-words", type=int, default=40)
+    asyncio.run(main(parser.parse_args()))